@@ -0,0 +1,91 @@
+"""
+Concurrent connects: threads over Usbmux against one event loop over AsyncUsbmux
+
+One tunnel to lockdownd is opened to every simulated device at once and
+closed again. usbmuxd answers each Connect after --delay seconds, the round
+trip to a phone. The fake usbmuxd runs in a child process, so it does not
+share the interpreter lock with the clients. Reports the wall time of the
+round and the threads the client used for it.
+
+    python benchmarks/aio.py [--devices 1,16,64,256] [--delay 0.02]
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeUsbmuxd  # noqa: E402
+from ioscmd.aio import AsyncUsbmux  # noqa: E402
+from ioscmd.sockets import LOCKDOWN_PORT, Usbmux  # noqa: E402
+
+
+def _serve(path: str, devices: int, delay: float, ready):
+    FakeUsbmuxd(path, devices, connect_delay=delay).start()
+    ready.set()
+    threading.Event().wait()
+
+
+def threaded(path: str, devids) -> dict:
+    with Usbmux(path) as usbmux, concurrent.futures.ThreadPoolExecutor(max_workers=len(devids),
+                                                                      thread_name_prefix="connect") as executor:
+        start = time.perf_counter()
+        futures = [executor.submit(usbmux.connect_device_port, devid, LOCKDOWN_PORT) for devid in devids]
+        for future in futures:
+            future.result().close()
+        elapsed = time.perf_counter() - start
+        threads = sum(1 for t in threading.enumerate() if t.name.startswith("connect"))
+    return {"client": "threads", "round_ms": round(elapsed * 1000, 1), "client_threads": threads}
+
+
+def asynchronous(path: str, devids) -> dict:
+    async def connect(usbmux: AsyncUsbmux, devid: int):
+        _, writer = await usbmux.connect_device_port(devid, LOCKDOWN_PORT)
+        writer.close()
+        await writer.wait_closed()
+
+    async def round_trip():
+        usbmux = AsyncUsbmux(path)
+        start = time.perf_counter()
+        await asyncio.gather(*(connect(usbmux, devid) for devid in devids))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(round_trip())
+    return {"client": "asyncio", "round_ms": round(elapsed * 1000, 1), "client_threads": 1}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", default="1,16,64,256", help='comma separated device counts')
+    parser.add_argument("--delay", type=float, default=0.02, help='seconds usbmuxd takes per Connect')
+    args = parser.parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for count in (int(n) for n in args.devices.split(",")):
+            path = os.path.join(directory, "usbmuxd-{}.sock".format(count))
+            ready = multiprocessing.Event()
+            server = multiprocessing.Process(target=_serve, args=(path, count, args.delay, ready), daemon=True)
+            server.start()
+            ready.wait()
+            devids = list(range(1, count + 1))  # FakeUsbmuxd numbers its devices from 1
+            for func in (threaded, asynchronous):
+                result = {"devices": count}
+                result.update(func(path, devids))
+                results.append(result)
+            server.terminate()
+            server.join()
+    json.dump({"benchmark": "aio", "delay_s": args.delay, "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Output throughput of a remote command: stream_command against the old readline loop
+
+The channel is a MuxChannel on a socketpair fed by a thread which plays the
+remote command, so only the local copy loop is measured. Output goes to
+/dev/null.
+
+    python benchmarks/exec.py [--megabytes 64] [--line 80]
+"""
+import argparse
+import contextlib
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ioscmd.mux import FRAME_EOF, FRAME_EXIT, FRAME_DATA, MuxChannel, send_frame  # noqa: E402
+from ioscmd.ssh_client import stream_command  # noqa: E402
+
+
+class _Client:
+    """ exec_command of a command which prints size bytes of text lines """
+
+    def __init__(self, size: int, line: int):
+        self._size = size
+        self._line = b"x" * (line - 1) + b"\n"
+
+    def _remote(self, sock: socket.socket):
+        chunk = self._line * (32768 // len(self._line))
+        left = self._size
+        while left > 0:
+            send_frame(sock, FRAME_DATA, chunk[:left])
+            left -= len(chunk)
+        send_frame(sock, FRAME_EOF)
+        send_frame(sock, FRAME_EXIT, struct.pack(">i", 0))
+        sock.close()
+
+    def exec_command(self, command):
+        local, remote = socket.socketpair()
+        threading.Thread(target=self._remote, args=(remote,), daemon=True).start()
+        chan = MuxChannel(local, command)
+        return chan.makefile_stdin("wb"), chan.makefile("r"), chan.makefile_stderr("r")
+
+
+def readline_loop(client, devnull):
+    """ the shell command before stream_command """
+    _, stdout, stderr = client.exec_command("cat")
+    with open(os.devnull, "w") as text, contextlib.redirect_stdout(text):
+        while True:
+            line = stdout.readline()
+            if not line:
+                break
+            print(line.rstrip())
+
+
+def streaming(client, devnull):
+    stream_command(client, "cat", stdout=devnull, stderr=devnull)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megabytes", type=int, default=64)
+    parser.add_argument("--line", type=int, default=80, help='bytes per output line')
+    args = parser.parse_args()
+    size = args.megabytes * 1024 * 1024
+    results = []
+    with open(os.devnull, "wb") as devnull:
+        for func in (readline_loop, streaming):
+            start = time.perf_counter()
+            func(_Client(size, args.line), devnull)
+            elapsed = time.perf_counter() - start
+            results.append({"loop": func.__name__, "seconds": round(elapsed, 3),
+                            "mb_per_s": round(args.megabytes / elapsed, 1)})
+    json.dump({"benchmark": "exec", "megabytes": args.megabytes, "line": args.line, "results": results},
+              sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
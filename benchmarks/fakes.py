@@ -0,0 +1,548 @@
+"""
+Local stand-ins for the device side, so benchmarks need no phone
+
+FakeSSHServer is a paramiko server accepting root / alpine. exec requests
+run through /bin/sh on this machine and sftp serves the local filesystem.
+FakeUsbmuxd answers the usbmuxd protocol on a unix socket for a number of
+simulated devices, their ports relay to local tcp ports such as the ssh server.
+"""
+import logging
+import os
+import plistlib
+import queue
+import socket
+import struct
+import subprocess
+import threading
+import time
+import typing
+
+import paramiko
+from paramiko import AUTH_FAILED, AUTH_SUCCESSFUL, OPEN_SUCCEEDED, SFTP_OK, SFTPAttributes, SFTPHandle, \
+    SFTPServer, SFTPServerInterface
+
+# clients hanging up mid transfer are expected, do not print each reset
+logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+_host_key = None
+_host_key_lock = threading.Lock()
+
+
+def host_key() -> paramiko.PKey:
+    global _host_key
+    with _host_key_lock:
+        if _host_key is None:
+            _host_key = paramiko.RSAKey.generate(2048)
+        return _host_key
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        f = getattr(self, "readfile", None) or self.writefile
+        return SFTPAttributes.from_stat(os.fstat(f.fileno()))
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+class _LocalFS(SFTPServerInterface):
+    @staticmethod
+    def _call(func):
+        try:
+            return func()
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        def listdir():
+            result = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+
+        return self._call(listdir)
+
+    def stat(self, path):
+        return self._call(lambda: SFTPAttributes.from_stat(os.stat(path)))
+
+    def lstat(self, path):
+        return self._call(lambda: SFTPAttributes.from_stat(os.lstat(path)))
+
+    def open(self, path, flags, attr):
+        def open_file():
+            fd = os.open(path, flags, 0o644)
+            if flags & os.O_WRONLY:
+                mode = "wb"
+            elif flags & os.O_RDWR:
+                mode = "rb+"
+            else:
+                mode = "rb"
+            f = os.fdopen(fd, mode)
+            handle = _Handle(flags)
+            handle.filename = path
+            if "r" in mode or "+" in mode:
+                handle.readfile = f
+            if "w" in mode or "+" in mode:
+                handle.writefile = f
+            return handle
+
+        return self._call(open_file)
+
+    def remove(self, path):
+        return self._call(lambda: os.remove(path) or SFTP_OK)
+
+    def rename(self, oldpath, newpath):
+        return self._call(lambda: os.rename(oldpath, newpath) or SFTP_OK)
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self._call(lambda: os.mkdir(path) or SFTP_OK)
+
+    def rmdir(self, path):
+        return self._call(lambda: os.rmdir(path) or SFTP_OK)
+
+    def chattr(self, path, attr):
+        def chattr():
+            if attr.st_mtime is not None:
+                os.utime(path, (attr.st_atime, attr.st_mtime))
+            return SFTP_OK
+
+        return self._call(chattr)
+
+    def canonicalize(self, path):
+        return os.path.abspath(path)
+
+
+def _run(chan: paramiko.Channel, command: str, replied: threading.Event):
+    # like sshd, start once the request is acknowledged, a fast command
+    # must not close the channel before the client saw the success reply
+    replied.wait(5)
+    proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    def pump_stdin():
+        try:
+            for data in iter(lambda: chan.recv(65536), b""):
+                proc.stdin.write(data)
+                proc.stdin.flush()
+        except OSError:
+            pass
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+
+    def pump_stderr():
+        for data in iter(lambda: os.read(proc.stderr.fileno(), 65536), b""):
+            chan.sendall_stderr(data)
+
+    threading.Thread(target=pump_stdin, daemon=True).start()
+    stderr = threading.Thread(target=pump_stderr, daemon=True)
+    stderr.start()
+    try:
+        for data in iter(lambda: os.read(proc.stdout.fileno(), 65536), b""):
+            chan.sendall(data)
+        stderr.join()
+        chan.send_exit_status(proc.wait())
+        chan.shutdown_write()
+    except (OSError, EOFError):
+        proc.kill()
+    finally:
+        chan.close()
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self):
+        self._replies = {}  # remote channel id: Event set once the request reply is sent
+        self._lock = threading.Lock()
+
+    def _reply_event(self, chanid: int) -> threading.Event:
+        with self._lock:
+            return self._replies.setdefault(chanid, threading.Event())
+
+    def wrap(self, transport: paramiko.Transport):
+        """ watch the channel success replies which transport sends """
+        send = transport._send_user_message
+
+        def send_user_message(message):
+            send(message)
+            data = message.asbytes()
+            if data[:1] == paramiko.common.cMSG_CHANNEL_SUCCESS:
+                (chanid,) = struct.unpack(">I", data[1:5])
+                with self._lock:
+                    event = self._replies.pop(chanid, None)
+                if event is not None:
+                    event.set()
+
+        transport._send_user_message = send_user_message
+
+    def _start(self, channel: paramiko.Channel, command: str):
+        replied = self._reply_event(channel.remote_chanid)
+        threading.Thread(target=_run, args=(channel, command, replied), daemon=True).start()
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL if (username, password) == ("root", "alpine") else AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_window_change_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self._start(channel, "sh -i")
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self._start(channel, command.decode())
+        return True
+
+
+class FakeSSHServer:
+    """
+    Args:
+        compression: offer zlib, like OpenSSH and dropbear do
+    """
+
+    def __init__(self, port: int = 0, compression: bool = True):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", port))
+        self._listener.listen(128)
+        self._compression = compression
+        self.port = self._listener.getsockname()[1]
+
+    def start(self) -> "FakeSSHServer":
+        host_key()
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._start_transport, args=(sock,), daemon=True).start()
+
+    def _start_transport(self, sock: socket.socket):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # as sshd does
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key())
+        transport.use_compression(self._compression)
+        transport.set_subsystem_handler("sftp", SFTPServer, _LocalFS)
+        try:
+            server = _Server()
+            server.wrap(transport)
+            transport.start_server(server=server)
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def close(self):
+        self._listener.close()
+
+
+class ThrottledProxy:
+    """
+    tcp relay limited to bandwidth bytes per second each way, stands in for a wifi link
+
+    latency delays every chunk by that many seconds each way without
+    holding back the ones behind it, so a round trip costs twice of it.
+    """
+
+    def __init__(self, target_port: int, bandwidth: typing.Optional[float] = None, port: int = 0,
+                 latency: float = 0.0):
+        self._target = ("127.0.0.1", target_port)
+        self._bandwidth = bandwidth
+        self._latency = latency
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", port))
+        self._listener.listen(128)
+        self.port = self._listener.getsockname()[1]
+
+    def start(self) -> "ThrottledProxy":
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self._listener.accept()
+            except OSError:
+                return
+            server = socket.create_connection(self._target)
+            if self._latency:
+                # small writes must not wait for the delayed ack of the one before
+                for sock in (client, server):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._pipe, args=(client, server), daemon=True).start()
+            threading.Thread(target=self._pipe, args=(server, client), daemon=True).start()
+
+    def _pipe(self, src: socket.socket, dst: socket.socket):
+        if not self._latency:
+            self._send(dst, ((0.0, data) for data in self._recv(src)))
+            return
+        chunks = queue.Queue()
+        threading.Thread(target=self._send, args=(dst, iter(chunks.get, None)), daemon=True).start()
+        for data in self._recv(src):
+            chunks.put((time.monotonic() + self._latency, data))
+        chunks.put(None)
+
+    @staticmethod
+    def _recv(src: socket.socket) -> typing.Iterator[bytes]:
+        try:
+            yield from iter(lambda: src.recv(16384), b"")
+        except OSError:
+            pass
+
+    def _send(self, dst: socket.socket, chunks: typing.Iterable[typing.Tuple[float, bytes]]):
+        """ each (due time, data) not before it is due, paced to the bandwidth """
+        start = time.monotonic()
+        sent = 0
+        try:
+            for due, data in chunks:
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                dst.sendall(data)
+                sent += len(data)
+                if self._bandwidth:
+                    ahead = sent / self._bandwidth - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except OSError:
+            pass
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def close(self):
+        self._listener.close()
+
+
+_USBMUX_HEADER = struct.Struct("IIII")
+_LOCKDOWN_HEADER = struct.Struct(">I")
+_LOCKDOWN_PORT = 62078
+_CONNECTION_REFUSED = 3
+
+
+def _recvall(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        data = sock.recv(size - len(buf))
+        if not data:
+            raise EOFError("connection closed")
+        buf += data
+    return bytes(buf)
+
+
+def _relay(src: socket.socket, dst: socket.socket):
+    try:
+        for data in iter(lambda: src.recv(65536), b""):
+            dst.sendall(data)
+    except OSError:
+        pass
+    try:
+        dst.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def _lockdown_values(device: dict) -> typing.Dict[typing.Optional[str], dict]:
+    """ values of a device by domain, None the default one, about the size a real iPhone answers """
+    devid = device["DeviceID"]
+    values = {
+        "DeviceName": "iPhone {}".format(devid),
+        "ProductType": "iPhone14,2",
+        "ProductVersion": "16.5",
+        "BuildVersion": "20F66",
+        "WiFiAddress": "02:00:00:00:{:02x}:{:02x}".format(devid >> 8 & 0xff, devid & 0xff),
+        "BluetoothAddress": "02:00:00:01:{:02x}:{:02x}".format(devid >> 8 & 0xff, devid & 0xff),
+        "UniqueDeviceID": device["UDID"],
+        "SerialNumber": "F2LFAKE{:05d}".format(devid),
+        "ActivationState": "Activated",
+        "DeviceClass": "iPhone",
+        "DeviceColor": "1",
+        "HardwareModel": "D63AP",
+        "CPUArchitecture": "arm64e",
+        "ChipID": 33040,
+        "UniqueChipID": 0x1234567800 + devid,
+        "TimeZone": "Asia/Shanghai",
+        "TimeIntervalSince1970": 1700000000.0,
+        "PasswordProtected": False,
+        "SupportedDeviceFamilies": [1],
+        "DeviceCertificate": bytes(range(256)) * 4,
+        "DevicePublicKey": bytes(range(256)) * 2,
+        "ProposalActivationTicket": bytes(range(256)) * 12,
+        "NonVolatileRAM": {"auto-boot": b"true", "backlight-level": b"1495", "boot-args": b""},
+    }
+    # the rest of a real dictionary: capability flags, radio and baseband details
+    values.update(("Capability{:03d}".format(i), i % 3 == 0) for i in range(80))
+    values.update(("Baseband{:02d}".format(i), "fake-baseband-value-{:04d}".format(i)) for i in range(40))
+    return {
+        None: values,
+        "com.apple.mobile.battery": {"BatteryCurrentCapacity": 87, "BatteryIsCharging": False},
+        "com.apple.disk_usage": {"TotalDiskCapacity": 128 * 1000 ** 3, "AmountDataAvailable": 40 * 1000 ** 3},
+    }
+
+
+class FakeUsbmuxd:
+    """
+    usbmuxd on a unix socket: ListDevices, ReadBUID, Listen and Connect
+
+    Args:
+        devices: number of simulated usb devices, UDIDs are fake-udid-0000...
+        ports: device port: local tcp port, a Connect to any other port is refused
+        lockdown_delay: seconds lockdownd takes per GetValue, port 62078 is always served
+        connect_delay: seconds until a Connect is answered, the round trip to the device
+    """
+
+    def __init__(self, path: str, devices: int = 1, ports: typing.Optional[typing.Dict[int, int]] = None,
+                 lockdown_delay: float = 0.0, connect_delay: float = 0.0):
+        self.path = path
+        self.ports = dict(ports or {})
+        self.lockdown_delay = lockdown_delay
+        self.connect_delay = connect_delay
+        self.lockdown_bytes = 0  # sent by lockdownd of every device, headers included
+        self._lock = threading.Lock()
+        self.devices = [{
+            "ConnectionType": "USB",
+            "ConnectionSpeed": 480000000,
+            "DeviceID": i + 1,
+            "LocationID": 0x14100000 + i,
+            "ProductID": 4776,
+            "SerialNumber": "fake-udid-{:04d}".format(i),
+            "UDID": "fake-udid-{:04d}".format(i),
+        } for i in range(devices)]
+        if os.path.exists(path):
+            os.unlink(path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        # a round of concurrent clients for hundreds of devices connects at once
+        self._listener.listen(1024)
+
+    @property
+    def udids(self) -> typing.List[str]:
+        return [d["UDID"] for d in self.devices]
+
+    @property
+    def env(self) -> typing.Dict[str, str]:
+        """ environment which points ioscmd subprocesses at this usbmuxd """
+        return {"USBMUXD_SOCKET_ADDRESS": "UNIX:" + self.path}
+
+    def start(self) -> "FakeUsbmuxd":
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def _serve(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(sock,), daemon=True).start()
+
+    def _handle(self, sock: socket.socket):
+        try:
+            while True:
+                length, _, _, tag = _USBMUX_HEADER.unpack(_recvall(sock, _USBMUX_HEADER.size))
+                request = plistlib.loads(_recvall(sock, length - _USBMUX_HEADER.size))
+                if not self._reply(sock, tag, request):
+                    return
+        except (EOFError, OSError):
+            pass
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _send(sock: socket.socket, tag: int, payload: dict):
+        body = plistlib.dumps(payload)
+        sock.sendall(_USBMUX_HEADER.pack(_USBMUX_HEADER.size + len(body), 1, 8, tag) + body)
+
+    def _reply(self, sock: socket.socket, tag: int, request: dict) -> bool:
+        """ answer one request, False once the connection was handed over or should close """
+        kind = request.get("MessageType")
+        if kind == "ListDevices":
+            self._send(sock, tag, {"DeviceList": [
+                {"DeviceID": d["DeviceID"], "MessageType": "Attached", "Properties": d} for d in self.devices]})
+        elif kind == "ReadBUID":
+            self._send(sock, tag, {"BUID": "00000000-0000-0000-0000-000000000000"})
+        elif kind == "Listen":
+            self._send(sock, tag, {"MessageType": "Result", "Number": 0})
+            for d in self.devices:
+                self._send(sock, 0, {"DeviceID": d["DeviceID"], "MessageType": "Attached", "Properties": d})
+            while sock.recv(1024):
+                pass
+            return False
+        elif kind == "Connect":
+            return self._connect(sock, tag, request["DeviceID"], socket.ntohs(request["PortNumber"]))
+        else:
+            self._send(sock, tag, {"MessageType": "Result", "Number": 1})
+        return True
+
+    def _connect(self, sock: socket.socket, tag: int, devid: int, port: int) -> bool:
+        if self.connect_delay:
+            time.sleep(self.connect_delay)
+        device = next((d for d in self.devices if d["DeviceID"] == devid), None)
+        if device is not None and port == _LOCKDOWN_PORT:
+            self._send(sock, tag, {"MessageType": "Result", "Number": 0})
+            self._lockdown(sock, device)
+            return False
+        if device is None or port not in self.ports:
+            self._send(sock, tag, {"MessageType": "Result", "Number": _CONNECTION_REFUSED})
+            return True
+        try:
+            target = socket.create_connection(("127.0.0.1", self.ports[port]))
+            target.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            self._send(sock, tag, {"MessageType": "Result", "Number": _CONNECTION_REFUSED})
+            return True
+        self._send(sock, tag, {"MessageType": "Result", "Number": 0})
+        threading.Thread(target=_relay, args=(target, sock), daemon=True).start()
+        _relay(sock, target)
+        target.close()
+        return False
+
+    def _lockdown(self, sock: socket.socket, device: dict):
+        domains = _lockdown_values(device)
+        while True:
+            (length,) = _LOCKDOWN_HEADER.unpack(_recvall(sock, _LOCKDOWN_HEADER.size))
+            request = plistlib.loads(_recvall(sock, length))
+            if self.lockdown_delay:
+                time.sleep(self.lockdown_delay)
+            reply = {"Request": request.get("Request")}
+            values = domains.get(request.get("Domain"))
+            if values is None:
+                reply["Error"] = "MissingValue"
+            elif "Key" not in request:
+                reply["Value"] = values
+            elif request["Key"] in values:
+                reply["Value"] = values[request["Key"]]
+            else:
+                reply["Error"] = "MissingValue"
+            for name in ("Domain", "Key"):
+                if name in request:
+                    reply[name] = request[name]
+            body = plistlib.dumps(reply)
+            sock.sendall(_LOCKDOWN_HEADER.pack(len(body)) + body)
+            with self._lock:
+                self.lockdown_bytes += _LOCKDOWN_HEADER.size + len(body)
+
+    def close(self):
+        self._listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,90 @@
+"""
+Installing a bundle of debs: one upload and dpkg + apt-get per deb, against
+install's cached parallel upload and single dpkg run
+
+The local paramiko server runs stand-in dpkg and apt-get scripts which only
+sleep, --dpkg and --apt seconds per call, so the number of round trips and
+resolution passes is what shows up.
+
+    python benchmarks/install.py [--debs 10] [--size 2] [--dpkg 0.2] [--apt 1.5]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import stat
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeSSHServer  # noqa: E402
+from ioscmd.command.install import _install_command, _upload_debs  # noqa: E402
+from ioscmd.ssh_client import SSH, stream_command  # noqa: E402
+
+
+def _stub(directory: str, name: str, seconds: float):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\nsleep {}\n".format(seconds))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def one_by_one(client, debs, cache_dir, sink):
+    """ install before bundles: upload, dpkg and apt-get for every deb """
+    sftp = client.open_sftp()
+    for deb in debs:
+        with open(deb, "rb") as f:
+            sftp.putfo(io.BytesIO(f.read()), "/tmp/_ios_install.deb", confirm=False)
+        stream_command(client, "dpkg -i /tmp/_ios_install.deb", stdout=sink, stderr=sink)
+        stream_command(client, "apt-get -f -y install", stdout=sink, stderr=sink)
+    sftp.close()
+
+
+def bundle(client, debs, cache_dir, sink):
+    remote = _upload_debs(client, 4, cache_dir, debs)
+    stream_command(client, _install_command(remote), stdout=sink, stderr=sink)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--debs", type=int, default=10)
+    parser.add_argument("--size", type=float, default=2, help='MB per deb')
+    parser.add_argument("--dpkg", type=float, default=0.2, help='seconds per dpkg call')
+    parser.add_argument("--apt", type=float, default=1.5, help='seconds per apt-get call')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        bin_dir = os.path.join(directory, "bin")
+        os.mkdir(bin_dir)
+        _stub(bin_dir, "dpkg", args.dpkg)
+        _stub(bin_dir, "apt-get", args.apt)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+        debs = []
+        for i in range(args.debs):
+            debs.append(os.path.join(directory, "tweak{}.deb".format(i)))
+            with open(debs[-1], "wb") as f:
+                f.write(os.urandom(int(args.size * 1024 * 1024)))
+        cache_dir = os.path.join(directory, "cache")
+
+        server = FakeSSHServer().start()
+        results = []
+        with open(os.devnull, "wb") as sink, open(os.devnull, "w") as text, contextlib.redirect_stdout(text):
+            for name, func in (("one_by_one", one_by_one), ("bundle", bundle), ("bundle_cached", bundle)):
+                client = SSH()
+                client.connect("127.0.0.1", port=server.port, username="root", password="alpine")
+                start = time.perf_counter()
+                func(client, debs, cache_dir, sink)
+                results.append({"flow": name, "seconds": round(time.perf_counter() - start, 3)})
+                client.close()
+        server.close()
+    json.dump({"benchmark": "install", "debs": args.debs, "megabytes_per_deb": args.size,
+               "dpkg_seconds": args.dpkg, "apt_seconds": args.apt, "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Device info from lockdownd: the whole value dictionary against the shown keys only
+
+Against a fake usbmuxd whose lockdownd answers a dictionary about the size
+of a real iPhone's. Reports time and bytes from lockdownd per device for
+get_deviceInfo (new connection, every value), get_values of the devices
+fields on a new connection, and again on the open session.
+
+    python benchmarks/lockdown.py [--devices 16] [--rounds 20]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeUsbmuxd  # noqa: E402
+from ioscmd.command.devices import DEFAULT_FIELDS  # noqa: E402
+from ioscmd.lockdown import LockdownSessions  # noqa: E402
+from ioscmd.sockets import Usbmux  # noqa: E402
+
+FIELDS = DEFAULT_FIELDS.split(",")
+
+
+def measure(mux: FakeUsbmuxd, name: str, query, rounds: int) -> dict:
+    devids = [d["DeviceID"] for d in mux.devices]
+    mux.lockdown_bytes = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for devid in devids:
+            query(devid)
+    elapsed = time.perf_counter() - start
+    count = rounds * len(devids)
+    return {"name": name, "us_per_device": round(elapsed / count * 1e6, 1),
+            "bytes_per_device": mux.lockdown_bytes // count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        mux = FakeUsbmuxd(os.path.join(directory, "usbmuxd.sock"), args.devices).start()
+        with Usbmux(mux.path) as usbmux:
+            results = [measure(mux, "full", usbmux.get_deviceInfo, args.rounds)]
+
+            def selective(devid: int):
+                with LockdownSessions(usbmux) as sessions:
+                    sessions.get(devid).get_values(FIELDS)
+
+            results.append(measure(mux, "selective", selective, args.rounds))
+            with LockdownSessions(usbmux) as sessions:
+                results.append(measure(mux, "session", lambda devid: sessions.get(devid).get_values(FIELDS),
+                                       args.rounds))
+        mux.close()
+    json.dump({"benchmark": "lockdown", "devices": args.devices, "fields": FIELDS, "results": results},
+              sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Packet send and receive over a socketpair: recv_into / sendmsg against the old path
+
+The old path grew a bytearray from one bytes object per recv() and joined
+header and body before sendall(). The new one does so only below 16KB, where
+a plain recv and join measured cheaper than recv_into and sendmsg. Packets
+are encoded once up front, so only the socket path is measured. Reports packets/s of a streaming run and the
+peak of transient allocations (tracemalloc) while one packet is received and
+sent, as a multiple of the packet size.
+
+    python benchmarks/packets.py [--packets 2000] [--sizes 512,65536,460000]
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ioscmd.exceptions import SocketError  # noqa: E402
+from ioscmd.sockets import LOCKDOWN_HEADER, PlistSocket, SafeStreamSocket, body_length  # noqa: E402
+
+
+def old_recvall(sock: SafeStreamSocket, size: int) -> bytearray:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise SocketError("recvall: socket connection broken")
+        buf.extend(chunk)
+    return buf
+
+
+def old_send(sock: SafeStreamSocket, header: bytes, body: bytes):
+    sock.sendall(header + body)
+
+
+def new_recvall(sock: SafeStreamSocket, size: int) -> bytearray:
+    return sock.recvall(size)
+
+
+def new_send(sock: PlistSocket, header: bytes, body: bytes):
+    sock.send_encoded(header, body)
+
+
+PATHS = {"old": (old_send, old_recvall), "new": (new_send, new_recvall)}
+
+
+def _recv_packet(sock: SafeStreamSocket, recvall) -> int:
+    header = recvall(sock, LOCKDOWN_HEADER.size)
+    return len(recvall(sock, body_length(header)))
+
+
+def _pair():
+    a, b = socket.socketpair()
+    return PlistSocket(a), PlistSocket(b)
+
+
+def throughput(path: str, size: int, packets: int) -> float:
+    send, recvall = PATHS[path]
+    header, body = LOCKDOWN_HEADER.pack(size), os.urandom(size)
+    sender, receiver = _pair()
+
+    def produce():
+        for _ in range(packets):
+            send(sender, header, body)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(packets):
+        _recv_packet(receiver, recvall)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    sender.close()
+    receiver.close()
+    return packets / elapsed
+
+
+def allocations(path: str, size: int) -> dict:
+    """ transient peak of one receive and one send, the socket buffers hold the packet in between """
+    send, recvall = PATHS[path]
+    header, body = LOCKDOWN_HEADER.pack(size), os.urandom(size)
+    sender, receiver = _pair()
+    for sock in (sender, receiver):
+        # room for the whole packet, so send completes without a reader
+        sock.get_socket().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size * 2 + 4096)
+        sock.get_socket().setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size * 2 + 4096)
+    result = {}
+    tracemalloc.start()
+    try:
+        for name, func in (("send", lambda: send(sender, header, body)),
+                           ("recv", lambda: _recv_packet(receiver, recvall))):
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            result[name + "_peak_x"] = round((peak - base) / size, 2)
+    finally:
+        tracemalloc.stop()
+    sender.close()
+    receiver.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packets", type=int, default=2000)
+    parser.add_argument("--sizes", default="512,65536,460000", help='comma separated body sizes in bytes')
+    args = parser.parse_args()
+    results = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        # fewer of the large ones, about the same bytes per run
+        packets = max(50, min(args.packets, args.packets * 65536 // size))
+        for path in PATHS:
+            result = {"path": path, "size": size, "packets": packets,
+                      "packets_per_s": round(throughput(path, size, packets))}
+            result.update(allocations(path, size))
+            results.append(result)
+    json.dump({"benchmark": "packets", "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
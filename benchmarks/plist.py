@@ -0,0 +1,85 @@
+"""
+Encode and decode cost and wire size of XML against binary plist packets
+
+Payloads as usbmuxd and lockdownd exchange them: a Connect request, the
+device list of --devices devices, a full lockdown value dictionary and a
+dictionary carrying --data-kb of binary data. encode_packet is what
+PlistSocket sends with Usbmux(binary=...), decoding is plistlib.loads as in
+recv_packet, which detects the format by itself.
+
+    python benchmarks/plist.py [--devices 16] [--data-kb 450] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import plistlib
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import _lockdown_values  # noqa: E402
+from ioscmd.sockets import _connect_request, encode_packet  # noqa: E402
+
+FORMATS = {"xml": plistlib.FMT_XML, "binary": plistlib.FMT_BINARY}
+
+
+def payloads(devices: int, data_kb: int) -> dict:
+    properties = [{
+        "ConnectionType": "USB",
+        "ConnectionSpeed": 480000000,
+        "DeviceID": i + 1,
+        "LocationID": 0x14100000 + i,
+        "ProductID": 4776,
+        "SerialNumber": "fake-udid-{:04d}".format(i),
+        "UDID": "fake-udid-{:04d}".format(i),
+    } for i in range(devices)]
+    return {
+        "connect": _connect_request(1, 22),
+        "device_list": {"DeviceList": [{"DeviceID": p["DeviceID"], "MessageType": "Attached", "Properties": p}
+                                       for p in properties]},
+        "lockdown_values": {"Request": "GetValue", "Value": _lockdown_values(properties[0])[None]},
+        "data": {"Request": "Data", "Value": os.urandom(data_kb * 1024)},
+    }
+
+
+def _median_us(func, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return round(statistics.median(times) * 1e6, 1)
+
+
+def measure(payload: dict, fmt: plistlib.PlistFormat, repeat: int) -> dict:
+    header, body = encode_packet(payload, fmt, True)
+    return {
+        "wire_bytes": len(header) + len(body),
+        "encode_us": _median_us(lambda: encode_packet(payload, fmt, True), repeat),
+        "decode_us": _median_us(lambda: plistlib.loads(body), repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=16)
+    parser.add_argument("--data-kb", type=int, default=450)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    results = []
+    for name, payload in payloads(args.devices, args.data_kb).items():
+        for fmt_name, fmt in FORMATS.items():
+            result = {"payload": name, "format": fmt_name}
+            result.update(measure(payload, fmt, args.repeat))
+            results.append(result)
+    json.dump({"benchmark": "plist", "devices": args.devices, "data_kb": args.data_kb, "results": results},
+              sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Throughput of every ssh profile over a usb-like and a wifi-like link
+
+The usb link is plain loopback to a local paramiko server, the wifi link
+goes through a proxy limited to --bandwidth MB/s. Each cell downloads
+--megabytes of compressible text and of random bytes with `cat`.
+
+    python benchmarks/profiles.py [--megabytes 32] [--bandwidth 8]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeSSHServer, ThrottledProxy  # noqa: E402
+from ioscmd.profiles import PROFILES  # noqa: E402
+from ioscmd.ssh_client import SSH, stream_command  # noqa: E402
+
+
+class _Count(io.RawIOBase):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def _payloads(directory: str, size: int) -> dict:
+    line = b"Oct 17 12:00:00 iPhone kernel[0] <Notice>: AppleBCMWLANCore: link quality changed\n"
+    text = os.path.join(directory, "text")
+    with open(text, "wb") as f:
+        f.write((line * (size // len(line) + 1))[:size])
+    random = os.path.join(directory, "random")
+    with open(random, "wb") as f:
+        f.write(os.urandom(size))
+    return {"text": text, "random": random}
+
+
+def measure(port: int, profile: str, path: str, size: int) -> dict:
+    start = time.perf_counter()
+    client = SSH(profile=profile)
+    client.connect("127.0.0.1", port=port, username="root", password="alpine")
+    handshake = time.perf_counter() - start
+    transport = client.get_transport()
+    sink = _Count()
+    start = time.perf_counter()
+    stream_command(client, "cat " + path, stdout=sink, stderr=_Count())
+    elapsed = time.perf_counter() - start
+    client.close()
+    assert sink.size == size, (sink.size, size)
+    return {
+        "handshake_ms": round(handshake * 1000, 1),
+        "mb_per_s": round(size / 1024 / 1024 / elapsed, 2),
+        "cipher": transport.remote_cipher,
+        "mac": transport.remote_mac,
+        "compression": transport.remote_compression,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megabytes", type=int, default=32)
+    parser.add_argument("--bandwidth", type=float, default=8, help='MB/s of the wifi-like link')
+    args = parser.parse_args()
+    size = args.megabytes * 1024 * 1024
+    server = FakeSSHServer().start()
+    proxy = ThrottledProxy(server.port, args.bandwidth * 1024 * 1024).start()
+    links = {"usb": server.port, "wifi": proxy.port}
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        payloads = _payloads(directory, size)
+        for link, port in links.items():
+            for profile in PROFILES:
+                for payload, path in payloads.items():
+                    result = {"link": link, "profile": profile, "payload": payload}
+                    result.update(measure(port, profile, path, size))
+                    results.append(result)
+    proxy.close()
+    server.close()
+    json.dump({"benchmark": "profiles", "megabytes": args.megabytes, "wifi_bandwidth": args.bandwidth,
+               "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
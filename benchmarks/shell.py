@@ -0,0 +1,135 @@
+"""
+Interactive shell loop: keystroke round trip and bulk output throughput
+
+interactive_shell runs in a child process on a pseudo terminal, its channel
+is a socketpair served by an in-process fake shell which echoes keystrokes
+and streams output on request, so only the local loop is measured.
+
+    python benchmarks/shell.py [--keys 500] [--megabytes 64]
+"""
+import argparse
+import json
+import os
+import pty
+import select
+import socket
+import statistics
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ioscmd.ssh_client import interactive_shell  # noqa: E402
+
+BULK = b"\x02"  # ask the fake shell for bulk output
+QUIT = b"\x04"
+
+
+class _Channel:
+    """ the part of paramiko.Channel used by interactive_shell, over a socket """
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def resize_pty(self, width=80, height=24, width_pixels=0, height_pixels=0):
+        pass
+
+    def send(self, data):
+        try:
+            return self._sock.send(data)
+        except BlockingIOError:
+            raise socket.timeout()
+
+    def recv(self, nbytes):
+        try:
+            return self._sock.recv(nbytes)
+        except BlockingIOError:
+            raise socket.timeout()
+
+
+def _fake_shell(sock: socket.socket, bulk_size: int):
+    chunk = b"x" * 65536
+    while True:
+        data = sock.recv(65536)
+        if not data or QUIT in data:
+            sock.close()
+            return
+        if BULK in data:
+            left = bulk_size
+            while left:
+                left -= sock.send(chunk[:min(left, len(chunk))])
+        else:
+            sock.sendall(data)
+
+
+def _child(bulk_size: int):
+    local, remote = socket.socketpair()
+    threading.Thread(target=_fake_shell, args=(remote, bulk_size), daemon=True).start()
+    interactive_shell(_Channel(local))
+
+
+def _read_exactly(fd: int, size: int, timeout: float = 30.0) -> int:
+    got = 0
+    deadline = time.monotonic() + timeout
+    while got < size:
+        if not select.select([fd], [], [], max(0.0, deadline - time.monotonic()))[0]:
+            raise TimeoutError("got {} of {} bytes".format(got, size))
+        got += len(os.read(fd, 1024 * 1024))
+    return got
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=500, help='keystrokes to time')
+    parser.add_argument("--megabytes", type=int, default=64, help='bulk output size')
+    args = parser.parse_args()
+    bulk_size = args.megabytes * 1024 * 1024
+
+    pid, master = pty.fork()
+    if pid == 0:
+        try:
+            _child(bulk_size)
+        finally:
+            os._exit(0)
+
+    time.sleep(0.2)
+    latencies = []
+    for i in range(args.keys):
+        start = time.perf_counter()
+        os.write(master, b"a")
+        _read_exactly(master, 1)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    os.write(master, BULK)
+    _read_exactly(master, bulk_size, timeout=120)
+    elapsed = time.perf_counter() - start
+
+    os.write(master, QUIT)
+    os.waitpid(pid, 0)
+    os.close(master)
+    latencies.sort()
+    json.dump({
+        "benchmark": "shell",
+        "keys": args.keys,
+        "keystroke_rtt_us": {
+            "median": round(statistics.median(latencies) * 1e6, 1),
+            "p99": round(latencies[int(len(latencies) * 0.99) - 1] * 1e6, 1),
+        },
+        "bulk_megabytes": args.megabytes,
+        "bulk_seconds": round(elapsed, 3),
+        "bulk_mb_per_s": round(args.megabytes / elapsed, 1),
+    }, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
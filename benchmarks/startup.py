@@ -0,0 +1,77 @@
+"""
+Startup cost of every subcommand
+
+Runs `python -X importtime -m ioscmd COMMAND --help` and reports the import
+time and wall time of each, as json on stdout.
+
+    python benchmarks/startup.py [--repeat 5] [COMMAND ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ioscmd.command.cli import CLI_COMMANDS  # noqa: E402
+
+
+def import_stats(stderr: str):
+    """ Return (total import microseconds, {top level package: cumulative microseconds}, {every module}) """
+    total = 0
+    packages = {}
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.add(name.strip())
+        if not name[1:].startswith(" "):  # top level only, nested imports are in its cumulative
+            cumulative = int(cumulative)
+            total += cumulative
+            package = name.strip().split(".")[0]
+            packages[package] = packages.get(package, 0) + cumulative
+    return total, packages, modules
+
+
+def measure(command, repeat):
+    args = [sys.executable, "-X", "importtime", "-m", "ioscmd"] + ([command] if command else []) + ["--help"]
+    walls, imports = [], []
+    packages, modules = {}, set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        walls.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError("{} failed: {}".format(" ".join(args), proc.stderr[-500:]))
+        total, packages, modules = import_stats(proc.stderr)
+        imports.append(total)
+    return {
+        "command": command or "--help",
+        "wall_ms": round(statistics.median(walls) * 1000, 2),
+        "import_ms": round(statistics.median(imports) / 1000, 2),
+        "paramiko": "paramiko" in modules,
+        "top_imports_ms": {k: round(v / 1000, 2) for k, v in
+                           sorted(packages.items(), key=lambda kv: -kv[1])[:5]},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("commands", nargs="*")
+    args = parser.parse_args()
+    commands = args.commands or [None] + [name for name, (_, short_help) in CLI_COMMANDS.items() if short_help]
+    results = [measure(command, args.repeat) for command in commands]
+    json.dump({"benchmark": "startup", "python": sys.version.split()[0], "results": results},
+              sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+End to end benchmarks of the ioscmd commands against a simulated device
+
+A FakeUsbmuxd serves simulated phones whose port 22 relays to a local
+FakeSSHServer, the commands run as subprocesses pointed at it through
+USBMUXD_SOCKET_ADDRESS with a throw-away cache directory. Nothing leaves
+this machine. The small files and script benchmarks run over a link that
+delays each way by --latency-ms, the round trips --jobs overlaps would cost
+nothing on loopback.
+
+Results are one json object, written to --output or stdout. --compare
+reads an earlier result and lists every metric which moved by more than
+--threshold percent, the exit status is 1 when one of them got worse.
+
+    python benchmarks/suite.py [--quick] [--output new.json] [--compare old.json]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCHMARKS)
+
+from fakes import FakeSSHServer, FakeUsbmuxd, ThrottledProxy  # noqa: E402
+from ioscmd.sockets import Usbmux  # noqa: E402
+from ioscmd.ssh_client import SSH, stream_command  # noqa: E402
+
+SIZES = {
+    "full": {"devices": (1, 16, 64), "repeat": 7, "large_mb": 256, "small_files": 1000, "keys": 500,
+             "script": 200},
+    "quick": {"devices": (1, 16), "repeat": 3, "large_mb": 32, "small_files": 200, "keys": 100,
+              "script": 40},
+}
+
+
+class _Sink(io.RawIOBase):
+    def write(self, data):
+        return len(data)
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def _median_ms(func, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return _ms(statistics.median(times))
+
+
+class _BaselineSSH(SSH):
+    """ the tunnel as opened before wait_device_port: a fixed two second sleep, then one Connect """
+
+    def _open_tunnel(self, _usbmux: Usbmux, host, port):
+        self._info = next(d for d in _usbmux.device_list() if d["UDID"] == host)
+        time.sleep(2)
+        conn = _usbmux.connect_device_port(self._info['DeviceID'], int(port))
+        self._socket = conn
+        return conn.get_socket()
+
+
+class Bench:
+    def __init__(self, directory: str, sizes: dict, latency: float = 0.0):
+        self.directory = directory
+        self.sizes = sizes
+        self.latency = latency
+        self.server = FakeSSHServer().start()
+        self.env = dict(os.environ, XDG_CACHE_HOME=os.path.join(directory, "cache"))
+        self._muxes = {}
+        self._proxy = None
+
+    def mux(self, devices: int) -> FakeUsbmuxd:
+        """ also the usbmuxd of SSH in this process, which finds devices through Usbmux() """
+        if devices not in self._muxes:
+            path = os.path.join(self.directory, "usbmuxd-{}.sock".format(devices))
+            self._muxes[devices] = FakeUsbmuxd(path, devices, ports={22: self.server.port}).start()
+        os.environ.update(self._muxes[devices].env)
+        return self._muxes[devices]
+
+    def link(self) -> FakeUsbmuxd:
+        """ one device whose ssh port is behind self.latency seconds each way """
+        if self._proxy is None:
+            self._proxy = ThrottledProxy(self.server.port, latency=self.latency).start()
+            path = os.path.join(self.directory, "usbmuxd-link.sock")
+            self._muxes["link"] = FakeUsbmuxd(path, 1, ports={22: self._proxy.port}).start()
+        os.environ.update(self._muxes["link"].env)
+        return self._muxes["link"]
+
+    def ioscmd(self, mux: FakeUsbmuxd, *args: str):
+        subprocess.run([sys.executable, "-m", "ioscmd"] + list(args), cwd=ROOT, env=dict(self.env, **mux.env),
+                       stdout=subprocess.DEVNULL, check=True)
+
+    def close(self):
+        for mux in self._muxes.values():
+            mux.close()
+        if self._proxy is not None:
+            self._proxy.close()
+        self.server.close()
+
+    def devices(self) -> dict:
+        result = {}
+        for n in self.sizes["devices"]:
+            mux = self.mux(n)
+            usbmux = Usbmux(mux.path)
+            result["list_{}_ms".format(n)] = _median_ms(usbmux.device_list, self.sizes["repeat"] * 3)
+            # --no-cache, every call asks lockdown of each device
+            result["cli_{}_ms".format(n)] = _median_ms(lambda: self.ioscmd(mux, "devices", "--no-cache"),
+                                                       self.sizes["repeat"])
+        return result
+
+    def connect(self) -> dict:
+        """ cold connects, and the same through the tunnel setup before wait_device_port for comparison """
+        mux = self.mux(1)
+        usbmux = Usbmux(mux.path)
+        udid = mux.udids[0]
+
+        def tunnel():
+            usbmux.connect_device_port(1, 22).close()
+
+        def ssh(cls=SSH):
+            with cls() as client:
+                client.connect(udid, port=22, username="root", password="alpine")
+
+        return {"usbmux_connect_ms": _median_ms(tunnel, self.sizes["repeat"] * 3),
+                "ssh_connect_ms": _median_ms(ssh, self.sizes["repeat"]),
+                # two seconds a run, a few are enough
+                "ssh_connect_baseline_ms": _median_ms(lambda: ssh(_BaselineSSH), 3)}
+
+    def shell(self) -> dict:
+        mux = self.mux(1)
+        udid = mux.udids[0]
+        with SSH() as client:
+            client.connect(udid, port=22, username="root", password="alpine")
+            exec_rtt = _median_ms(lambda: stream_command(client, "true", stdout=_Sink(), stderr=_Sink()),
+                                  self.sizes["repeat"] * 3)
+        return {"exec_rtt_ms": exec_rtt,
+                "cli_ms": _median_ms(lambda: self.ioscmd(mux, "-u", udid, "shell", "true"), self.sizes["repeat"])}
+
+    def _transfer(self, name: str, local: str, size: int, push_args: typing.Optional[list] = None,
+                  pull_args: typing.Optional[list] = None, variant: str = "",
+                  mux: typing.Optional[FakeUsbmuxd] = None) -> dict:
+        """
+        push local with push_args, then pull it back with pull_args, None leaves a direction out
+
+        A variant without push pulls what the plain run of name pushed. The
+        device is the one of self.mux(1) unless mux is given.
+        """
+        mux = mux or self.mux(1)
+        udid = mux.udids[0]
+        remote = os.path.join(self.directory, name + (variant if push_args is not None else "") + ".remote")
+        back = os.path.join(self.directory, name + variant + ".back")
+        mb = size / 1024 / 1024
+        result = {}
+        for direction, args, source, target in (("push", push_args, local, remote), ("pull", pull_args, remote, back)):
+            if args is None:
+                continue
+            if direction == "push":
+                shutil.rmtree(remote, ignore_errors=True)
+            start = time.perf_counter()
+            self.ioscmd(mux, "-u", udid, direction, *args, source, target)
+            elapsed = time.perf_counter() - start
+            key = direction + variant
+            result.update({key + "_ms": _ms(elapsed), key + "_mb_per_s": round(mb / elapsed, 2)})
+        return result
+
+    def large_file(self) -> dict:
+        size = self.sizes["large_mb"] * 1024 * 1024
+        path = os.path.join(self.directory, "large")
+        with open(path, "wb") as f:
+            for _ in range(self.sizes["large_mb"]):
+                f.write(os.urandom(1024 * 1024))
+        result = self._transfer("large", path, size, [], [])
+        # read-ahead depth of the pull, 128 is the default
+        for requests in (16, 512):
+            result.update(self._transfer("large", path, size, None, ["--max-requests", str(requests)],
+                                         "_r{}".format(requests)))
+        return result
+
+    def small_files(self) -> dict:
+        """
+        serial sftp, the files spread over --jobs sftp channels both ways, and one tar stream
+
+        Over self.link(), a file costs a few round trips on each channel.
+        """
+        path = os.path.join(self.directory, "small")
+        count = self.sizes["small_files"]
+        for i in range(count):
+            sub = os.path.join(path, "d{:02d}".format(i % 20))
+            os.makedirs(sub, exist_ok=True)
+            with open(os.path.join(sub, "f{:05d}".format(i)), "wb") as f:
+                f.write(os.urandom(4096))
+        link = self.link()
+        result = self._transfer("small", path, count * 4096, [], [], mux=link)
+        result.update(self._transfer("small", path, count * 4096, ["--jobs", "4"], ["--jobs", "4"], "_j4", link))
+        result.update(self._transfer("small", path, count * 4096, ["--tar"], ["--tar"], "_tar", link))
+        result.update(self._transfer("small", path, count * 4096, ["--tar", "-z"], ["--tar", "-z"], "_tar_z", link))
+        result["files"] = count
+        result["link_rtt_ms"] = _ms(self.latency * 2)
+        return result
+
+    def script(self) -> dict:
+        """ the same commands as one `shell` call each, and as one `run` script with 1 and 8 jobs, over self.link() """
+        mux = self.link()
+        udid = mux.udids[0]
+        commands = ["echo line {}".format(i) for i in range(self.sizes["script"])]
+        path = os.path.join(self.directory, "script.sh")
+        with open(path, "w") as f:
+            f.write("\n".join(commands) + "\n")
+        start = time.perf_counter()
+        for command in commands:
+            self.ioscmd(mux, "-u", udid, "shell", command)
+        loop = time.perf_counter() - start
+        result = {"commands": len(commands), "shell_loop_ms": _ms(loop), "link_rtt_ms": _ms(self.latency * 2)}
+        for jobs in (1, 8):
+            start = time.perf_counter()
+            self.ioscmd(mux, "-u", udid, "run", "-j", str(jobs), path)
+            result["run_j{}_ms".format(jobs)] = _ms(time.perf_counter() - start)
+        return result
+
+    def interactive(self) -> dict:
+        out = subprocess.run([sys.executable, os.path.join(BENCHMARKS, "shell.py"), "--keys", str(self.sizes["keys"]),
+                              "--megabytes", "16"], stdout=subprocess.PIPE, check=True).stdout
+        result = json.loads(out)
+        return {"keystroke_rtt_median_us": result["keystroke_rtt_us"]["median"],
+                "keystroke_rtt_p99_us": result["keystroke_rtt_us"]["p99"],
+                "bulk_mb_per_s": result["bulk_mb_per_s"]}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _metrics(report: dict) -> dict:
+    return {"{}.{}".format(name, key): value for name, values in report["results"].items()
+            for key, value in values.items() if key.endswith(("_ms", "_us", "_mb_per_s"))}
+
+
+def compare(old: dict, new: dict, threshold: float) -> bool:
+    """ print metrics which moved more than threshold percent, True when none got worse """
+    ok = True
+    before, after = _metrics(old), _metrics(new)
+    for name in sorted(set(before) & set(after)):
+        if not before[name]:
+            continue
+        change = (after[name] - before[name]) / before[name] * 100
+        if abs(change) < threshold:
+            continue
+        # times should go down, throughput up
+        worse = change < 0 if name.endswith("_mb_per_s") else change > 0
+        ok = ok and not worse
+        sys.stderr.write("{:<8} {:<40} {:>12} -> {:<12} {:+.1f}%\n".format(
+            "WORSE" if worse else "better", name, before[name], after[name], change))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help='fewer devices, repeats and bytes')
+    parser.add_argument("--only", action="append", help='run only this benchmark, can be repeated')
+    parser.add_argument("--output", help='write the json here instead of stdout')
+    parser.add_argument("--compare", help='json of an earlier run to compare with')
+    parser.add_argument("--threshold", type=float, default=10, help='percent change reported by --compare')
+    parser.add_argument("--latency-ms", type=float, default=5,
+                        help='one way delay of the link of small_files and script, in ms')
+    args = parser.parse_args()
+    sizes = SIZES["quick" if args.quick else "full"]
+    names = ["devices", "connect", "shell", "large_file", "small_files", "script", "interactive"]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        bench = Bench(directory, sizes, args.latency_ms / 1000)
+        try:
+            for name in args.only or names:
+                sys.stderr.write("{} ...\n".format(name))
+                results[name] = getattr(bench, name)()
+        finally:
+            bench.close()
+    report = {
+        "benchmark": "suite",
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sizes": dict(sizes, devices=list(sizes["devices"])),
+        "latency_ms": args.latency_ms,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(json.load(f), report, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Polling loop of Usbmux.device_list against a fake usbmuxd
+
+Compares a connection per request (pool_size=0) with reused control
+connections, reporting the latency per call and the open file descriptors
+of the process while the loop runs.
+
+    python benchmarks/usbmux.py [--calls 10000] [--devices 1]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeUsbmuxd  # noqa: E402
+from ioscmd.sockets import Usbmux  # noqa: E402
+
+
+def _open_fds() -> int:
+    return len(os.listdir("/proc/self/fd" if os.path.isdir("/proc/self/fd") else "/dev/fd"))
+
+
+def poll(path: str, pool_size: int, calls: int) -> dict:
+    fds = []
+    with Usbmux(path, pool_size=pool_size) as usbmux:
+        usbmux.device_list()
+        before = _open_fds()
+        start = time.perf_counter()
+        for i in range(calls):
+            usbmux.device_list()
+            if i % 100 == 0:
+                fds.append(_open_fds())
+        elapsed = time.perf_counter() - start
+        after = _open_fds()
+    return {
+        "pool_size": pool_size,
+        "calls": calls,
+        "us_per_call": round(elapsed / calls * 1e6, 1),
+        "fds_before": before,
+        "fds_max": max(fds),
+        "fds_after": after,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=10000)
+    parser.add_argument("--devices", type=int, default=1)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        mux = FakeUsbmuxd(os.path.join(directory, "usbmuxd.sock"), args.devices).start()
+        results = [poll(mux.path, pool_size, args.calls) for pool_size in (0, 2)]
+        mux.close()
+    json.dump({"benchmark": "usbmux", "devices": args.devices, "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Listing a remote tree: one streamed find against sftp listdir per directory
+
+Builds --dirs directories of --files empty files each and lists them
+through a local paramiko server, directly and over a wifi-like link.
+
+    python benchmarks/walk.py [--dirs 500] [--files 100] [--bandwidth 8]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeSSHServer, ThrottledProxy  # noqa: E402
+from ioscmd.ssh_client import SSH  # noqa: E402
+from ioscmd.walk import _sftp_walk, walk  # noqa: E402
+
+
+def _tree(root: str, dirs: int, files: int) -> int:
+    for i in range(dirs):
+        directory = os.path.join(root, "d{:03d}".format(i // 50), "d{:04d}".format(i))
+        os.makedirs(directory)
+        for j in range(files):
+            open(os.path.join(directory, "f{:04d}".format(j)), "wb").close()
+    return sum(len(d) + len(f) for _, d, f in os.walk(root))
+
+
+def measure(port: int, root: str) -> dict:
+    client = SSH()
+    client.connect("127.0.0.1", port=port, username="root", password="alpine")
+    result = {}
+    for name, func in (("sftp", lambda: _sftp_walk(client, root, None)), ("find", lambda: walk(client, root)),
+                       ("cached", lambda: walk(client, root))):
+        start = time.perf_counter()
+        count = sum(1 for _ in func())
+        result[name + "_s"] = round(time.perf_counter() - start, 3)
+        result["entries"] = count
+    client.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dirs", type=int, default=500)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--bandwidth", type=float, default=8, help='MB/s of the wifi-like link')
+    args = parser.parse_args()
+    server = FakeSSHServer().start()
+    proxy = ThrottledProxy(server.port, args.bandwidth * 1024 * 1024).start()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        entries = _tree(directory, args.dirs, args.files)
+        for link, port in (("usb", server.port), ("wifi", proxy.port)):
+            result = {"link": link}
+            result.update(measure(port, directory))
+            assert result["entries"] == entries, (result, entries)
+            results.append(result)
+    proxy.close()
+    server.close()
+    json.dump({"benchmark": "walk", "entries": entries, "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+asyncio version of Usbmux, for controllers which drive many devices from one event loop
+"""
+import asyncio
+import logging
+import os
+import plistlib
+import typing
+from typing import Union
+
+from .exceptions import MuxReplyError, SocketError, UsbmuxReplyCode
+from .sockets import LOCKDOWN_HEADER, LOCKDOWN_PORT, USBMUX_HEADER, _check, _connect_request, _env_address, \
+    _get_value_request, _list_devices_request, _listen_request, _parse_device_list, _read_buid_request, \
+    body_length, encode_packet
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPlistStream:
+    """ PlistSocket framing on top of asyncio streams """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 tag: int = 0, binary: bool = False):
+        self.reader = reader
+        self.writer = writer
+        self._tag = tag
+        self._first = True
+        self._fmt = plistlib.FMT_BINARY if binary else plistlib.FMT_XML
+
+    async def send_packet(self, payload: dict, message_type: int = 8):
+        header, body_data = encode_packet(payload, self._fmt, self._first, self._tag, message_type)
+        try:
+            self.writer.writelines((header, body_data))
+            await self.writer.drain()
+        except OSError as e:
+            raise SocketError("sendall error") from e
+
+    async def recv_packet(self, header_size=None) -> dict:
+        try:
+            if self._first or header_size == 16:
+                header = await self.reader.readexactly(USBMUX_HEADER.size)
+                self._first = False
+            else:
+                header = await self.reader.readexactly(LOCKDOWN_HEADER.size)
+            body_data = await self.reader.readexactly(body_length(header))
+        except asyncio.IncompleteReadError as e:
+            raise SocketError("recvall: socket connection broken") from e
+        return plistlib.loads(body_data)
+
+    async def send_recv_packet(self, payload: dict, timeout: float = 10.0) -> dict:
+        await self.send_packet(payload)
+        try:
+            return await asyncio.wait_for(self.recv_packet(), timeout)
+        except asyncio.TimeoutError as e:
+            # what Usbmux raises for socket.timeout, callers handle both clients alike
+            raise SocketError("socket timeout") from e
+
+    async def close(self):
+        """ a coroutine, unlike PlistSocketProxy.close, returns once the transport is gone """
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass  # reset by the peer, closed all the same
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class AsyncUsbmux:
+    def __init__(self, address: typing.Optional[Union[str, tuple]] = None, binary: bool = False):
+        """
+        Args:
+            address: defaults to $USBMUXD_SOCKET_ADDRESS, then the usbmuxd of the platform
+            binary: send binary plist to usbmuxd and lockdownd instead of XML
+        """
+        if address is None:
+            address = _env_address()
+        if address is None:
+            if os.name == "posix":  # linux or darwin
+                address = "/var/run/usbmuxd"
+            elif os.name == "nt":  # windows
+                address = ('127.0.0.1', 27015)
+            else:
+                raise EnvironmentError("Unsupported os.name", os.name)
+        if isinstance(address, str) and ':' in address:
+            host, port = address.split(":", 1)
+            address = (host, int(port))
+        self.__address = address
+        self.__tag = 0
+        self.__binary = binary
+
+    def _next_tag(self) -> int:
+        self.__tag += 1
+        return self.__tag
+
+    async def create_connection(self) -> AsyncPlistStream:
+        try:
+            if isinstance(self.__address, str):
+                reader, writer = await asyncio.open_unix_connection(self.__address)
+            else:
+                reader, writer = await asyncio.open_connection(*self.__address)
+        except OSError as e:
+            raise SocketError("socket connect error") from e
+        return AsyncPlistStream(reader, writer, self._next_tag(), self.__binary)
+
+    async def send_recv(self, payload: dict, timeout: float = 10.0) -> dict:
+        async with await self.create_connection() as s:
+            data = await s.send_recv_packet(payload, timeout)
+        _check(data)
+        return data
+
+    async def device_list(self) -> typing.List[dict]:
+        data = await self.send_recv(_list_devices_request())
+        return _parse_device_list(data)
+
+    async def device_udid_list(self) -> typing.List[str]:
+        return [d['UDID'] for d in await self.device_list()]
+
+    async def read_system_BUID(self) -> str:
+        data = await self.send_recv(_read_buid_request())
+        return data['BUID']
+
+    async def watch_device(self) -> typing.AsyncIterator[dict]:
+        """ async iterator of Attached / Detached messages, same as Usbmux.watch_device """
+        async with await self.create_connection() as s:
+            await s.send_packet(_listen_request())
+            _check(await s.recv_packet())
+            while True:
+                yield await s.recv_packet(header_size=16)
+
+    async def _connect(self, devid: int, port: int, timeout: float) -> AsyncPlistStream:
+        conn = await self.create_connection()
+        try:
+            data = await conn.send_recv_packet(_connect_request(devid, port), timeout)
+            _check(data)
+        except BaseException:
+            await conn.close()
+            raise
+        return conn
+
+    async def connect_device_port(self, devid: int, port: int, timeout: float = 10.0) \
+            -> typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """ Create connection to port of the device, return raw streams of the tunnel """
+        conn = await self._connect(devid, port, timeout)
+        return conn.reader, conn.writer
+
+    async def wait_device_port(self, devid: int, port: int, timeout: float = 10.0, interval: float = 0.05,
+                               max_interval: float = 1.0, attempt_timeout: float = 10.0) \
+            -> typing.Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """ Same as Usbmux.wait_device_port """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                remaining = max(deadline - loop.time(), 0.001)
+                return await self.connect_device_port(devid, port, min(remaining, attempt_timeout))
+            except MuxReplyError as e:
+                now = loop.time()
+                if e.reply_code != UsbmuxReplyCode.ConnectionRefused or now >= deadline:
+                    raise
+                await asyncio.sleep(min(interval, deadline - now))
+                interval = min(interval * 2, max_interval)
+
+    async def get_deviceInfo(self, devid: int, timeout: float = 10.0) -> dict:
+        async with await self._connect(devid, LOCKDOWN_PORT, timeout) as s:
+            ret = await s.send_recv_packet(_get_value_request(), timeout)
+            return ret['Value']
@@ -0,0 +1,172 @@
+"""
+Run a script of commands over one ssh session
+
+Every line of the script is one command, a line ending in a backslash
+continues on the next one, empty lines and # comments are skipped. The
+commands of a block run at the same time on separate exec channels, up
+to jobs of them. A line holding only `wait` ends the block, the next
+one starts when all of it has finished.
+
+Output is written from the calling thread only, so it follows the
+stdout / stderr routing of fanout for multi-device runs.
+"""
+import io
+import queue
+import sys
+import threading
+import time
+import typing
+
+from .fanout import Sink
+from .ssh_client import stream_command
+
+BARRIER = "wait"
+# like ssh, when a command could not be started at all
+NO_STATUS = 255
+
+
+class Command(typing.NamedTuple):
+    line: int  # line number in the script, used as tag of its output
+    text: str
+
+
+def parse_script(lines: typing.Iterable[str]) -> typing.List[typing.List[Command]]:
+    """ blocks of commands, split at `wait` lines """
+    blocks = [[]]
+    pending, start = "", 0
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if not pending:
+            start = number
+        if line.endswith("\\"):
+            pending += line[:-1]
+            continue
+        text, pending = (pending + line).strip(), ""
+        if not text or text.startswith("#"):
+            continue
+        if text == BARRIER:
+            if blocks[-1]:
+                blocks.append([])
+            continue
+        blocks[-1].append(Command(start, text))
+    if pending.strip():
+        blocks[-1].append(Command(start, pending.strip()))
+    return [block for block in blocks if block]
+
+
+class _Pipe(io.RawIOBase):
+    """ stdout or stderr of one command, handed to the calling thread as events """
+
+    def __init__(self, events: queue.Queue, index: int, stream: int):
+        self._events = events
+        self._index = index
+        self._stream = stream
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if data:
+            self._events.put((self._index, self._stream, bytes(data)))
+        return len(data)
+
+
+_EXIT = 0  # event stream of a finished command, data is its result
+
+
+class _Output:
+    """ ordered: one command at a time, the others wait in memory. tagged: every line as it comes """
+
+    def __init__(self, commands: typing.List[Command], ordered: bool):
+        self._commands = commands
+        self._ordered = ordered
+        self._lock = threading.Lock()
+        self._buffered = {}  # index: [(stream, data)]
+        self._finished = set()
+        self._head = 0
+        self._sinks = {}
+
+    @staticmethod
+    def _stream(stream: int):
+        return sys.stdout.buffer if stream == 1 else sys.stderr.buffer
+
+    def write(self, index: int, stream: int, data: bytes):
+        if not self._ordered:
+            key = (index, stream)
+            if key not in self._sinks:
+                prefix = "{}: ".format(self._commands[index].line).encode()
+                self._sinks[key] = Sink(prefix, self._stream(stream), self._lock, False)
+            self._sinks[key].write(data)
+        elif index == self._head:
+            self._stream(stream).write(data)
+            self._stream(stream).flush()
+        else:
+            self._buffered.setdefault(index, []).append((stream, data))
+
+    def finish(self, index: int):
+        if not self._ordered:
+            for stream in (1, 2):
+                sink = self._sinks.pop((index, stream), None)
+                if sink is not None:
+                    sink.close()
+            return
+        self._finished.add(index)
+        while self._head in self._finished:
+            self._head += 1
+            for stream, data in self._buffered.pop(self._head, ()):
+                self._stream(stream).write(data)
+                self._stream(stream).flush()
+
+
+def run_script(client, blocks: typing.List[typing.List[Command]], jobs: int = 1, ordered: bool = True,
+               stop_on_failure: bool = False) -> typing.List[dict]:
+    """
+    Run the blocks of parse_script on client, return one result per command
+
+    With stop_on_failure no command starts after one failed, those report
+    Status 'skipped'. Commands already running finish.
+
+    Returns:
+        [{'Line': line number, 'Status': exit status or 'skipped', 'Duration': ..., 'Command': text}]
+    """
+    commands = [command for block in blocks for command in block]
+    results = [{'Line': c.line, 'Status': 'skipped', 'Duration': '-', 'Command': c.text} for c in commands]
+    events = queue.Queue()
+    output = _Output(commands, ordered)
+    failed = threading.Event()
+
+    def execute(index: int):
+        if stop_on_failure and failed.is_set():
+            events.put((index, _EXIT, None))
+            return
+        start = time.monotonic()
+        try:
+            status = stream_command(client, commands[index].text, stdout=_Pipe(events, index, 1),
+                                    stderr=_Pipe(events, index, 2))
+        except Exception as e:
+            events.put((index, 2, "Error: {}\n".format(str(e) or type(e).__name__).encode()))
+            status = NO_STATUS
+        if status != 0:
+            failed.set()
+        events.put((index, _EXIT, {'Status': status, 'Duration': "{:.2f}s".format(time.monotonic() - start)}))
+
+    index = 0
+    for block in blocks:
+        if stop_on_failure and failed.is_set():
+            break
+        queued = list(range(index, index + len(block)))
+        index += len(block)
+        running = 0
+        while queued or running:
+            while queued and running < max(1, jobs):
+                threading.Thread(target=execute, args=(queued.pop(0),), daemon=True).start()
+                running += 1
+            i, stream, data = events.get()
+            if stream != _EXIT:
+                output.write(i, stream, data)
+                continue
+            running -= 1
+            if data is not None:
+                results[i].update(data)
+            output.finish(i)
+    return results
@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+import tempfile
+import time
+import typing
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# lockdown values which do not change while a device stays the same device
+STATIC_KEYS = ("DeviceName", "ProductType", "WiFiAddress")
+# values an iOS update changes, trusted for at most this many seconds
+SHORT_LIVED_KEYS = {"ProductVersion": 3600}
+
+
+def cache_dir() -> Path:
+    """ $XDG_CACHE_HOME/ioscmd or ~/.cache/ioscmd """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(base).joinpath("ioscmd")
+
+
+def write_json(path: Path, data):
+    """ write json atomically, so concurrent invocations never see half a file """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, str(path))
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def read_json(path: Path, default=None):
+    try:
+        with open(str(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+class DeviceInfoCache:
+    """
+    On-disk cache of lockdown values keyed by UDID
+
+    Values older than ttl seconds are ignored, those of SHORT_LIVED_KEYS
+    sooner when their own limit is shorter
+    """
+
+    def __init__(self, path: typing.Optional[Path] = None, ttl: float = 24 * 3600):
+        self._path = path or cache_dir().joinpath("devices.json")
+        self._ttl = ttl
+        self._entries = read_json(self._path, {})
+        self._dirty = False
+
+    def _ttl_of(self, key: str) -> float:
+        return min(self._ttl, SHORT_LIVED_KEYS.get(key, self._ttl))
+
+    def _fresh(self, udid: str) -> typing.Dict[str, typing.Tuple[typing.Any, float]]:
+        """ {key: (value, time written)} of the values still trusted """
+        entry = self._entries.get(udid)
+        if not entry:
+            return {}
+        now = time.time()
+        # entries written before per key times only have the time of the whole entry
+        times = entry.get("times", {})
+        fresh = {}
+        for key, value in entry["info"].items():
+            written = times.get(key, entry.get("time", 0))
+            if (key in STATIC_KEYS or key in SHORT_LIVED_KEYS) and now - written <= self._ttl_of(key):
+                fresh[key] = (value, written)
+        return fresh
+
+    def get(self, udid: str) -> typing.Optional[dict]:
+        fresh = self._fresh(udid)
+        return {key: value for key, (value, _) in fresh.items()} or None
+
+    def put(self, udid: str, info: dict):
+        """ merged into the entry, a query of some fields keeps the others with their own times """
+        fresh = self._fresh(udid)
+        now = time.time()
+        for key in STATIC_KEYS + tuple(SHORT_LIVED_KEYS):
+            if key in info:
+                fresh[key] = (info[key], now)
+        self._entries[udid] = {"time": now,
+                               "info": {key: value for key, (value, _) in fresh.items()},
+                               "times": {key: written for key, (_, written) in fresh.items()}}
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            write_json(self._path, self._entries)
+            self._dirty = False
+        except OSError as e:
+            logger.debug("unable to write cache %s: %s", self._path, e)
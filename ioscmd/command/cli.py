@@ -1,39 +1,186 @@
+import importlib
+import json
+import sys
+import typing
 from functools import update_wrapper
 
 import click
 from click import ClickException
 
-from ioscmd.ssh_client import SSH
+from ioscmd import spans
+from ioscmd.exceptions import BaseError
+from ioscmd.profiles import AUTO, PROFILES
 
+# command name: (module which registers it, short help), imported when the command is invoked
+# so that commands without ssh never load paramiko. short help None hides the command
+CLI_COMMANDS = {
+    "ssh": ("ioscmd.command.ssh", "Open an interactive shell on the device"),
+    "install": ("ioscmd.command.install", "Install deb packages"),
+    "push": ("ioscmd.command.upload", "Copy a local file or directory to the device"),
+    "pull": ("ioscmd.command.pull", "Copy a file or directory from the device"),
+    "ls": ("ioscmd.command.ls", "List a directory of the device"),
+    "shell": ("ioscmd.command.shell", "Run a command on the device"),
+    "run": ("ioscmd.command.run", "Run a script of commands over one ssh session"),
+    "devices": ("ioscmd.command.devices", "List attached devices"),
+    "forward": ("ioscmd.command.forward", "Forward LOCAL_PORT to DEVICE_PORT of the device"),
+    "registry": ("ioscmd.command.registry", "Keep the device list in memory for other ioscmd invocations"),
+    "mux-master": ("ioscmd.command.mux", None),
+}
 
-@click.group()
+
+class LazyGroup(click.Group):
+    def list_commands(self, ctx: click.Context) -> typing.List[str]:
+        return sorted(set(super().list_commands(ctx)) | set(CLI_COMMANDS))
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> typing.Optional[click.Command]:
+        if cmd_name not in self.commands and cmd_name in CLI_COMMANDS:
+            importlib.import_module(CLI_COMMANDS[cmd_name][0])
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        # help from CLI_COMMANDS, listing commands must not import them
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in CLI_COMMANDS:
+                if CLI_COMMANDS[name][1] is not None:
+                    rows.append((name, CLI_COMMANDS[name][1]))
+            elif not self.commands[name].hidden:
+                rows.append((name, self.commands[name].get_short_help_str()))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup)
 @click.option('--ip', "-i", default=None, help='ssh host ip')
 @click.option('--port', "-p", default="22", help='ssh port')
-@click.option('--udid', "-u", default=None, help='specify unique device identifier')
+@click.option('--udid', "-u", multiple=True, help='specify unique device identifier, repeat to run on several devices')
+@click.option('--all', "all_devices", is_flag=True, help='run on every attached device')
+@click.option('--parallel', default=8, type=click.IntRange(min=1), help='devices served at the same time')
+@click.option('--device-timeout', default=None, type=float, help='seconds before a device is given up')
+@click.option('--group-output', is_flag=True, help='print the output of each device in one block')
+@click.option('--connect-timeout', default=10.0, type=float, help='seconds to wait for the device port')
+@click.option('--mux', is_flag=True, help='reuse a background ssh session of the device')
+@click.option('--mux-idle', default=300.0, type=float, help='seconds the background session stays unused')
+@click.option('--ssh-profile', default=AUTO, type=click.Choice([AUTO] + list(PROFILES)),
+              help='ssh cipher and compression profile, auto picks by usb or network link')
+@click.option('--profile', "timing", is_flag=True, help='print the time spent per phase as json to stderr')
 @click.pass_context
-def cli(ctx: click.Context, ip, port, udid):
+def cli(ctx: click.Context, ip, port, udid, all_devices, parallel, device_timeout, group_output,
+        connect_timeout, mux, mux_idle, ssh_profile, timing):
     ctx.ensure_object(dict)
-    ctx.obj['udid'] = udid
+    ctx.obj['udid'] = udid[0] if len(udid) == 1 else None
+    ctx.obj['udids'] = list(udid)
+    ctx.obj['all'] = all_devices
+    ctx.obj['parallel'] = parallel
+    ctx.obj['device_timeout'] = device_timeout
+    ctx.obj['group_output'] = group_output
     ctx.obj['port'] = port
     ctx.obj['ip'] = ip
+    ctx.obj['connect_timeout'] = connect_timeout
+    ctx.obj['mux'] = mux
+    ctx.obj['mux_idle'] = mux_idle
+    ctx.obj['ssh_profile'] = ssh_profile
+    if timing:
+        _collect_timing(ctx)
+
+
+def _collect_timing(ctx: click.Context):
+    collector = spans.Collector()
+    spans.add_hook(collector)
+
+    def report():
+        spans.remove_hook(collector)
+        print(json.dumps(collector.report()), file=sys.stderr)
+
+    ctx.call_on_close(report)
+
+
+def device_key(obj: dict) -> str:
+    """ identify the ssh endpoint selected by the group options """
+    host = obj['ip'] or obj['udid'] or 'usb'
+    return f"{host}-{obj['port']}"
+
+
+def client_device(client) -> str:
+    """ UDID of the connected device, or the endpoint key for a direct ip """
+    info = getattr(client, "_info", None)
+    if info and info.get("UDID"):
+        return info["UDID"]
+    return device_key(click.get_current_context().obj)
+
+
+def _mux_client(obj: dict):
+    from ioscmd import mux
+    args = ['-p', str(obj['port']), '--connect-timeout', str(obj['connect_timeout']), '--ssh-profile', obj['ssh_profile']]
+    if obj['ip']:
+        args += ['-i', obj['ip']]
+    elif obj['udid']:
+        args += ['-u', obj['udid']]
+    args += ['mux-master', '--idle-timeout', str(obj['mux_idle'])]
+    return mux.connect(device_key(obj), args, timeout=obj['connect_timeout'] + 20)
+
+
+def _invoke(ctx, func, *args, **kwargs):
+    try:
+        return ctx.invoke(func, *args, **kwargs)
+    except BaseError as e:
+        raise ClickException(str(e))
+
+
+def _run(ctx, obj: dict, func, *args, **kwargs):
+    if obj['mux']:
+        try:
+            with spans.span("mux.connect"):
+                _client = _mux_client(obj)
+        except Exception as e:
+            raise ClickException(str(e))
+        with _client:
+            return _invoke(ctx, func, _client, *args, **kwargs)
+    from ioscmd.ssh_client import SSH
+    with SSH(connect_timeout=obj['connect_timeout'], profile=obj['ssh_profile']) as _client:
+        try:
+            _client.connect(hostname=obj['ip'] if obj['ip'] else obj['udid'], port=obj['port'],
+                            username='root', password='alpine')
+        except Exception as e:
+            raise ClickException(str(e))
+        return _invoke(ctx, func, _client, *args, **kwargs)
+
+
+def target_udids(obj: dict) -> typing.List[str]:
+    """ devices selected by --all or repeated --udid, empty for a single target """
+    if obj['ip']:
+        return []
+    if obj['all']:
+        from ioscmd.registry import lookup_devices
+        udids = [d['UDID'] for d in lookup_devices()]
+        if not udids:
+            raise ClickException("--all: no devices attached")
+        return udids
+    return obj['udids'] if len(obj['udids']) > 1 else []
 
 
 def ssh_client(func):
     @click.pass_context
     def new_func(ctx, *args, **kwargs):
-        ip = ctx.obj['ip']
-        udid = ctx.obj['udid']
-        local_port = ctx.obj['port']
-        with SSH() as _client:
-            try:
-                _client.connect(hostname=ip if ip else udid, port=local_port, username='root', password='alpine')
-            except Exception as e:
-                raise ClickException(str(e))
-            return ctx.invoke(func, _client, *args, **kwargs)
+        udids = target_udids(ctx.obj)
+        if not udids:
+            return _run(ctx, ctx.obj, func, *args, **kwargs)
 
-    return update_wrapper(new_func, func)
+        from ioscmd import fanout
 
+        def _one(udid):
+            # a context per device, so click.get_current_context().obj names this device
+            sub_ctx = click.Context(ctx.command, parent=ctx.parent, info_name=ctx.info_name,
+                                    obj=dict(ctx.obj, udid=udid))
+            sub_ctx.params = dict(ctx.params)
+            return _run(sub_ctx, sub_ctx.obj, func, *args, **kwargs)
+
+        results = fanout.run_on_devices(udids, _one, jobs=ctx.obj['parallel'], timeout=ctx.obj['device_timeout'],
+                                        collect=ctx.obj['group_output'])
+        fanout.print_summary(results)
+        if any(r['Status'] != 0 for r in results):
+            ctx.exit(1)
+
+    return update_wrapper(new_func, func)
 
-CLI_GROUPS = ["ssh", "install", "upload", "devices", "shell", "pull"]
-for group in CLI_GROUPS:
-    __import__(f"ioscmd.command.{group}")
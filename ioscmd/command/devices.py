@@ -1,17 +1,108 @@
+import logging
+import queue
+import threading
+import time
+import typing
+
+import click
+
+from ioscmd.cache import DeviceInfoCache
 from ioscmd.command.cli import cli
+from ioscmd.lockdown import LockdownSessions
+from ioscmd.registry import lookup_devices
 from ioscmd.sockets import Usbmux
 from ioscmd.utils import print_dict_as_table
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_FIELDS = "DeviceName,WiFiAddress,ProductType,ProductVersion"
+
+
+def _query_all(tasks: typing.List[typing.Tuple[str, typing.Callable[[], dict]]], jobs: int,
+               timeout: float) -> typing.Dict[str, dict]:
+    """
+    Run (udid, query) up to jobs at a time, each given up timeout seconds after it started
+
+    Workers are daemon threads, one wedged device neither holds back the
+    others nor the exit of the process.
+    """
+    results = queue.Queue()
+    pending = list(tasks)
+    running = {}  # udid: deadline
+    infos = {}
+
+    def call(udid: str, query: typing.Callable[[], dict]):
+        try:
+            results.put((udid, query(), None))
+        except Exception as e:
+            results.put((udid, None, e))
+
+    while pending or running:
+        while pending and len(running) < jobs:
+            udid, query = pending.pop(0)
+            running[udid] = time.monotonic() + timeout
+            threading.Thread(target=call, args=(udid, query), daemon=True).start()
+        try:
+            udid, info, error = results.get(timeout=max(0.0, min(running.values()) - time.monotonic()))
+        except queue.Empty:
+            now = time.monotonic()
+            for udid in [u for u, deadline in running.items() if deadline <= now]:
+                logger.debug("query %s timed out", udid)
+                del running[udid]
+            continue
+        if running.pop(udid, None) is None:
+            continue  # answered after it was given up
+        if error is not None:
+            logger.debug("query %s failed: %s", udid, error)
+        else:
+            infos[udid] = info
+    return infos
+
+
+def _split_fields(ctx, param, value) -> list:
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    if not fields:
+        raise click.BadParameter("no field given")
+    return fields
+
 
 @cli.command()
-def devices():
+@click.option('--jobs', '-j', default=8, type=click.IntRange(min=1), help='parallel lockdown queries')
+@click.option('--timeout', default=5.0, type=float,
+              help='seconds to wait for each device, from the start of its query')
+@click.option('--ttl', default=24 * 3600, type=float, help='seconds to trust cached device info, ProductVersion at most an hour')
+@click.option('--no-cache', is_flag=True, help='always query lockdown')
+@click.option('--fields', '-f', default=DEFAULT_FIELDS, show_default=True, callback=_split_fields,
+              help='comma separated lockdown keys to show, domain:key for other domains')
+def devices(jobs, timeout, ttl, no_cache, fields):
     _usbmux = Usbmux()
-    devices = _usbmux.device_list()
-    headers = ["Identifier", "DeviceName", "WiFiAddress", "ProductType", "ProductVersion", "ConnectionType"]
-    infos = []
+    devices = lookup_devices(_usbmux)
+    headers = ["Identifier"] + fields + ["ConnectionType"]
+    cache = DeviceInfoCache(ttl=ttl)
+    infos = {}
+    pending = []
+    for device in devices:
+        info = {} if no_cache else cache.get(device["UDID"]) or {}
+        # only what is shown and not cached is asked for
+        missing = [f for f in fields if f not in info]
+        if missing:
+            pending.append((device, missing))
+        infos[device["UDID"]] = info
+
+    if pending:
+        sessions = LockdownSessions(_usbmux, timeout)
+        tasks = [(d["UDID"], lambda d=d, missing=missing: sessions.get(d['DeviceID']).get_values(missing))
+                 for d, missing in pending]
+        for udid, info in _query_all(tasks, jobs, timeout).items():
+            infos[udid].update(info)
+            cache.put(udid, info)
+        sessions.close()
+        cache.save()
+
+    rows = []
     for device in devices:
-        info = _usbmux.get_deviceInfo(device['DeviceID'])
+        info = infos[device["UDID"]]
         info['Identifier'] = device["UDID"]
         info['ConnectionType'] = device["ConnectionType"]
-        infos.append(info)
-    print_dict_as_table(infos, headers)
+        rows.append(info)
+    print_dict_as_table(rows, headers)
@@ -0,0 +1,42 @@
+import click
+from click import ClickException
+
+from ioscmd.command.cli import cli
+from ioscmd.registry import lookup_devices
+from ioscmd.relay import Relay
+from ioscmd.sockets import Usbmux
+
+
+def _find_device(usbmux: Usbmux, udid) -> dict:
+    devices = lookup_devices(usbmux)
+    if udid is None:
+        if len(devices) != 1:
+            raise ClickException("{} devices detected, use --udid".format(len(devices)))
+        return devices[0]
+    for d in devices:
+        if d["UDID"] == udid:
+            return d
+    raise ClickException("Device not found")
+
+
+@cli.command()
+@click.argument("local_port", type=int)
+@click.argument("device_port", type=int)
+@click.option("--bind", default="127.0.0.1", help='local address to listen on')
+@click.pass_context
+def forward(ctx: click.Context, local_port, device_port, bind):
+    """ Forward LOCAL_PORT to DEVICE_PORT of the device """
+    ip = ctx.obj['ip']
+    if ip:
+        relay = Relay(local_port, device_port, host=ip, bind=bind, report=print)
+        target = f"{ip}:{device_port}"
+    else:
+        usbmux = Usbmux()
+        device = _find_device(usbmux, ctx.obj['udid'])
+        relay = Relay(local_port, device_port, usbmux=usbmux, devid=device['DeviceID'], bind=bind, report=print)
+        target = f"{device['UDID']}:{device_port}"
+    print(f"forwarding {bind}:{local_port} -> {target}", flush=True)
+    try:
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,24 +1,111 @@
+import hashlib
+import io
+import logging
+import posixpath
+import shlex
+import threading
+import typing
+
 import click
 
+from ioscmd import spans
 from ioscmd.command.cli import cli, ssh_client
-from ioscmd.ssh_client import SSH
+from ioscmd.ssh_client import SSH, stream_command
+from ioscmd.transfer import SFTPPool, TransferError, run_command
+
+logger = logging.getLogger(__name__)
+
+# debs are kept on the device as <sha1>.deb, a bundle only uploads what changed
+DEB_CACHE = "/var/root/.cache/ioscmd/debs"
+
+_debs = {}
+_debs_lock = threading.Lock()
+
+
+def _read_deb(path) -> typing.Tuple[bytes, str]:
+    """ (content, sha1) read once, shared by every device of a fan-out install """
+    with _debs_lock:
+        if path not in _debs:
+            with open(path, "rb") as f:
+                data = f.read()
+            _debs[path] = (data, hashlib.sha1(data).hexdigest())
+        return _debs[path]
+
+
+def _upload_debs(client, jobs: int, cache_dir: str, debs: typing.List[str]) -> typing.List[str]:
+    """ upload debs missing from the device cache, return the remote path of every deb """
+    names = {}
+    for deb in debs:
+        names[deb] = _read_deb(deb)[1] + ".deb"
+    cached = set(run_command(client, "mkdir -p {0} && ls {0}".format(shlex.quote(cache_dir))).decode().split())
+    missing = {}  # name: deb, same content under two paths is uploaded once
+    for deb in debs:
+        if names[deb] not in cached:
+            missing.setdefault(names[deb], deb)
+
+    def upload(sftp, item):
+        name, deb = item
+        remote = posixpath.join(cache_dir, name)
+        # renamed into place once complete, an interrupted upload never looks cached
+        data = _read_deb(deb)[0]
+        with spans.span("sftp.put", bytes=len(data)):
+            sftp.putfo(io.BytesIO(data), remote + ".part", confirm=False)
+            sftp.posix_rename(remote + ".part", remote)
+
+    with SFTPPool(client, jobs) as pool:
+        pool.map(upload, missing.items())
+    remote = list(dict.fromkeys(posixpath.join(cache_dir, names[deb]) for deb in debs))
+    print("{} debs, {} uploaded, {} cached".format(len(remote), len(missing), len(remote) - len(missing)))
+    return remote
+
+
+# dpkg fails on missing dependencies, apt-get -f installs them. When dpkg failed,
+# its status stands unless every package of the bundle ended up installed,
+# a corrupt deb, a conflict or a failing postinst are not fixed by apt-get
+_INSTALL = """dpkg -i {debs}; status=$?
+apt-get -f -y install || exit $?
+[ $status -eq 0 ] && exit 0
+failed=0
+for deb in {debs}; do
+    package=$(dpkg-deb -f "$deb" Package)
+    case "$(dpkg-query -W -f='${{Status}}' "$package" 2>/dev/null)" in
+        *" installed") ;;
+        *) echo "$package: not installed" >&2; failed=1 ;;
+    esac
+done
+[ $failed -eq 0 ] || exit $status
+"""
+
+
+def _install_command(remote: typing.List[str]) -> str:
+    return _INSTALL.format(debs=" ".join(shlex.quote(p) for p in remote))
+
+
+def _prune_command(cache_dir: str, remote: typing.List[str], keep: int) -> str:
+    """ keep the debs of this bundle and the most recently used others, up to keep in all """
+    return ("cd {dir} && touch -c -- {debs} && ls -t | grep '\\.deb$' | tail -n +{start} | xargs rm -f --; "
+            "find . -name '*.part' -mmin +60 -exec rm -f {{}} +").format(
+        dir=shlex.quote(cache_dir), debs=" ".join(shlex.quote(posixpath.basename(p)) for p in remote),
+        start=max(keep, len(remote)) + 1)
 
 
 @cli.command()
-@click.argument("deb", type=click.Path(exists=True))
+@click.option('--jobs', '-j', default=4, type=click.IntRange(min=1), help='parallel uploads')
+@click.option('--cache-dir', default=DEB_CACHE, help='deb cache directory on the device')
+@click.option('--cache-keep', default=50, type=click.IntRange(min=0),
+              help='debs kept in the device cache, least recently used are removed')
+@click.option('--clear-cache', is_flag=True, help='empty the device cache after installing')
+@click.argument("debs", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
 @ssh_client
-def install(client, deb):
-    sftp = client.open_sftp()
-    sftp.put(deb, "/tmp/_ios_install.deb")
-    _shell(client, "dpkg -i /tmp/_ios_install.deb")
-    _shell(client, "apt-get -f -y install")
-    sftp.close()
-
-
-def _shell(client, cmd):
-    _, stdout, stderr = client.exec_command(cmd)
-    while True:
-        line = stdout.readline()
-        if not line:
-            break
-        print(line.rstrip())
+def install(client: SSH, jobs, cache_dir, cache_keep, clear_cache, debs):
+    remote = _upload_debs(client, jobs, cache_dir, list(debs))
+    status = stream_command(client, _install_command(remote))
+    try:
+        if clear_cache:
+            run_command(client, "rm -rf {}".format(shlex.quote(cache_dir)))
+        else:
+            run_command(client, _prune_command(cache_dir, remote, cache_keep))
+    except TransferError as e:
+        # the install result stands, a full cache is tried again next time
+        logger.warning("unable to prune %s: %s", cache_dir, e)
+    click.get_current_context().exit(status)
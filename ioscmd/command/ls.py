@@ -0,0 +1,42 @@
+import sys
+import time
+
+import click
+
+from ioscmd.command.cli import cli, ssh_client
+from ioscmd.ssh_client import SSH
+from ioscmd.walk import RemoteEntry, root_entry, walk
+
+
+def _long(entry: RemoteEntry) -> str:
+    mtime = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.mtime))
+    return "{} {:>12} {} {}".format(entry.filemode(), entry.size, mtime, entry.path)
+
+
+@cli.command()
+@click.option("--recursive", "-R", is_flag=True, help='the whole tree, parents before their children')
+@click.option("--long", "-l", "long_format", is_flag=True, help='mode, size and mtime of every entry')
+@click.argument("path", default=".")
+@ssh_client
+def ls(client: SSH, recursive, long_format, path):
+    out = sys.stdout
+    lines = []
+    try:
+        entries = walk(client, path, max_depth=None if recursive else 1)
+        for entry in entries if recursive else sorted(entries):
+            lines.append(_long(entry) if long_format else entry.path)
+            if len(lines) >= 1000:
+                out.write("\n".join(lines) + "\n")
+                lines = []
+    except NotADirectoryError:
+        # like ls, a file argument lists the file itself
+        try:
+            entry = root_entry(client, path)
+        except FileNotFoundError as e:
+            raise click.ClickException(str(e))
+        lines.append(_long(entry) if long_format else entry.path)
+    except FileNotFoundError as e:
+        raise click.ClickException(str(e))
+    finally:
+        if lines:
+            out.write("\n".join(lines) + "\n")
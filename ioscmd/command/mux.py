@@ -0,0 +1,31 @@
+import os
+import sys
+
+import click
+from click import ClickException
+
+from ioscmd.command.cli import cli, device_key
+from ioscmd.mux import MuxMaster, socket_path
+
+
+@cli.command(name="mux-master", hidden=True)
+@click.option("--idle-timeout", default=300.0, type=float, help='seconds to keep an unused session')
+@click.pass_context
+def mux_master(ctx: click.Context, idle_timeout):
+    """ Serve a shared SSH session, started by --mux """
+
+    def ready(status):
+        sys.stdout.write(status + "\n")
+        sys.stdout.flush()
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+
+    ip = ctx.obj['ip']
+    master = MuxMaster(ip if ip else ctx.obj['udid'], ctx.obj['port'], 'root', 'alpine',
+                       idle_timeout=idle_timeout, connect_timeout=ctx.obj['connect_timeout'],
+                       profile=ctx.obj['ssh_profile'])
+    try:
+        master.serve_forever(socket_path(device_key(ctx.obj)), ready)
+    except Exception as e:
+        raise ClickException(str(e))
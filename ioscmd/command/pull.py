@@ -1,21 +1,142 @@
 import os
+import posixpath
+import shutil
+import stat
+import sys
 from pathlib import Path
 
 import click
+from click import ClickException
 
-from ioscmd.command.cli import cli, ssh_client
+from ioscmd import spans
+from ioscmd.command.cli import cli, client_device, ssh_client
 from ioscmd.ssh_client import SSH
+from ioscmd.transfer import Resume, SFTPPool, TransferStats, changed_files, extraneous, local_digest, local_tree, \
+    print_progress, remote_digests, remote_tree, resumable_get, tar_pull
+
+
+def _download(client, jobs, files, max_requests=None, resume: Resume = None) -> TransferStats:
+    """
+    get [(remote file, local file, size, mtime)] over jobs sftp channels, or one by one resumable, keep mtime
+
+    Every file is read with prefetch, at most max_requests reads in flight per file
+    """
+    stats = TransferStats()
+    total = sum(item[2] for item in files)
+    if resume:
+        for remote_file, local_file, _, _ in files:
+            resumable_get(client, remote_file, local_file, resume, stats, max_requests)
+            print_progress(stats, len(files), total)
+        if sys.stderr.isatty() and files:
+            sys.stderr.write("\n")
+        return stats
+
+    def _get(sftp, item):
+        remote_file, local_file, size, mtime = item
+        with spans.span("sftp.get", bytes=size):
+            sftp.get(remote_file, local_file, max_concurrent_prefetch_requests=max_requests)
+        os.utime(local_file, (mtime, mtime))
+        stats.add(size)
+
+    files = sorted(files, key=lambda item: item[2], reverse=True)
+    with SFTPPool(client, jobs) as pool:
+        pool.map(_get, files, lambda: print_progress(stats, len(files), total))
+    if sys.stderr.isatty() and files:
+        sys.stderr.write("\n")
+    return stats
+
+
+def _pull_tree(client, jobs, remote, local, max_requests, resume) -> TransferStats:
+    sftp = client.open_sftp()
+    try:
+        attr = sftp.stat(remote)
+        if not stat.S_ISDIR(attr.st_mode):
+            files = [(remote, local, attr.st_size, int(attr.st_mtime))]
+            return _download(client, jobs, files, max_requests, resume)
+    finally:
+        sftp.close()
+    source = remote_tree(client, remote)
+    os.makedirs(local, exist_ok=True)
+    files = []
+    for path, entry in source.items():
+        local_file = os.path.join(local, *path.split("/"))
+        if entry.is_dir:
+            os.makedirs(local_file, exist_ok=True)
+        else:
+            files.append((posixpath.join(remote, path), local_file, entry.size, entry.mtime))
+    return _download(client, jobs, files, max_requests, resume)
+
+
+def _sync(client, jobs, remote, local, delete, checksum, max_requests, resume) -> TransferStats:
+    # before anything local is touched, an empty source would delete it all
+    try:
+        source = remote_tree(client, remote)
+    except (FileNotFoundError, NotADirectoryError) as e:
+        raise ClickException("--sync expects a remote directory: {}".format(e))
+    target = local_tree(local) if os.path.isdir(local) else {}
+
+    def local_file(path):
+        return os.path.join(local, *path.split("/"))
+
+    paths = changed_files(source, target, compare_mtime=not checksum)
+    if checksum:
+        same_size = [p for p, e in source.items() if not e.is_dir and p not in paths]
+        digests = remote_digests(client, remote, same_size) if same_size else {}
+        paths += [p for p in same_size if digests.get(p) != local_digest(local_file(p))]
+
+    if delete:
+        for path in extraneous(source, target):
+            if target[path].is_dir:
+                shutil.rmtree(local_file(path))
+            else:
+                os.remove(local_file(path))
+    os.makedirs(local, exist_ok=True)
+    for path, entry in source.items():
+        if entry.is_dir:
+            os.makedirs(local_file(path), exist_ok=True)
+    files = [(posixpath.join(remote, p), local_file(p), source[p].size, source[p].mtime) for p in paths]
+    return _download(client, jobs, files, max_requests, resume)
 
 
 @cli.command()
 @ssh_client
+@click.option("--jobs", "-j", default=1, type=click.IntRange(min=1), help='parallel sftp channels')
+@click.option("--sync", is_flag=True, help='mirror the remote directory into local, only new or changed files')
+@click.option("--delete", is_flag=True, help='with --sync, remove local files missing on the device')
+@click.option("--checksum", is_flag=True, help='with --sync, compare sha1 instead of mtime')
+@click.option("--tar", "use_tar", is_flag=True, help='receive a directory as one tar stream, fast for many small files')
+@click.option("--compress", "-z", is_flag=True, help='with --tar, gzip the stream')
+@click.option("--max-requests", default=128, type=click.IntRange(min=1),
+              help='read-ahead requests of 32KB in flight per file, more hides more link latency')
+@click.option("--resume", is_flag=True,
+              help='one file at a time in chunks, continue after a dropped connection, not with --jobs')
+@click.option("--chunk-size", default=8, type=click.IntRange(min=1), help='with --resume, MB per chunk')
+@click.option("--verify", is_flag=True, help='with --resume, check every chunk against its sha1 on the device')
+@click.option("--retries", default=5, type=click.IntRange(min=0), help='with --resume, reconnects without progress')
 @click.argument("remote")
 @click.argument("local", type=click.Path())
-def pull(client: SSH, remote, local):
-    sftp = client.open_sftp()
+def pull(client: SSH, jobs, sync, delete, checksum, use_tar, compress, max_requests, resume, chunk_size, verify,
+         retries, remote, local):
+    if use_tar and (sync or resume):
+        raise ClickException("--tar can not be used with --sync or --resume")
+    if not sync and (delete or checksum):
+        raise click.UsageError("--delete and --checksum only work with --sync")
+    if resume and jobs > 1:
+        raise click.UsageError("--resume sends one file at a time, it can not be used with --jobs")
+    resume = Resume(client_device(client), chunk_size * 1024 * 1024, verify, retries) if resume else None
+    if use_tar:
+        local_path = Path(local)
+        if local_path.is_dir():
+            local_path = local_path.joinpath(posixpath.basename(remote.rstrip("/")))
+        stats = tar_pull(client, remote, str(local_path), compress)
+        print(f"{remote} has been downloaded to {local_path}: {stats.summary()}")
+        return
+    if sync:
+        stats = _sync(client, jobs, remote, local, delete, checksum, max_requests, resume)
+        print(f"{remote} synced to {local}: {stats.summary()}")
+        return
     local_path = Path(local)
     if local_path.is_dir():
-        remote_path = Path(remote)
-        local_path = local_path.joinpath(remote_path.name)
-    sftp.get(remote, local_path.as_posix())
-    print(f"{remote} has been downloaded to {local}")
+        local_path = local_path.joinpath(posixpath.basename(remote.rstrip("/")))
+    stats = _pull_tree(client, jobs, remote, local_path.as_posix(), max_requests, resume)
+    print(f"{remote} has been downloaded to {local}: {stats.summary()}")
@@ -0,0 +1,13 @@
+
+from ioscmd.command.cli import cli
+from ioscmd.registry import serve, socket_path
+
+
+@cli.command()
+def registry():
+    """ Keep the device list in memory for other ioscmd invocations """
+    print(f"serving device registry on {socket_path()}", flush=True)
+    try:
+        serve()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,29 @@
+import sys
+
+import click
+
+from ioscmd.batch import parse_script, run_script
+from ioscmd.command.cli import cli, ssh_client
+from ioscmd.ssh_client import SSH
+from ioscmd.utils import print_dict_as_table
+
+
+@cli.command()
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='commands of a block run at the same time')
+@click.option('--output', type=click.Choice(['ordered', 'tagged']), default='ordered',
+              help='ordered: whole output of each command in script order, tagged: lines prefixed by line number')
+@click.option('--stop-on-failure', '-e', is_flag=True, help='start no more commands after one failed')
+@click.option('--summary', is_flag=True, help='print the status of every command at the end')
+@click.argument("script", type=click.File("r"), default="-")
+@ssh_client
+def run(client: SSH, jobs, output, stop_on_failure, summary, script):
+    results = run_script(client, parse_script(script), jobs=jobs, ordered=output == 'ordered',
+                         stop_on_failure=stop_on_failure)
+    if summary:
+        print_dict_as_table(results, ["Line", "Status", "Duration", "Command"])
+    failed = [r for r in results if r['Status'] not in (0, 'skipped')]
+    if failed:
+        skipped = sum(r['Status'] == 'skipped' for r in results)
+        sys.stderr.write("{} of {} commands failed, {} skipped, first at line {}\n".format(
+            len(failed), len(results), skipped, failed[0]['Line']))
+        click.get_current_context().exit(failed[0]['Status'])
@@ -1,16 +1,16 @@
+import sys
+
 import click
 
 from ioscmd.command.cli import cli, ssh_client
-from ioscmd.ssh_client import SSH
+from ioscmd.ssh_client import SSH, stream_command
 
 
-@cli.command(context_settings={"ignore_unknown_options": True})
+@cli.command(context_settings={"ignore_unknown_options": True, "allow_interspersed_args": False})
+@click.option("--stdin", "forward_stdin", is_flag=True,
+              help="forward local stdin to the command, only before the command itself")
 @click.argument("cmd", nargs=-1, required=True)
 @ssh_client
-def shell(client: SSH, cmd):
-    _, stdout, stderr = client.exec_command(" ".join(cmd))
-    while True:
-        line = stdout.readline()
-        if not line:
-            break
-        print(line.rstrip())
+def shell(client: SSH, forward_stdin, cmd):
+    status = stream_command(client, " ".join(cmd), stdin=sys.stdin.buffer if forward_stdin else None)
+    click.get_current_context().exit(status)
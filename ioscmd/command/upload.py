@@ -1,31 +1,144 @@
 import os
+import posixpath
+import sys
 from pathlib import Path
 
 import click
+from click import ClickException
 
-from ioscmd.command.cli import cli, ssh_client
+from ioscmd import spans, walk
+from ioscmd.command.cli import cli, client_device, ssh_client
 from ioscmd.ssh_client import SSH
+from ioscmd.transfer import Manifest, Resume, SFTPPool, TransferStats, changed_files, extraneous, local_digest, \
+    local_tree, print_progress, remote_digests, remote_makedirs, remote_remove, remote_sample_matches, remote_tree, \
+    resumable_put, tar_push
+
+
+def _walk(local, remote):
+    """ Return (remote dirs, [(local file, remote file, size)]) of the local tree """
+    if not Path(local).is_dir():
+        return [], [(local, remote, os.path.getsize(local))]
+    dirs = [remote]
+    files = []
+    for root, dirnames, filenames in os.walk(local):
+        rel = os.path.relpath(root, local)
+        remote_root = remote if rel == "." else posixpath.join(remote, *Path(rel).parts)
+        for name in dirnames:
+            dirs.append(posixpath.join(remote_root, name))
+        for name in filenames:
+            file_path = os.path.join(root, name)
+            files.append((file_path, posixpath.join(remote_root, name), os.path.getsize(file_path)))
+    return dirs, files
+
+
+def _upload(client, jobs, files, preserve_mtime=False, resume: Resume = None) -> TransferStats:
+    """ put [(local file, remote file, size)] over jobs sftp channels, or one by one resumable """
+    stats = TransferStats()
+    total = sum(size for _, _, size in files)
+    if resume:
+        for local_file, remote_file, _ in files:
+            resumable_put(client, local_file, remote_file, resume, stats)
+            print_progress(stats, len(files), total)
+        if preserve_mtime:
+            sftp = client.open_sftp()
+            for local_file, remote_file, _ in files:
+                st = os.stat(local_file)
+                sftp.utime(remote_file, (st.st_atime, st.st_mtime))
+            sftp.close()
+        if sys.stderr.isatty() and files:
+            sys.stderr.write("\n")
+        return stats
+
+    def _put(sftp, item):
+        local_file, remote_file, size = item
+        with spans.span("sftp.put", bytes=size):
+            sftp.put(local_file, remote_file, confirm=False)
+        if preserve_mtime:
+            st = os.stat(local_file)
+            sftp.utime(remote_file, (st.st_atime, st.st_mtime))
+        stats.add(size)
+
+    # biggest files first, so the tail is not one large file on a single channel
+    files = sorted(files, key=lambda item: item[2], reverse=True)
+    with SFTPPool(client, jobs) as pool:
+        pool.map(_put, files, lambda: print_progress(stats, len(files), total))
+    if sys.stderr.isatty() and files:
+        sys.stderr.write("\n")
+    return stats
+
+
+def _sync(client, jobs, local, remote, delete, checksum, trust_manifest, resume) -> TransferStats:
+    if not Path(local).is_dir():
+        raise ClickException("--sync expects a directory")
+    source = local_tree(local)
+    manifest = Manifest(client_device(client), local, remote)
+    target = manifest.load() if trust_manifest and not checksum else None
+    # the device may have changed since, a few sampled files decide whether to list it after all
+    if target is not None and not remote_sample_matches(client, remote, target):
+        target = None
+    if target is None:
+        try:
+            target = remote_tree(client, remote)
+        except FileNotFoundError:
+            target = {}  # created below
+        except NotADirectoryError as e:
+            raise ClickException(str(e))
+
+    paths = changed_files(source, target, compare_mtime=not checksum)
+    if checksum:
+        same_size = [p for p, e in source.items() if not e.is_dir and p not in paths]
+        digests = remote_digests(client, remote, same_size) if same_size else {}
+        paths += [p for p in same_size if digests.get(p) != local_digest(os.path.join(local, *p.split("/")))]
+
+    if delete:
+        remote_remove(client, remote, extraneous(source, target))
+    dirs = [posixpath.join(remote, p) for p, e in source.items() if e.is_dir and p not in target]
+    if not target:
+        dirs.append(remote)
+    if dirs:
+        remote_makedirs(client, dirs)
+    files = [(os.path.join(local, *p.split("/")), posixpath.join(remote, p), source[p].size) for p in paths]
+    manifest.clear()
+    stats = _upload(client, jobs, files, preserve_mtime=True, resume=resume)
+    manifest.save(source)
+    return stats
 
 
 @cli.command()
 @ssh_client
+@click.option("--jobs", "-j", default=1, type=click.IntRange(min=1), help='parallel sftp channels')
+@click.option("--sync", is_flag=True, help='only upload new or changed files')
+@click.option("--delete", is_flag=True, help='with --sync, remove remote files missing locally')
+@click.option("--checksum", is_flag=True, help='with --sync, compare sha1 instead of mtime')
+@click.option("--trust-manifest", is_flag=True,
+              help='with --sync, compare against the tree of the last sync instead of listing the device, '
+                   'unless sampled files changed there')
+@click.option("--tar", "use_tar", is_flag=True, help='send everything as one tar stream, fast for many small files')
+@click.option("--compress", "-z", is_flag=True, help='with --tar, gzip the stream')
+@click.option("--resume", is_flag=True,
+              help='one file at a time in chunks, continue after a dropped connection, not with --jobs')
+@click.option("--chunk-size", default=8, type=click.IntRange(min=1), help='with --resume, MB per chunk')
+@click.option("--verify", is_flag=True, help='with --resume, check the sha1 of every chunk on the device')
+@click.option("--retries", default=5, type=click.IntRange(min=0), help='with --resume, reconnects without progress')
 @click.argument("local", type=click.Path(exists=True))
 @click.argument("remote")
-def push(client: SSH, local, remote):
-    sftp = client.open_sftp()
-
-    def _listdir(local_file, remote_path):
-        if Path(local_file).is_dir():
-            try:
-                sftp.mkdir(remote_path)
-            except Exception as e:
-                pass
-            files = os.listdir(local_file)
-            for file in files:
-                file_path = os.path.join(local_file, file)
-                _listdir(file_path, os.path.join(remote_path, file))
-        else:
-            print(f"upload file {local_file} to {remote_path}")
-            sftp.put(local_file, remote_path)
-
-    _listdir(local, remote)
+def push(client: SSH, jobs, sync, delete, checksum, trust_manifest, use_tar, compress, resume, chunk_size, verify,
+         retries, local, remote):
+    if use_tar and (sync or resume):
+        raise ClickException("--tar can not be used with --sync or --resume")
+    if not sync and (delete or checksum or trust_manifest):
+        raise click.UsageError("--delete, --checksum and --trust-manifest only work with --sync")
+    if resume and jobs > 1:
+        raise click.UsageError("--resume sends one file at a time, it can not be used with --jobs")
+    resume = Resume(client_device(client), chunk_size * 1024 * 1024, verify, retries) if resume else None
+    if use_tar:
+        stats = tar_push(client, local, remote, compress)
+    elif sync:
+        stats = _sync(client, jobs, local, remote, delete, checksum, trust_manifest, resume)
+    else:
+        dirs, files = _walk(local, remote)
+        if dirs:
+            remote_makedirs(client, dirs)
+        stats = _upload(client, jobs, files, resume=resume)
+    walk.forget(client, remote)
+    print(f"{local} pushed to {remote}: {stats.summary()}")
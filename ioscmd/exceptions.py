@@ -1,5 +1,5 @@
 __all__ = [
-    'BaseError', 'MuxError', 'MuxReplyError',
+    'BaseError', 'MuxError', 'MuxReplyError', 'UsbmuxReplyCode',
     'AuthenticationException',
     'SocketError'
 ]
@@ -0,0 +1,212 @@
+"""
+Run one command on many devices at once
+
+Output written by a device's worker thread to sys.stdout / sys.stderr is
+prefixed with the device UDID, or collected and printed when it finishes.
+"""
+import io
+import sys
+import threading
+import time
+import traceback
+import typing
+
+import click
+
+from .utils import print_dict_as_table
+
+
+class Sink:
+    """ line buffered writer prefixing every line, one per device (or per batch command) """
+
+    def __init__(self, prefix: bytes, out, lock: threading.Lock, collect: bool):
+        self._prefix = prefix
+        self._out = out
+        self._lock = lock
+        self._collect = collect
+        self._partial = b""
+        self._lines = []
+        self._dropped = False
+
+    def write(self, data: bytes):
+        data = self._partial + bytes(data)
+        *lines, self._partial = data.split(b"\n")
+        self._emit(lines)
+
+    def _emit(self, lines: typing.List[bytes]):
+        if not lines:
+            return
+        if self._dropped:
+            return
+        chunk = b"".join(self._prefix + line + b"\n" for line in lines)
+        if self._collect:
+            self._lines.append(chunk)
+            return
+        with self._lock:
+            if self._dropped:
+                return
+            self._out.write(chunk)
+            self._out.flush()
+
+    def close(self):
+        if self._partial:
+            self._emit([self._partial])
+            self._partial = b""
+        if self._collect and self._lines:
+            with self._lock:
+                if not self._dropped:
+                    self._out.write(b"".join(self._lines))
+                    self._out.flush()
+            self._lines = []
+
+    def drop(self):
+        """ the device was given up, whatever it writes from now on is thrown away """
+        with self._lock:
+            self._dropped = True
+            self._lines = []
+
+
+class _BinaryRouter(io.RawIOBase):
+    def __init__(self, router: "_Router"):
+        self._router = router
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        sink = self._router.sink()
+        if sink is None:
+            return self._router.real.buffer.write(data)
+        sink.write(data)
+        return len(data)
+
+    def flush(self):
+        if self._router.sink() is None:
+            self._router.real.buffer.flush()
+
+
+class _Router(io.TextIOBase):
+    """ stand-in for sys.stdout / sys.stderr, sends each thread to its sink """
+
+    def __init__(self, real):
+        self.real = real
+        self._local = threading.local()
+        self._buffer = _BinaryRouter(self)
+
+    def sink(self) -> typing.Optional[Sink]:
+        return getattr(self._local, "sink", None)
+
+    def set_sink(self, sink: typing.Optional[Sink]):
+        self._local.sink = sink
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    @property
+    def encoding(self):
+        return self.real.encoding
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        sink = self.sink()
+        if sink is None:
+            return self.real.write(s)
+        sink.write(s.encode(self.real.encoding or "utf-8", errors="replace"))
+        return len(s)
+
+    def flush(self):
+        if self.sink() is None:
+            self.real.flush()
+
+    def isatty(self) -> bool:
+        return self.sink() is None and self.real.isatty()
+
+    def fileno(self) -> int:
+        return self.real.fileno()
+
+
+def _run_one(udid: str, func: typing.Callable[[str], typing.Any], result: dict):
+    start = time.monotonic()
+    try:
+        func(udid)
+        result['Status'] = 0
+    except click.exceptions.Exit as e:
+        result['Status'] = e.exit_code
+    except click.ClickException as e:
+        result['Status'] = e.exit_code
+        sys.stderr.write("Error: {}\n".format(e.format_message()))
+    except Exception as e:
+        result['Status'] = 1
+        sys.stderr.write("Error: {}\n".format(e or type(e).__name__))
+        sys.stderr.write(traceback.format_exc())
+    finally:
+        result['Duration'] = "{:.2f}s".format(time.monotonic() - start)
+        for stream in (sys.stdout, sys.stderr):
+            if isinstance(stream, _Router) and stream.sink():
+                stream.sink().close()
+                stream.set_sink(None)
+
+
+def run_on_devices(udids: typing.List[str], func: typing.Callable[[str], typing.Any],
+                   jobs: int = 8, timeout: typing.Optional[float] = None,
+                   collect: bool = False) -> typing.List[dict]:
+    """
+    Call func(udid) for every udid, at most jobs at the same time
+
+    A device which does not finish within timeout seconds is reported as
+    "timeout" and left behind, its slot goes to the next device. Its output
+    is dropped from then on, and while such a worker is still running
+    sys.stdout / sys.stderr stay routed so it cannot write unprefixed.
+
+    Returns:
+        [{'Identifier': udid, 'Status': exit status or 'timeout', 'Duration': ...}]
+    """
+    lock = threading.Lock()
+    stdout, stderr = sys.stdout, sys.stderr
+    out_router, err_router = _Router(stdout), _Router(stderr)
+    results = [{'Identifier': udid, 'Status': 'timeout', 'Duration': '-'} for udid in udids]
+    sinks = {}  # index: (stdout sink, stderr sink)
+    abandoned = []
+
+    def worker(index, udid, result):
+        out_router.set_sink(sinks[index][0])
+        err_router.set_sink(sinks[index][1])
+        _run_one(udid, func, result)
+
+    queue = list(enumerate(udids))
+    running = {}  # thread: (start time, index)
+    sys.stdout, sys.stderr = out_router, err_router
+    try:
+        while queue or running:
+            while queue and len(running) < max(1, jobs):
+                index, udid = queue.pop(0)
+                prefix = udid.encode() + b": "
+                sinks[index] = (Sink(prefix, stdout.buffer, lock, collect),
+                                Sink(prefix, stderr.buffer, lock, collect))
+                t = threading.Thread(target=worker, args=(index, udid, results[index]), daemon=True)
+                t.start()
+                running[t] = (time.monotonic(), index)
+            for t, (start, index) in list(running.items()):
+                t.join(0.05 / len(running))
+                if not t.is_alive():
+                    del running[t]
+                elif timeout is not None and time.monotonic() - start > timeout:
+                    # the worker keeps its own dict, late updates do not change the report
+                    results[index] = {'Identifier': udids[index], 'Status': 'timeout',
+                                      'Duration': "{:.2f}s".format(timeout)}
+                    for sink in sinks[index]:
+                        sink.drop()
+                    abandoned.append(t)
+                    del running[t]
+    finally:
+        # threads without a sink go straight through, a left behind worker keeps its dropping sink
+        if not any(t.is_alive() for t in abandoned):
+            sys.stdout, sys.stderr = stdout, stderr
+    return results
+
+
+def print_summary(results: typing.List[dict]):
+    print_dict_as_table(results, ["Identifier", "Status", "Duration"])
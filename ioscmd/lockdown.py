@@ -0,0 +1,166 @@
+"""
+GetValue of selected lockdown keys over one connection per device
+
+    with LockdownSessions(usbmux) as sessions:
+        sessions.get(devid).get_values(["DeviceName", "com.apple.mobile.battery:BatteryCurrentCapacity"])
+
+A field is a key of the default domain, or domain:key. Requests of a batch
+are sent together and the replies read in order, one round trip for all of
+them. Asking without a key returns the whole value dictionary, tens of
+kilobytes of plist, which is what Usbmux.get_deviceInfo still does.
+"""
+import logging
+import socket
+import threading
+import typing
+
+from . import spans
+from .exceptions import SocketError
+from .sockets import LOCKDOWN_PORT, PlistSocketProxy, Usbmux, _get_value_request
+from .utils import set_socket_timeout
+
+logger = logging.getLogger(__name__)
+
+
+def parse_field(field: str) -> typing.Tuple[typing.Optional[str], str]:
+    """ "domain:key" or "key" to (domain or None, key) """
+    domain, _, key = field.rpartition(":")
+    return domain or None, key
+
+
+class LockdownClient:
+    """ one lockdownd connection of a device, opened on first use and again after it broke """
+
+    def __init__(self, usbmux: Usbmux, devid: int, timeout: float = 10.0):
+        self._usbmux = usbmux
+        self._devid = devid
+        self._timeout = timeout
+        self._conn: typing.Optional[PlistSocketProxy] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def devid(self) -> int:
+        return self._devid
+
+    def get_value(self, key: typing.Optional[str] = None, domain: typing.Optional[str] = None,
+                  default=None) -> typing.Any:
+        reply = self._exchange([_get_value_request(key, domain)])[0]
+        return reply.get("Value", default)
+
+    def get_values(self, fields: typing.Iterable[str]) -> dict:
+        """ {field: value} of every field the device has, missing ones are left out """
+        fields = list(dict.fromkeys(fields))
+        if not fields:
+            return {}
+        requests = [_get_value_request(key, domain) for domain, key in map(parse_field, fields)]
+        values = {}
+        for field, reply in zip(fields, self._exchange(requests)):
+            if "Value" in reply:
+                values[field] = reply["Value"]
+            else:
+                logger.debug("lockdown %s of device %d: %s", field, self._devid, reply.get("Error"))
+        return values
+
+    def _exchange(self, requests: typing.List[dict]) -> typing.List[dict]:
+        with self._lock, spans.span("lockdown.GetValue", keys=len(requests)):
+            reused = self._conn is not None and not self._conn.closed
+            try:
+                return self._pipeline(requests)
+            except (SocketError, OSError):
+                self._close()
+                if not reused or self._closed:
+                    raise
+                # lockdownd drops idle connections, start over once on a fresh one
+                logger.debug("lockdown connection of device %d broke, reconnecting", self._devid)
+                try:
+                    return self._pipeline(requests)
+                except (SocketError, OSError):
+                    self._close()
+                    raise
+            finally:
+                # close() came while this was in flight and left the connection to it
+                if self._closed:
+                    self._close()
+
+    def _pipeline(self, requests: typing.List[dict]) -> typing.List[dict]:
+        if self._closed:
+            raise SocketError("lockdown client of device {} is closed".format(self._devid))
+        if self._conn is None or self._conn.closed:
+            self._conn = self._usbmux.connect_device_port(self._devid, LOCKDOWN_PORT, self._timeout)
+            if self._closed:
+                raise SocketError("lockdown client of device {} is closed".format(self._devid))
+        with set_socket_timeout(self._conn.get_socket(), self._timeout):
+            for request in requests:
+                self._conn.send_packet(request)
+            return [self._conn.recv_packet() for _ in requests]
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def close(self):
+        """
+        From any thread, never waits for a request in flight: its socket is
+        shut down so it fails now instead of at its timeout, and it closes
+        the connection itself
+        """
+        self._closed = True
+        conn = self._conn
+        if conn is not None and not conn.closed:
+            try:
+                conn.get_socket().shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._lock.acquire(blocking=False):
+            try:
+                self._close()
+            finally:
+                self._lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LockdownSessions:
+    """ a LockdownClient per device of one Usbmux, closed together """
+
+    def __init__(self, usbmux: Usbmux, timeout: float = 10.0):
+        self._usbmux = usbmux
+        self._timeout = timeout
+        self._clients: typing.Dict[int, LockdownClient] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def get(self, devid: int) -> LockdownClient:
+        with self._lock:
+            if self._closed:
+                raise SocketError("lockdown sessions are closed")
+            if devid not in self._clients:
+                self._clients[devid] = LockdownClient(self._usbmux, devid, self._timeout)
+            return self._clients[devid]
+
+    def discard(self, devid: int):
+        """ the device went away """
+        with self._lock:
+            client = self._clients.pop(devid, None)
+        if client is not None:
+            client.close()
+
+    def close(self):
+        """ no new sessions after this, the ones in flight fail at once, see LockdownClient.close """
+        with self._lock:
+            self._closed = True
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,482 @@
+"""
+Persistent SSH session shared by short-lived ioscmd invocations
+
+A master process keeps one authenticated transport per device and listens on
+a local unix socket. Every client connection asks for one channel
+(exec, shell or subsystem); the master opens it on the shared transport and
+relays it as frames of (kind, length, payload).
+"""
+import fcntl
+import json
+import logging
+import os
+import re
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import typing
+import weakref
+
+import paramiko
+from paramiko import pipe
+from paramiko.buffered_pipe import BufferedPipe, PipeTimeout
+from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
+
+from . import spans
+from .cache import cache_dir
+from .exceptions import MuxError
+from .profiles import AUTO
+from .ssh_client import SSH, interactive_shell
+
+logger = logging.getLogger(__name__)
+
+FRAME_OPEN = 0  # json request, client -> master
+FRAME_OK = 1
+FRAME_ERROR = 2  # utf-8 message
+FRAME_DATA = 3  # stdout / stdin
+FRAME_EXT = 4  # stderr
+FRAME_EOF = 5
+FRAME_EXIT = 6  # >i exit status
+FRAME_WINCH = 7  # >II width height
+
+_HEADER = struct.Struct(">BI")
+_CHUNK = 32768
+
+
+def socket_path(key: str) -> str:
+    name = re.sub(r"[^\w.-]", "_", key)
+    return str(cache_dir().joinpath("mux", name + ".sock"))
+
+
+def _recvall(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError("mux socket closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def send_frame(sock: socket.socket, kind: int, payload: bytes = b""):
+    sock.sendall(_HEADER.pack(kind, len(payload)) + payload)
+
+
+def recv_frame(sock: socket.socket) -> typing.Tuple[int, bytes]:
+    kind, length = _HEADER.unpack(_recvall(sock, _HEADER.size))
+    return kind, _recvall(sock, length) if length else b""
+
+
+class MuxChannel:
+    """
+    Channel relayed by the master, implements the part of paramiko.Channel
+    used by SFTPClient, ChannelFile and interactive_shell
+    """
+
+    def __init__(self, sock: socket.socket, name: str):
+        self._sock = sock
+        self._name = name
+        self._send_lock = threading.Lock()
+        self._timeout = None
+        self._pipe = None
+        self.in_buffer = BufferedPipe()
+        self.in_stderr_buffer = BufferedPipe()
+        self.exit_status = -1
+        self.status_event = threading.Event()
+        self.closed = False
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        try:
+            while True:
+                kind, payload = recv_frame(self._sock)
+                if kind == FRAME_DATA:
+                    self.in_buffer.feed(payload)
+                elif kind == FRAME_EXT:
+                    self.in_stderr_buffer.feed(payload)
+                elif kind == FRAME_EOF:
+                    self.in_buffer.close()
+                    self.in_stderr_buffer.close()
+                elif kind == FRAME_EXIT:
+                    (self.exit_status,) = struct.unpack(">i", payload)
+                    self.status_event.set()
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.in_buffer.close()
+            self.in_stderr_buffer.close()
+            self.status_event.set()
+            if self._pipe is not None:
+                self._pipe.set_forever()
+
+    def _send(self, kind: int, payload: bytes = b""):
+        with self._send_lock:
+            try:
+                send_frame(self._sock, kind, payload)
+            except OSError as e:
+                raise EOFError("mux socket closed") from e
+
+    def get_name(self) -> str:
+        return self._name
+
+    def settimeout(self, timeout: typing.Optional[float]):
+        self._timeout = timeout
+
+    def gettimeout(self) -> typing.Optional[float]:
+        return self._timeout
+
+    def fileno(self) -> int:
+        if self._pipe is None:
+            self._pipe = pipe.make_pipe()
+            p1, p2 = pipe.make_or_pipe(self._pipe)
+            self.in_buffer.set_event(p1)
+            self.in_stderr_buffer.set_event(p2)
+        return self._pipe.fileno()
+
+    def recv(self, nbytes: int) -> bytes:
+        try:
+            return self.in_buffer.read(nbytes, self._timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv_stderr(self, nbytes: int) -> bytes:
+        try:
+            return self.in_stderr_buffer.read(nbytes, self._timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv_ready(self) -> bool:
+        return self.in_buffer.read_ready()
+
+    def recv_stderr_ready(self) -> bool:
+        return self.in_stderr_buffer.read_ready()
+
+    def send(self, data: bytes) -> int:
+        self._send(FRAME_DATA, bytes(data))
+        return len(data)
+
+    def sendall(self, data: bytes):
+        view = memoryview(data)
+        for i in range(0, len(view), _CHUNK):
+            self._send(FRAME_DATA, bytes(view[i:i + _CHUNK]))
+
+    def shutdown_write(self):
+        if self.closed:
+            return
+        try:
+            self._send(FRAME_EOF)
+        except EOFError:
+            pass
+
+    def resize_pty(self, width: int = 80, height: int = 24, width_pixels: int = 0, height_pixels: int = 0):
+        self._send(FRAME_WINCH, struct.pack(">II", width, height))
+
+    def exit_status_ready(self) -> bool:
+        return self.status_event.is_set()
+
+    def recv_exit_status(self) -> int:
+        self.status_event.wait()
+        return self.exit_status
+
+    def makefile(self, *params) -> ChannelFile:
+        return ChannelFile(*([self] + list(params)))
+
+    def makefile_stderr(self, *params) -> ChannelStderrFile:
+        return ChannelStderrFile(*([self] + list(params)))
+
+    def makefile_stdin(self, *params) -> ChannelStdinFile:
+        return ChannelStdinFile(*([self] + list(params)))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MuxClient:
+    """
+    Drop-in for SSH inside commands, every channel goes through the master
+
+    close() closes the channels opened by this client, reconnect() starts
+    the master again if it went away and has it reconnect a lost transport.
+    """
+
+    def __init__(self, path: str, master_args: typing.Optional[typing.List[str]] = None, timeout: float = 30.0):
+        self._path = path
+        self._master_args = master_args
+        self._timeout = timeout
+        self._count = 0
+        self._channels: "weakref.WeakSet[MuxChannel]" = weakref.WeakSet()
+        self._closed = False
+
+    def _open(self, request: dict) -> MuxChannel:
+        with spans.span("mux.open", kind=request["kind"]):
+            return self._open_channel(request)
+
+    def _request(self, request: dict) -> socket.socket:
+        """ connected socket the master answered FRAME_OK on """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._path)
+            send_frame(sock, FRAME_OPEN, json.dumps(request).encode())
+            kind, payload = recv_frame(sock)
+        except (OSError, EOFError) as e:
+            sock.close()
+            raise MuxError("mux master unavailable") from e
+        if kind != FRAME_OK:
+            sock.close()
+            raise MuxError(payload.decode(errors="replace"))
+        return sock
+
+    def _open_channel(self, request: dict) -> MuxChannel:
+        if self._closed:
+            raise MuxError("mux client is closed")
+        sock = self._request(request)
+        self._count += 1
+        chan = MuxChannel(sock, "mux%d" % self._count)
+        self._channels.add(chan)
+        return chan
+
+    def exec_command(self, command: str, bufsize: int = -1, timeout: float = None, get_pty: bool = False):
+        chan = self._open({"kind": "exec", "command": command, "get_pty": get_pty})
+        chan.settimeout(timeout)
+        stdin = chan.makefile_stdin("wb", bufsize)
+        stdout = chan.makefile("r", bufsize)
+        stderr = chan.makefile_stderr("r", bufsize)
+        return stdin, stdout, stderr
+
+    def invoke_shell(self, term: str = "vt100", width: int = 80, height: int = 24) -> MuxChannel:
+        return self._open({"kind": "shell", "term": term, "width": width, "height": height})
+
+    def open_sftp(self) -> paramiko.SFTPClient:
+        return paramiko.SFTPClient(self._open({"kind": "subsystem", "name": "sftp"}))
+
+    def close(self):
+        """ close every channel of this client, the master and its transport stay for the next invocation """
+        self._closed = True
+        for chan in list(self._channels):
+            chan.close()
+        self._channels.clear()
+
+    def reconnect(self):
+        """ like SSH.reconnect: drop the open channels, make sure master and transport are up again """
+        self.close()
+        if self._master_args is not None and not _is_alive(self._path):
+            _start_master(self._master_args, self._timeout)
+        self._request({"kind": "reconnect"}).close()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __call__(self, *args, **kwargs):
+        interactive_shell(self.invoke_shell())
+
+
+class MuxMaster:
+    def __init__(self, hostname: typing.Optional[str], port, username: str, password: str,
+                 idle_timeout: float = 300, connect_timeout: float = 10.0, profile: str = AUTO):
+        self._connect_args = dict(hostname=hostname, port=port, username=username, password=password)
+        self._idle_timeout = idle_timeout
+        self._connect_timeout = connect_timeout
+        self._profile = profile
+        self._client = None
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last_active = time.monotonic()
+
+    def transport(self) -> paramiko.Transport:
+        """ Return the shared transport, reconnect if the device was replugged """
+        with self._lock:
+            transport = self._client.get_transport() if self._client else None
+            if transport is None or not transport.is_active():
+                if self._client is not None:
+                    logger.info("transport lost, reconnecting")
+                    self._client.close()
+                self._client = SSH(connect_timeout=self._connect_timeout, profile=self._profile)
+                self._client.connect(**self._connect_args)
+                transport = self._client.get_transport()
+                transport.set_keepalive(30)
+            return transport
+
+    def serve_forever(self, path: str, ready: typing.Callable[[str], None] = None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if _is_alive(path):
+                ready and ready("ok")
+                return
+            try:
+                self.transport()
+            except Exception as e:
+                ready and ready("error " + str(e))
+                raise
+            if os.path.exists(path):
+                os.unlink(path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            os.chmod(path, 0o600)
+            server.listen(64)
+        ready and ready("ok")
+        server.settimeout(1.0)
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    with self._lock:
+                        idle = self._active == 0 and time.monotonic() - self._last_active > self._idle_timeout
+                    if idle:
+                        logger.info("idle for %ds, exit", self._idle_timeout)
+                        break
+                    continue
+                conn.settimeout(None)
+                with self._lock:
+                    self._active += 1
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            server.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            if self._client is not None:
+                self._client.close()
+
+    def _handle(self, conn: socket.socket):
+        try:
+            kind, payload = recv_frame(conn)
+            if kind != FRAME_OPEN:
+                raise MuxError("unexpected frame %d" % kind)
+            request = json.loads(payload.decode())
+            if request.get("kind") == "reconnect":
+                try:
+                    self.transport()
+                except Exception as e:
+                    send_frame(conn, FRAME_ERROR, str(e).encode())
+                else:
+                    send_frame(conn, FRAME_OK)
+                return
+            try:
+                chan = self._open_channel(request)
+            except Exception as e:
+                send_frame(conn, FRAME_ERROR, str(e).encode())
+                return
+            send_frame(conn, FRAME_OK)
+            try:
+                self._relay(conn, chan)
+            finally:
+                chan.close()
+        except (EOFError, OSError, ValueError, MuxError) as e:
+            logger.debug("mux client error: %s", e)
+        finally:
+            conn.close()
+            with self._lock:
+                self._active -= 1
+                self._last_active = time.monotonic()
+
+    def _open_channel(self, request: dict) -> paramiko.Channel:
+        chan = self.transport().open_session()
+        kind = request.get("kind")
+        if kind == "exec":
+            if request.get("get_pty"):
+                chan.get_pty()
+            chan.exec_command(request["command"])
+        elif kind == "shell":
+            chan.get_pty(request.get("term", "vt100"), request.get("width", 80), request.get("height", 24))
+            chan.invoke_shell()
+        elif kind == "subsystem":
+            chan.invoke_subsystem(request["name"])
+        else:
+            chan.close()
+            raise MuxError("unknown channel kind: {}".format(kind))
+        return chan
+
+    @staticmethod
+    def _relay(conn: socket.socket, chan: paramiko.Channel):
+        stdout_eof = False
+        while True:
+            # once stdout reached eof the channel stays readable, only wait for the exit status
+            if stdout_eof:
+                readable, _, _ = select.select([conn], [], [], 0.05)
+            else:
+                readable, _, _ = select.select([conn, chan], [], [], 1.0)
+            if conn in readable:
+                kind, payload = recv_frame(conn)
+                if kind == FRAME_DATA:
+                    chan.sendall(payload)
+                elif kind == FRAME_EOF:
+                    chan.shutdown_write()
+                elif kind == FRAME_WINCH:
+                    width, height = struct.unpack(">II", payload)
+                    chan.resize_pty(width=width, height=height)
+            while chan.recv_stderr_ready():
+                send_frame(conn, FRAME_EXT, chan.recv_stderr(_CHUNK))
+            if not stdout_eof and (chan.recv_ready() or chan.closed or chan.eof_received):
+                data = chan.recv(_CHUNK)
+                if data:
+                    send_frame(conn, FRAME_DATA, data)
+                else:
+                    stdout_eof = True
+            if stdout_eof and not chan.recv_stderr_ready() and (chan.exit_status_ready() or chan.closed):
+                send_frame(conn, FRAME_EOF)
+                send_frame(conn, FRAME_EXIT, struct.pack(">i", chan.recv_exit_status()))
+                return
+
+
+def _is_alive(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+def _start_master(master_args: typing.List[str], timeout: float):
+    cmd = [sys.executable, "-m", "ioscmd"] + master_args
+    logger.debug("start mux master: %s", cmd)
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, start_new_session=True)
+    ready, _, _ = select.select([proc.stdout], [], [], timeout)
+    line = proc.stdout.readline().decode().strip() if ready else "error timeout waiting for mux master"
+    proc.stdout.close()
+    if line != "ok":
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        raise MuxError(line[len("error "):] if line.startswith("error ") else "mux master exited")
+    # the master outlives this process, until then it is reaped here instead of left a zombie
+    threading.Thread(target=proc.wait, daemon=True).start()
+
+
+def connect(key: str, master_args: typing.List[str], timeout: float = 30.0) -> MuxClient:
+    """
+    Return a client attached to the master of key, start the master if needed
+
+    Args:
+        master_args: command line arguments (for ioscmd) that start the master
+    """
+    path = socket_path(key)
+    if not _is_alive(path):
+        _start_master(master_args, timeout)
+    return MuxClient(path, master_args, timeout)
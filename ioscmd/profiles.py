@@ -0,0 +1,65 @@
+"""
+SSH algorithm profiles per link type
+
+Over usb the host cpu is the limit, so the cheapest cipher, mac and kex come
+first. Over the network the bandwidth is, so zlib compression is requested
+as well. Algorithms not known to the installed paramiko are skipped, and the
+rest of paramiko's defaults stay behind the preferred ones as fallback.
+"""
+import typing
+
+if typing.TYPE_CHECKING:
+    import paramiko
+
+# cheap kex first, the group exchange ones cost several hundred ms on a phone
+_FAST_KEX = ('curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256')
+# aead when paramiko has it, otherwise ctr with an encrypt-then-mac
+_FAST_CIPHERS = ('aes128-gcm@openssh.com', 'aes128-ctr')
+_FAST_MACS = ('hmac-sha2-256-etm@openssh.com', 'hmac-sha2-256')
+
+
+class Profile(typing.NamedTuple):
+    name: str
+    ciphers: typing.Tuple[str, ...] = ()
+    kex: typing.Tuple[str, ...] = ()
+    macs: typing.Tuple[str, ...] = ()
+    compress: bool = False
+
+
+PROFILES = {
+    "default": Profile("default"),
+    "usb": Profile("usb", ciphers=_FAST_CIPHERS, kex=_FAST_KEX, macs=_FAST_MACS),
+    "network": Profile("network", ciphers=_FAST_CIPHERS, kex=_FAST_KEX, macs=_FAST_MACS, compress=True),
+}
+
+AUTO = "auto"
+
+
+def profile_for(connection_type: typing.Optional[str]) -> Profile:
+    """ profile of a usbmux ConnectionType, None for a direct tcp connection """
+    if connection_type and connection_type.lower() == "usb":
+        return PROFILES["usb"]
+    return PROFILES["network"]
+
+
+def _prefer(preferred: typing.Sequence[str], available: typing.Sequence[str], known) -> typing.Tuple[str, ...]:
+    first = tuple(name for name in preferred if name in known)
+    return first + tuple(name for name in available if name not in first)
+
+
+def transport_factory(profile: Profile) -> typing.Callable[..., "paramiko.Transport"]:
+    """ for SSHClient.connect(transport_factory=...), orders the algorithms of a new Transport """
+    import paramiko
+
+    def factory(sock, **kwargs) -> paramiko.Transport:
+        transport = paramiko.Transport(sock, **kwargs)
+        options = transport.get_security_options()
+        if profile.ciphers:
+            options.ciphers = _prefer(profile.ciphers, options.ciphers, transport._cipher_info)
+        if profile.kex:
+            options.kex = _prefer(profile.kex, options.kex, transport._kex_info)
+        if profile.macs:
+            options.digests = _prefer(profile.macs, options.digests, transport._mac_info)
+        return transport
+
+    return factory
@@ -0,0 +1,225 @@
+"""
+In-memory device registry kept up to date by the usbmuxd Listen stream
+
+A long-running process can use DeviceRegistry directly; `ioscmd registry`
+serves it on a local unix socket, and lookup_devices() makes short-lived
+invocations read from there instead of asking usbmuxd.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import typing
+
+from .cache import cache_dir
+from .exceptions import SocketError
+from .sockets import PlistSocketProxy, Usbmux, _check, _listen_request
+
+logger = logging.getLogger(__name__)
+
+
+def socket_path() -> str:
+    return str(cache_dir().joinpath("registry.sock"))
+
+
+def _normalize(prop: dict) -> dict:
+    prop = dict(prop)
+    prop['ConnectionType'] = prop.get('ConnectionType', '').lower()  # same as Usbmux.device_list
+    return prop
+
+
+class DeviceRegistry:
+    """
+    Devices attached to usbmuxd, lookups never leave the process
+
+    Call start() to follow Attached / Detached events in a background thread.
+    When the usbmuxd connection drops the registry reconnects and resyncs.
+    """
+
+    def __init__(self, usbmux: typing.Optional[Usbmux] = None, retry_interval: float = 1.0):
+        self._own_usbmux = usbmux is None
+        self._usbmux = usbmux or Usbmux()
+        self._retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._by_id = {}  # DeviceID: properties
+        self._by_udid = {}  # UDID: properties
+        self._by_type = {}  # ConnectionType: {DeviceID}
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._conn = None
+        self._thread = None
+
+    def start(self) -> "DeviceRegistry":
+        self._thread = threading.Thread(target=self._run, name="device-registry", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        conn = self._conn
+        if conn is not None:
+            conn.close()
+        if self._thread is not None:
+            self._thread.join()
+        if self._own_usbmux:
+            self._usbmux.close()
+
+    def wait_synced(self, timeout: typing.Optional[float] = None) -> bool:
+        """ wait until the registry holds a full device list """
+        return self._synced.wait(timeout)
+
+    @property
+    def synced(self) -> bool:
+        return self._synced.is_set()
+
+    def get(self, udid: str) -> typing.Optional[dict]:
+        with self._lock:
+            return self._by_udid.get(udid)
+
+    def get_by_id(self, devid: int) -> typing.Optional[dict]:
+        with self._lock:
+            return self._by_id.get(devid)
+
+    def by_connection_type(self, connection_type: str) -> typing.List[dict]:
+        with self._lock:
+            return [self._by_id[i] for i in self._by_type.get(connection_type.lower(), ())]
+
+    def device_list(self) -> typing.List[dict]:
+        """ same result as Usbmux.device_list """
+        with self._lock:
+            return list(self._by_udid.values())
+
+    def _reset(self, devices: typing.List[dict]):
+        with self._lock:
+            self._by_id.clear()
+            self._by_udid.clear()
+            self._by_type.clear()
+            for prop in devices:
+                self._add(_normalize(prop))
+
+    def _add(self, prop: dict):
+        devid = prop['DeviceID']
+        self._remove(devid)
+        self._by_id[devid] = prop
+        self._by_type.setdefault(prop['ConnectionType'], set()).add(devid)
+        if prop.get('UDID'):
+            self._by_udid[prop['UDID']] = prop
+
+    def _remove(self, devid: int):
+        prop = self._by_id.pop(devid, None)
+        if prop is None:
+            return
+        self._by_type.get(prop['ConnectionType'], set()).discard(devid)
+        udid = prop.get('UDID')
+        if self._by_udid.get(udid) is prop:
+            del self._by_udid[udid]
+            # another connection of the same device (usb and network) takes over
+            for other in self._by_id.values():
+                if other.get('UDID') == udid:
+                    self._by_udid[udid] = other
+
+    def apply(self, event: dict):
+        """ apply one message of the Listen stream """
+        kind = event.get('MessageType')
+        with self._lock:
+            if kind == 'Attached':
+                self._add(_normalize(event['Properties']))
+            elif kind == 'Detached':
+                self._remove(event['DeviceID'])
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except (SocketError, OSError) as e:
+                logger.debug("usbmuxd listen connection lost: %s", e)
+            finally:
+                self._synced.clear()
+                self._conn = None
+            self._stopped.wait(self._retry_interval)
+
+    def _listen(self):
+        conn: PlistSocketProxy = self._usbmux.create_connection()
+        self._conn = conn
+        if self._stopped.is_set():
+            conn.close()
+            return
+        with conn:
+            conn.send_packet(_listen_request())
+            _check(conn.recv_packet())
+            # events which race with the list are applied again afterwards, both are idempotent
+            self._reset(self._usbmux.device_list())
+            self._synced.set()
+            while True:
+                self.apply(conn.recv_packet(header_size=16))
+
+
+class RegistryServer:
+    """ Answer device lists from a DeviceRegistry on a unix socket, one json line per request """
+
+    def __init__(self, registry: DeviceRegistry, path: typing.Optional[str] = None):
+        self._registry = registry
+        self._path = path or socket_path()
+
+    def serve_forever(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._path)
+        server.listen(64)
+        try:
+            while True:
+                conn, _ = server.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            server.close()
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+
+    def _handle(self, conn: socket.socket):
+        with conn:
+            conn.settimeout(5)
+            try:
+                conn.makefile("rb").readline()
+                if not self._registry.wait_synced(5):
+                    reply = {"error": "usbmuxd not available"}
+                else:
+                    reply = {"devices": self._registry.device_list()}
+                conn.sendall(json.dumps(reply, default=str).encode() + b"\n")
+            except OSError as e:
+                logger.debug("registry client error: %s", e)
+
+
+def lookup_devices(usbmux: typing.Optional[Usbmux] = None, timeout: float = 1.0) -> typing.List[dict]:
+    """
+    Device list from a running `ioscmd registry`, or from usbmuxd when there is none
+    """
+    path = socket_path()
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.settimeout(timeout)
+                s.connect(path)
+                s.sendall(b"{}\n")
+                reply = json.loads(s.makefile("rb").readline())
+            if "devices" in reply:
+                return reply["devices"]
+        except (OSError, ValueError) as e:
+            logger.debug("registry unavailable: %s", e)
+    return (usbmux or Usbmux()).device_list()
+
+
+def serve(usbmux: typing.Optional[Usbmux] = None):
+    registry = DeviceRegistry(usbmux).start()
+    start = time.monotonic()
+    registry.wait_synced(10)
+    logger.info("registry synced in %.3fs", time.monotonic() - start)
+    try:
+        RegistryServer(registry).serve_forever()
+    finally:
+        registry.stop()
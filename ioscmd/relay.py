@@ -0,0 +1,238 @@
+"""
+Port forwarding from local tcp clients to a port of the device
+
+One selector loop serves every tunnel: the usbmux Connect handshake and the
+relay are both driven by socket readiness, no thread per connection.
+"""
+import errno
+import logging
+import plistlib
+import selectors
+import socket
+import time
+import typing
+
+from .exceptions import MuxReplyError
+from .sockets import USBMUX_HEADER, Usbmux, _check, _connect_request, body_length, create_socket, encode_packet
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 256 * 1024
+
+_HANDSHAKE = 0  # waiting for usbmuxd Connect reply, or tcp connect
+_RELAY = 1
+
+
+class _Tunnel:
+    def __init__(self, number: int, client: socket.socket, peer, device: socket.socket, state: int):
+        self.number = number
+        self.client = client
+        self.peer = peer
+        self.device = device
+        self.state = state
+        self.handshake = bytearray()
+        # pending[sock]: bytes waiting to be written to sock
+        self.pending = {client: b"", device: b""}
+        # eof[sock]: sock has been read to the end
+        self.eof = {client: False, device: False}
+        self.sent = 0  # client -> device
+        self.received = 0  # device -> client
+        self.start = time.monotonic()
+
+    def other(self, sock: socket.socket) -> socket.socket:
+        return self.device if sock is self.client else self.client
+
+
+class Relay:
+    """
+    Args:
+        usbmux: usbmuxd to connect through, required with devid
+        devid: DeviceID of the device
+        host: connect to host:device_port directly instead of through usbmux
+        report: called with one line for every closed tunnel
+    """
+
+    def __init__(self, local_port: int, device_port: int,
+                 usbmux: typing.Optional[Usbmux] = None,
+                 devid: typing.Optional[int] = None,
+                 host: typing.Optional[str] = None,
+                 bind: str = "127.0.0.1",
+                 report: typing.Callable[[str], None] = logger.info):
+        self._local = (bind, local_port)
+        self._device_port = device_port
+        self._usbmux = usbmux
+        self._devid = devid
+        self._host = host
+        self._report = report
+        self._selector = selectors.DefaultSelector()
+        self._tunnels = {}
+        self._count = 0
+
+    def serve_forever(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self._local)
+        listener.listen(128)
+        listener.setblocking(False)
+        self._selector.register(listener, selectors.EVENT_READ)
+        try:
+            while True:
+                for key, mask in self._selector.select():
+                    if key.fileobj is listener:
+                        self._accept(listener)
+                        continue
+                    tunnel = self._tunnels.get(key.fileobj)
+                    if tunnel is None:
+                        continue
+                    try:
+                        self._handle(tunnel, key.fileobj, mask)
+                    except OSError as e:
+                        logger.debug("tunnel #%d error: %s", tunnel.number, e)
+                        self._close(tunnel)
+        finally:
+            for tunnel in set(self._tunnels.values()):
+                self._close(tunnel)
+            self._selector.unregister(listener)
+            listener.close()
+            self._selector.close()
+
+    def _open_device(self) -> typing.Tuple[socket.socket, bool]:
+        """ Return (socket, True if a usbmux reply is expected) """
+        if self._host:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            err = sock.connect_ex((self._host, self._device_port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                raise OSError(err, "connect {}:{}".format(self._host, self._device_port))
+            return sock, False
+        sock = create_socket(self._usbmux.address)
+        header, body = encode_packet(_connect_request(self._devid, self._device_port), plistlib.FMT_XML, True)
+        sock.sendall(header + body)
+        sock.setblocking(False)
+        return sock, True
+
+    def _accept(self, listener: socket.socket):
+        try:
+            client, peer = listener.accept()
+        except BlockingIOError:
+            return
+        try:
+            device, usbmux = self._open_device()
+        except OSError as e:
+            logger.warning("connect device port %d failed: %s", self._device_port, e)
+            client.close()
+            return
+        client.setblocking(False)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._count += 1
+        tunnel = _Tunnel(self._count, client, peer, device, _HANDSHAKE)
+        self._tunnels[client] = tunnel
+        self._tunnels[device] = tunnel
+        self._selector.register(device, selectors.EVENT_READ if usbmux else selectors.EVENT_WRITE)
+        logger.debug("tunnel #%d opened for %s", tunnel.number, peer)
+
+    def _handle(self, tunnel: _Tunnel, sock: socket.socket, mask: int):
+        if tunnel.state == _HANDSHAKE:
+            self._handshake(tunnel, mask)
+            return
+        if mask & selectors.EVENT_WRITE:
+            self._flush(tunnel, sock)
+        if mask & selectors.EVENT_READ:
+            self._read(tunnel, sock)
+        if tunnel.client in self._tunnels:
+            self._update(tunnel)
+
+    def _handshake(self, tunnel: _Tunnel, mask: int):
+        device = tunnel.device
+        if mask & selectors.EVENT_WRITE:  # direct tcp connect finished
+            err = device.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, "connect device port failed")
+        else:
+            data = device.recv(BUFFER_SIZE)
+            if not data:
+                raise OSError("usbmuxd closed connection")
+            tunnel.handshake.extend(data)
+            if len(tunnel.handshake) < USBMUX_HEADER.size:
+                return
+            length = USBMUX_HEADER.size + body_length(bytes(tunnel.handshake[:USBMUX_HEADER.size]))
+            if len(tunnel.handshake) < length:
+                return
+            try:
+                _check(plistlib.loads(bytes(tunnel.handshake[USBMUX_HEADER.size:length])))
+            except MuxReplyError as e:
+                logger.warning("tunnel #%d: %s", tunnel.number, e.reply_code.name)
+                self._close(tunnel, report=False)
+                return
+            tunnel.pending[tunnel.client] = bytes(tunnel.handshake[length:])
+        tunnel.handshake = None
+        tunnel.state = _RELAY
+        if self._host:
+            device.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._selector.register(tunnel.client, selectors.EVENT_READ)
+        self._update(tunnel)
+
+    def _read(self, tunnel: _Tunnel, sock: socket.socket):
+        target = tunnel.other(sock)
+        if tunnel.pending[target] or tunnel.eof[sock]:
+            return
+        try:
+            data = sock.recv(BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            tunnel.eof[sock] = True
+            self._flush(tunnel, target)
+            return
+        if sock is tunnel.client:
+            tunnel.sent += len(data)
+        else:
+            tunnel.received += len(data)
+        tunnel.pending[target] = data
+        self._flush(tunnel, target)
+
+    def _flush(self, tunnel: _Tunnel, sock: socket.socket):
+        data = tunnel.pending[sock]
+        if data:
+            try:
+                n = sock.send(data)
+            except BlockingIOError:
+                n = 0
+            tunnel.pending[sock] = data[n:]
+        if not tunnel.pending[sock] and tunnel.eof[tunnel.other(sock)]:
+            try:
+                sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def _update(self, tunnel: _Tunnel):
+        if all(tunnel.eof.values()) and not any(tunnel.pending.values()):
+            self._close(tunnel)
+            return
+        for sock in (tunnel.client, tunnel.device):
+            events = 0
+            if not tunnel.eof[sock] and not tunnel.pending[tunnel.other(sock)]:
+                events |= selectors.EVENT_READ
+            if tunnel.pending[sock]:
+                events |= selectors.EVENT_WRITE
+            key = self._selector.get_map().get(sock)
+            if events == 0:
+                if key is not None:
+                    self._selector.unregister(sock)
+            elif key is None:
+                self._selector.register(sock, events)
+            elif key.events != events:
+                self._selector.modify(sock, events)
+
+    def _close(self, tunnel: _Tunnel, report: bool = True):
+        for sock in (tunnel.client, tunnel.device):
+            self._tunnels.pop(sock, None)
+            if sock in self._selector.get_map():
+                self._selector.unregister(sock)
+            sock.close()
+        if report:
+            elapsed = max(time.monotonic() - tunnel.start, 1e-6)
+            self._report("#{} {}:{} closed: sent {:.2f} MB, received {:.2f} MB in {:.2f}s ({:.2f} MB/s)".format(
+                tunnel.number, tunnel.peer[0], tunnel.peer[1], tunnel.sent / 1024 / 1024,
+                tunnel.received / 1024 / 1024, elapsed, (tunnel.sent + tunnel.received) / 1024 / 1024 / elapsed))
@@ -1,16 +1,22 @@
+import itertools
 import logging
 import os
 import plistlib
+import select
 import socket
 import struct
+import threading
+import time
 import typing
 import weakref
 from typing import Any, Union
 
-from .exceptions import SocketError, MuxReplyError
+from . import spans
+from .exceptions import SocketError, MuxReplyError, UsbmuxReplyCode
 from .utils import set_socket_timeout
 
 PROGRAM_NAME = "SSHCmd"
+LOCKDOWN_PORT = 0xf27e
 logger = logging.getLogger(__name__)
 
 
@@ -42,6 +48,35 @@ def create_socket(addr: Union[str, typing.Tuple[str, int], socket.socket, Any]):
         return sock
 
 
+# usbmuxd packets: length, version, message type, tag (little endian)
+USBMUX_HEADER = struct.Struct("IIII")
+# packets to a service on the device: big endian body length
+LOCKDOWN_HEADER = struct.Struct(">I")
+# below this a plain recv / joined sendall is cheaper than recv_into / sendmsg, see benchmarks/packets.py
+_SMALL_PACKET = 16 * 1024
+
+
+def encode_packet(payload: dict, fmt: plistlib.PlistFormat, first: bool, tag: int = 0,
+                  message_type: int = 8) -> typing.Tuple[bytes, bytes]:
+    """ Return (header, body) of a plist packet, usbmuxd header if first else lockdown header """
+    body_data = plistlib.dumps(payload, fmt=fmt, sort_keys=False)
+    if first:  # first package
+        # version: 1, request: 8(?), tag: 1(?)
+        header = USBMUX_HEADER.pack(USBMUX_HEADER.size + len(body_data), 1, message_type, tag)
+    else:
+        header = LOCKDOWN_HEADER.pack(len(body_data))
+    return header, body_data
+
+
+def body_length(header: Union[bytes, bytearray]) -> int:
+    """ body length of a packet from its usbmuxd or lockdown header """
+    if len(header) == USBMUX_HEADER.size:
+        (length, version, resp, tag) = USBMUX_HEADER.unpack(header)
+        return length - USBMUX_HEADER.size  # minus header length
+    (length,) = LOCKDOWN_HEADER.unpack(header)
+    return length
+
+
 class SafeStreamSocket:
     def __init__(self, addr: Union[str, typing.Tuple[str, int], socket.socket, Any]):
         """
@@ -100,13 +135,37 @@ class SafeStreamSocket:
         except Exception as e:
             raise SocketError("socket error") from e
 
-    def recvall(self, size: int) -> bytearray:
-        buf = bytearray()
-        while len(buf) < size:
-            chunk = self.recv(size - len(buf))
+    def recv_into(self, buffer: memoryview) -> int:
+        """recv data from socket into buffer, return number of bytes received
+        Raises:
+            SocketError
+        """
+        try:
+            return self._sock.recv_into(buffer)
+        except socket.timeout as e:
+            raise SocketError("socket timeout") from e
+        except Exception as e:
+            raise SocketError("socket error") from e
+
+    def recvall(self, size: int) -> Union[bytes, bytearray]:
+        if 0 < size <= _SMALL_PACKET:
+            # almost always there in one piece
+            chunk = self.recv(size)
+            if len(chunk) == size:
+                return chunk
             if not chunk:
                 raise SocketError("recvall: socket connection broken")
-            buf.extend(chunk)
+        else:
+            chunk = b""
+        buf = bytearray(size)
+        buf[:len(chunk)] = chunk
+        view = memoryview(buf)
+        received = len(chunk)
+        while received < size:
+            n = self.recv_into(view[received:])
+            if not n:
+                raise SocketError("recvall: socket connection broken")
+            received += n
         return buf
 
     def sendall(self, data: Union[bytes, bytearray]):
@@ -115,6 +174,23 @@ class SafeStreamSocket:
         except Exception as e:
             raise SocketError("sendall error") from e
 
+    def sendall_parts(self, *parts: Union[bytes, bytearray, memoryview]):
+        """ send several buffers with one sendmsg (scatter/gather), without joining them """
+        if not hasattr(self._sock, "sendmsg"):  # windows
+            return self.sendall(b"".join(parts))
+        views = [memoryview(p) for p in parts if len(p)]
+        try:
+            while views:
+                sent = self._sock.sendmsg(views)
+                while sent:
+                    if sent >= len(views[0]):
+                        sent -= len(views.pop(0))
+                    else:
+                        views[0] = views[0][sent:]
+                        sent = 0
+        except Exception as e:
+            raise SocketError("sendall error") from e
+
     def __enter__(self):
         return self
 
@@ -124,14 +200,21 @@ class SafeStreamSocket:
 
 
 class PlistSocket(SafeStreamSocket):
-    def __init__(self, addr: str, tag: int = 0):
+    def __init__(self, addr: str, tag: int = 0, binary: bool = False):
+        """
+        Args:
+            binary: encode outgoing packets as binary plist instead of XML,
+                incoming packets are always detected automatically
+        """
         super().__init__(addr)
         if isinstance(addr, PlistSocket):
             self._tag = addr._tag
             self._first = addr._first
+            self._fmt = addr._fmt
         else:
             self._tag = tag
             self._first = True
+            self._fmt = plistlib.FMT_BINARY if binary else plistlib.FMT_XML
         self.prepare()
 
     def prepare(self):
@@ -145,30 +228,35 @@ class PlistSocket(SafeStreamSocket):
             # The following args only used in the first request
             message_type: 8 (Plist)
         """
-
-        body_data = plistlib.dumps(payload)
-        if self._first:  # first package
-            length = 16 + len(body_data)
-            header = struct.pack(
-                "IIII", length, 1, message_type,
-                self._tag)  # version: 1, request: 8(?), tag: 1(?)
+        header, body_data = encode_packet(payload, self._fmt, self._first, self._tag, message_type)
+        self.send_encoded(header, body_data)
+
+    def send_usbmux_packet(self, payload: dict, tag: int, message_type: int = 8):
+        """ send with the usbmuxd header whatever was sent before, for control connections which stay usbmuxd """
+        header, body_data = encode_packet(payload, self._fmt, True, tag, message_type)
+        self.send_encoded(header, body_data)
+
+    def send_encoded(self, header: bytes, body_data: bytes):
+        """ a packet of encode_packet, small ones joined since the copy costs less than sendmsg """
+        if len(body_data) <= _SMALL_PACKET:
+            self.sendall(header + body_data)
         else:
-            header = struct.pack(">I", len(body_data))
-        self.sendall(header + body_data)
+            self.sendall_parts(header, body_data)
+
+    def recv_usbmux_packet(self) -> typing.Tuple[int, dict]:
+        """ Return (tag, payload) of a packet with the usbmuxd header """
+        header = self.recvall(USBMUX_HEADER.size)
+        _, _, _, tag = USBMUX_HEADER.unpack(header)
+        return tag, plistlib.loads(self.recvall(body_length(header)))
 
     def recv_packet(self, header_size=None) -> dict:
         if self._first or header_size == 16:  # first receive
-            header = self.recvall(16)
-            (length, version, resp, tag) = struct.unpack("IIII", header)
-            length -= 16  # minus header length
+            header = self.recvall(USBMUX_HEADER.size)
             self._first = False
         else:
-            header = self.recvall(4)
-            (length,) = struct.unpack(">I", header)
-
-        body_data = self.recvall(length)
-        payload = plistlib.loads(body_data)
-        return payload
+            header = self.recvall(LOCKDOWN_HEADER.size)
+        body_data = self.recvall(body_length(header))
+        return plistlib.loads(body_data)
 
 
 class PlistSocketProxy:
@@ -232,8 +320,135 @@ def _check(data: dict):
         raise MuxReplyError(data['Number'])
 
 
+def _list_devices_request() -> dict:
+    return {
+        "MessageType": "ListDevices",  # 必选
+        "ClientVersionString": "libusbmuxd 1.1.0",
+        "ProgName": PROGRAM_NAME,
+        "kLibUSBMuxVersion": 3,
+        # "ProcessID": 0, # Xcode send it processID
+    }
+
+
+def _parse_device_list(data: dict) -> typing.List[dict]:
+    result = {}
+    for item in data['DeviceList']:
+        prop = item['Properties']
+        prop['ConnectionType'] = prop['ConnectionType'].lower()  # 兼容旧代码
+        result[prop.get("UDID")] = prop
+    return list(result.values())
+
+
+def _read_buid_request() -> dict:
+    return {
+        'ClientVersionString': 'libusbmuxd 1.1.0',
+        'MessageType': 'ReadBUID',
+        'ProgName': PROGRAM_NAME,
+        'kLibUSBMuxVersion': 3
+    }
+
+
+def _listen_request() -> dict:
+    return {
+        'ClientVersionString': 'qt4i-usbmuxd',
+        'MessageType': 'Listen',
+        'ProgName': 'tcprelay'
+    }
+
+
+def _connect_request(devid: int, port: int) -> dict:
+    return {
+        'DeviceID': devid,  # Required
+        'MessageType': 'Connect',  # Required
+        'PortNumber': socket.htons(port),  # Required, Same as: ((port & 0xff) << 8) | (port >> 8)
+        'ProgName': PROGRAM_NAME,
+    }
+
+
+def _get_value_request(key: typing.Optional[str] = None, domain: typing.Optional[str] = None) -> dict:
+    """ without key the whole dictionary of domain, without both every value of the device """
+    request = {
+        "Request": "GetValue",
+        "Label": PROGRAM_NAME,
+    }
+    if domain is not None:
+        request["Domain"] = domain
+    if key is not None:
+        request["Key"] = key
+    return request
+
+
+def _env_address() -> typing.Optional[str]:
+    """ USBMUXD_SOCKET_ADDRESS as libusbmuxd reads it: UNIX:/path/to/socket or host:port """
+    value = os.environ.get("USBMUXD_SOCKET_ADDRESS")
+    if not value:
+        return None
+    if value.upper().startswith("UNIX:"):
+        return value[len("UNIX:"):]
+    return value
+
+
+def _idle_alive(sock: socket.socket) -> bool:
+    """ an idle control connection has nothing to read, readable means closed by usbmuxd or out of sync """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+class _ControlPool:
+    """
+    Idle usbmuxd connections for requests which leave the connection usable (ListDevices, ReadBUID)
+
+    Connect and Listen turn a connection into a tunnel or an event stream, they never come from here.
+    """
+
+    def __init__(self, connect: typing.Callable[[], PlistSocket], size: int):
+        self._connect = connect
+        self._size = size
+        self._idle: typing.List[PlistSocket] = []
+        self._lock = threading.Lock()
+
+    def acquire(self, reuse: bool = True) -> typing.Tuple[PlistSocket, bool]:
+        """ Return (connection, whether it was reused) """
+        while reuse:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if _idle_alive(conn.get_socket()):
+                return conn, True
+            conn.close()
+        return self._connect(), False
+
+    def release(self, conn: PlistSocket, reusable: bool):
+        """ keep conn for the next request, close it when the pool is full or the request failed """
+        if reusable:
+            with self._lock:
+                if len(self._idle) < self._size:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
 class Usbmux:
-    def __init__(self, address: typing.Optional[Union[str, tuple]] = None):
+    def __init__(self, address: typing.Optional[Union[str, tuple]] = None, binary: bool = False,
+                 pool_size: int = 2):
+        """
+        Args:
+            address: defaults to $USBMUXD_SOCKET_ADDRESS, then the usbmuxd of the platform
+            binary: send binary plist to usbmuxd and lockdownd instead of XML
+            pool_size: idle control connections kept for reuse, 0 closes each after its request
+        """
+        if address is None:
+            address = _env_address()
         if address is None:
             if os.name == "posix":  # linux or darwin
                 address = "/var/run/usbmuxd"
@@ -243,7 +458,10 @@ class Usbmux:
                 raise EnvironmentError("Unsupported os.name", os.name)
 
         self.__address = address
-        self.__tag = 0
+        self.__tags = itertools.count(1)
+        self.__binary = binary
+        self._pool = _ControlPool(lambda: PlistSocket(self.__address, 0, self.__binary), pool_size)
+        self._finalizer = weakref.finalize(self, self._pool.close)
 
     @property
     def address(self) -> str:
@@ -253,19 +471,56 @@ class Usbmux:
         return f"{ip}:{port}"
 
     def _next_tag(self) -> int:
-        self.__tag += 1
-        return self.__tag
+        return next(self.__tags)
+
+    def close(self):
+        """ close the idle control connections """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def create_connection(self) -> PlistSocketProxy:
-        psock = PlistSocket(self.__address, self._next_tag())
+        psock = PlistSocket(self.__address, self._next_tag(), self.__binary)
         return PlistSocketProxy(psock)
 
     def send_recv(self, payload: dict, timeout: float = None) -> dict:
-        s = self.create_connection()
-        data = s.send_recv_packet(payload, timeout)
-        _check(data)
+        with spans.span("usbmux." + payload.get("MessageType", "request")):
+            conn, reused = self._pool.acquire()
+            try:
+                data = self._pooled_request(conn, payload, timeout)
+            except SocketError:
+                # usbmuxd may close an idle connection right after the health check
+                if not reused:
+                    raise
+                conn, _ = self._pool.acquire(reuse=False)
+                data = self._pooled_request(conn, payload, timeout)
+            _check(data)
+            return data
+
+    def _pooled_request(self, conn: PlistSocket, payload: dict, timeout: typing.Optional[float]) -> dict:
+        """ send payload on conn and hand conn back to the pool, it is closed if the request failed """
+        reusable = False
+        try:
+            data = self._request(conn, payload, timeout)
+            reusable = True
+        finally:
+            self._pool.release(conn, reusable)
         return data
 
+    def _request(self, conn: PlistSocket, payload: dict, timeout: typing.Optional[float]) -> dict:
+        tag = self._next_tag()
+        with set_socket_timeout(conn.get_socket(), timeout):
+            conn.send_usbmux_packet(payload, tag)
+            while True:
+                reply_tag, data = conn.recv_usbmux_packet()
+                if reply_tag == tag:
+                    return data
+                logger.debug("drop usbmuxd reply with tag %d, waiting for %d", reply_tag, tag)
+
     def device_list(self) -> typing.List[Any]:
         """
         Return DeviceInfo and contains bother USB and NETWORK device
@@ -282,32 +537,15 @@ class Usbmux:
                             'UDID': '539c5fffb18f2be0bf7f771d68f7c327fb68d2d9',
                             'USBSerialNumber': '539c5fffb18f2be0bf7f771d68f7c327fb68d2d9'}}]}
         """
-        payload = {
-            "MessageType": "ListDevices",  # 必选
-            "ClientVersionString": "libusbmuxd 1.1.0",
-            "ProgName": PROGRAM_NAME,
-            "kLibUSBMuxVersion": 3,
-            # "ProcessID": 0, # Xcode send it processID
-        }
-        data = self.send_recv(payload, timeout=10)
-        result = {}
-        for item in data['DeviceList']:
-            prop = item['Properties']
-            prop['ConnectionType'] = prop['ConnectionType'].lower()  # 兼容旧代码
-            result[prop.get("UDID")] = prop
-        return list(result.values())
+        data = self.send_recv(_list_devices_request(), timeout=10)
+        return _parse_device_list(data)
 
     def device_udid_list(self) -> typing.List[str]:
         return [d['UDID'] for d in self.device_list()]
 
     def read_system_BUID(self) -> str:
         """ BUID is always same """
-        data = self.send_recv({
-            'ClientVersionString': 'libusbmuxd 1.1.0',
-            'MessageType': 'ReadBUID',
-            'ProgName': PROGRAM_NAME,
-            'kLibUSBMuxVersion': 3
-        })
+        data = self.send_recv(_read_buid_request())
         return data['BUID']
 
     def watch_device(self) -> typing.Iterator[dict]:
@@ -322,11 +560,7 @@ class Usbmux:
             'SerialNumber': 'xxx.xxx', 'USBSerialNumber': 'xxxx..xxx'}}
         """
         with self.create_connection() as s:
-            s.send_packet({
-                'ClientVersionString': 'qt4i-usbmuxd',
-                'MessageType': 'Listen',
-                'ProgName': 'tcprelay'
-            })
+            s.send_packet(_listen_request())
             data = s.recv_packet()
             _check(data)
 
@@ -334,35 +568,68 @@ class Usbmux:
                 data = s.recv_packet(header_size=16)
                 yield data
 
-    def connect_device_port(self, devid: int, port: int) -> PlistSocketProxy:
+    def connect_device_port(self, devid: int, port: int, timeout: float = 10.0) -> PlistSocketProxy:
         """
         Create connection to mobile phone
         """
-        _port = socket.htons(port)
-        # Same as: ((port & 0xff) << 8) | (port >> 8)
-        del port
-
         conn = self.create_connection()
-        payload = {
-            'DeviceID': devid,  # Required
-            'MessageType': 'Connect',  # Required
-            'PortNumber': _port,  # Required
-            'ProgName': PROGRAM_NAME,
-        }
+        payload = _connect_request(devid, port)
 
         logger.debug("Send payload: %s", payload)
-        data = conn.send_recv_packet(payload)
-        _check(data)
-        logger.debug("connected to port: %d", _port)
+        try:
+            with spans.span("usbmux.Connect", port=port):
+                data = conn.send_recv_packet(payload, timeout)
+                _check(data)
+        except Exception:
+            conn.close()
+            raise
+        logger.debug("connected to port: %d", port)
         return conn
 
-    def get_deviceInfo(self, devid: int) -> dict:
-        request = {
-            "Request": "GetValue",
-            "Label": PROGRAM_NAME,
-        }
-        with self.connect_device_port(devid, 0xf27e) as s:
-            ret = s.send_recv_packet(request)
+    def wait_device_port(self, devid: int, port: int,
+                         timeout: float = 10.0,
+                         interval: float = 0.05,
+                         max_interval: float = 1.0,
+                         attempt_timeout: float = 10.0) -> PlistSocketProxy:
+        """
+        Connect to device port as soon as it is ready
+
+        Retry with exponential backoff while usbmuxd replies ConnectionRefused,
+        until timeout seconds have elapsed. No attempt waits for its reply
+        longer than attempt_timeout or past that deadline.
+
+        Raises:
+            MuxReplyError
+            SocketError when usbmuxd did not answer in time
+        """
+        with spans.span("usbmux.wait_port", port=port):
+            return self._wait_device_port(devid, port, timeout, interval, max_interval, attempt_timeout)
+
+    def _wait_device_port(self, devid: int, port: int, timeout: float, interval: float,
+                          max_interval: float, attempt_timeout: float) -> PlistSocketProxy:
+        start = time.monotonic()
+        deadline = start + timeout
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                # at least a moment for the last attempt, a zero timeout would make the socket non-blocking
+                remaining = max(deadline - time.monotonic(), 0.001)
+                conn = self.connect_device_port(devid, port, min(remaining, attempt_timeout))
+            except MuxReplyError as e:
+                now = time.monotonic()
+                if e.reply_code != UsbmuxReplyCode.ConnectionRefused or now >= deadline:
+                    raise
+                time.sleep(min(interval, deadline - now))
+                interval = min(interval * 2, max_interval)
+                continue
+            logger.debug("port %d ready after %d attempt(s), %.3fs",
+                         port, attempt, time.monotonic() - start)
+            return conn
+
+    def get_deviceInfo(self, devid: int, timeout: float = 10.0) -> dict:
+        with spans.span("lockdown.GetValue"), self.connect_device_port(devid, LOCKDOWN_PORT, timeout) as s:
+            ret = s.send_recv_packet(_get_value_request(), timeout)
             return ret['Value']
     #
     # def get_serial(self, devid: int) -> str:
@@ -0,0 +1,133 @@
+"""
+Timing of the phases of a command: usbmux requests, ssh handshake, sftp and exec traffic
+
+    with spans.span("sftp.put", bytes=size):
+        ...
+
+Nothing is measured until a hook is registered, span() then returns a shared
+no-op object. `ioscmd --profile` registers a Collector and prints its report,
+a long running controller can add_hook() its own callback instead.
+"""
+import threading
+import time
+import typing
+
+
+class Span:
+    """ one finished or running phase, hooks receive it when it ends """
+    __slots__ = ("name", "start", "duration", "bytes", "attrs", "error", "parent")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.bytes = attrs.pop("bytes", 0)
+        self.error = None
+        self.parent = None
+        self.start = 0.0
+        self.duration = 0.0
+
+    def add_bytes(self, size: int):
+        self.bytes += size
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        _stack().pop()
+        for hook in _hooks:
+            hook(self)
+        return False
+
+    def as_dict(self) -> dict:
+        return {"name": self.name, "parent": self.parent, "seconds": self.duration, "bytes": self.bytes,
+                "error": self.error, "attrs": self.attrs}
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def add_bytes(self, size: int):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+_hooks = []  # replaced, not mutated, so a running span iterates a stable list
+_hooks_lock = threading.Lock()
+_local = threading.local()
+
+
+def _stack() -> typing.List[Span]:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def enabled() -> bool:
+    return bool(_hooks)
+
+
+def span(name: str, **attrs) -> typing.Union[Span, _NullSpan]:
+    """ context manager timing name, attrs (and bytes=) are passed on to the hooks """
+    if not _hooks:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def add_hook(hook: typing.Callable[[Span], None]):
+    """ call hook(span) for every span which ends, from the thread which ran it """
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + [hook]
+
+
+def remove_hook(hook: typing.Callable[[Span], None]):
+    global _hooks
+    with _hooks_lock:
+        _hooks = [h for h in _hooks if h is not hook]
+
+
+class Collector:
+    """ hook which sums time and bytes per phase name """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}  # name: {'count', 'seconds', 'bytes', 'errors', 'first'}
+        self._start = time.perf_counter()
+
+    def __call__(self, s: Span):
+        with self._lock:
+            phase = self._phases.get(s.name)
+            if phase is None:
+                phase = self._phases[s.name] = {"name": s.name, "parent": s.parent, "count": 0, "seconds": 0.0,
+                                                "bytes": 0, "errors": 0, "first": s.start}
+            phase["count"] += 1
+            phase["seconds"] += s.duration
+            phase["bytes"] += s.bytes
+            phase["errors"] += s.error is not None
+
+    def report(self) -> dict:
+        with self._lock:
+            phases = sorted(self._phases.values(), key=lambda p: p["first"])
+            result = []
+            for p in phases:
+                item = {k: v for k, v in p.items() if k != "first"}
+                item["seconds"] = round(item["seconds"], 6)
+                item["start"] = round(p["first"] - self._start, 6)
+                if item["bytes"] and item["seconds"]:
+                    item["mb_per_s"] = round(item["bytes"] / 1024 / 1024 / item["seconds"], 2)
+                result.append(item)
+        return {"total_seconds": round(time.perf_counter() - self._start, 6), "phases": result}
@@ -1,35 +1,240 @@
+import contextlib
 import os
 import re
 import select
-import subprocess
+import signal
+import socket
 import sys
 import termios
 import time
 import tty
+import typing
 
 import paramiko
 from paramiko.config import SSH_PORT
 
+from ioscmd import spans
 from ioscmd.exceptions import AuthenticationException
+from ioscmd.profiles import AUTO, PROFILES, profile_for, transport_factory
+from ioscmd.registry import DeviceRegistry, lookup_devices
 from ioscmd.sockets import Usbmux
 
 
-def resize_pty(channel):
+# 一次读写的最大字节数, 粘贴大段文本和大量输出时不再逐字节处理
+BUFFER_SIZE = 64 * 1024
+
+
+def terminal_size(fd: int) -> typing.Tuple[int, int]:
+    """ (width, height) of the terminal on fd, read with the TIOCGWINSZ ioctl """
+    try:
+        size = os.get_terminal_size(fd)
+    except OSError:
+        return 80, 24
+    return size.columns or 80, size.lines or 24
+
+
+def resize_pty(channel, fd: int = None):
     # resize to match terminal size
-    tty_height, tty_width = subprocess.check_output(['stty', 'size']).split()
+    width, height = terminal_size(sys.stdout.fileno() if fd is None else fd)
     try:
-        channel.resize_pty(width=int(tty_width), height=int(tty_height))
-    except paramiko.ssh_exception.SSHException:
+        channel.resize_pty(width=width, height=height)
+    except (paramiko.ssh_exception.SSHException, EOFError):
         pass
 
 
+@contextlib.contextmanager
+def _winch_pipe():
+    """ read end of a pipe which becomes readable when the terminal is resized """
+    r, w = os.pipe()
+    os.set_blocking(r, False)
+    os.set_blocking(w, False)
+
+    def on_winch(signum, frame):
+        try:
+            os.write(w, b"\0")
+        except OSError:
+            pass
+
+    try:
+        previous = signal.signal(signal.SIGWINCH, on_winch)
+    except (ValueError, AttributeError):  # not the main thread, or no SIGWINCH
+        previous = None
+    try:
+        yield r
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGWINCH, previous)
+        os.close(r)
+        os.close(w)
+
+
+def interactive_shell(client):
+    """ bridge local terminal and a channel opened by invoke_shell """
+    oldtty_attrs = termios.tcgetattr(sys.stdin)
+    stdin_fileno = sys.stdin.fileno()
+    stdout_fileno = sys.stdout.fileno()
+    sys.stdout.flush()
+    try:
+        # 将现在的操作终端属性设置为服务器上的原生终端属性,可以支持tab了
+        tty.setraw(stdin_fileno)
+        tty.setcbreak(stdin_fileno)
+        client.settimeout(0)
+        with _winch_pipe() as winch:
+            resize_pty(client, stdout_fileno)
+            pending = b""  # stdin data the channel window did not take yet
+            stdin_eof = False
+            while True:
+                watch = [client, winch]
+                if not pending and not stdin_eof:
+                    watch.append(stdin_fileno)
+                # 窗口满时稍后重试发送
+                read, _, _ = select.select(watch, [], [], 0.01 if pending else None)
+                if winch in read:
+                    # 终端大小变化时才调整, 不再每次循环都去查询
+                    try:
+                        os.read(winch, 4096)
+                    except BlockingIOError:
+                        pass
+                    resize_pty(client, stdout_fileno)
+
+                # 如果是用户输入命令了,stdin发生变化, 一次读出所有已输入的内容
+                if stdin_fileno in read:
+                    pending = os.read(stdin_fileno, BUFFER_SIZE)
+                    stdin_eof = not pending
+                if pending:
+                    try:
+                        pending = pending[client.send(pending):]
+                    except socket.timeout:
+                        pass
+
+                # 服务器返回了结果,channel通道接受到结果,发生变化 select感知到
+                if client in read:
+                    try:
+                        result = client.recv(BUFFER_SIZE)
+                    except socket.timeout:
+                        continue
+                    # 断开连接后退出
+                    if len(result) == 0:
+                        break
+                    # 输出到屏幕
+                    view = memoryview(result)
+                    while view:
+                        view = view[os.write(stdout_fileno, view):]
+    finally:
+        # 执行完后将现在的终端属性恢复为原操作终端属性
+        termios.tcsetattr(sys.stdin, termios.TCSAFLUSH, oldtty_attrs)
+
+
+def stream_command(client, command: str, stdin: typing.BinaryIO = None,
+                   stdout: typing.BinaryIO = None, stderr: typing.BinaryIO = None) -> int:
+    """
+    Run command and copy its stdout and stderr as raw bytes, return the exit status
+
+    Args:
+        stdin: forwarded to the command until eof, None closes the command stdin
+        stdout, stderr: default to sys.stdout.buffer and sys.stderr.buffer at call time
+    """
+    with spans.span("exec", command=command[:80]) as span:
+        return _stream_command(client, command, stdin, stdout, stderr, span)
+
+
+def _stream_command(client, command, stdin, stdout, stderr, span) -> int:
+    stdout = stdout or sys.stdout.buffer
+    stderr = stderr or sys.stderr.buffer
+    # closing the stdin file, also when it is garbage collected, sends eof
+    remote_stdin, out, _ = client.exec_command(command)
+    chan = out.channel
+    chan.settimeout(0)
+    stdin_fileno = stdin.fileno() if stdin is not None else None
+    if stdin_fileno is None:
+        remote_stdin.close()
+    pending = b""
+    stdout_eof = stderr_eof = False
+    while not (stdout_eof and stderr_eof):
+        watch = [chan]
+        if stdin_fileno is not None and not pending:
+            watch.append(stdin_fileno)
+        read, _, _ = select.select(watch, [], [], 0.01 if pending else None)
+        if stdin_fileno in read:
+            pending = os.read(stdin_fileno, BUFFER_SIZE)
+            if not pending:
+                stdin_fileno = None
+                remote_stdin.close()
+        if pending:
+            try:
+                sent = chan.send(pending)
+                span.add_bytes(sent)
+                pending = pending[sent:]
+            except socket.timeout:
+                pass
+        if chan not in read:
+            continue
+        # stderr first, it is usually smaller and should not wait behind stdout
+        while not stderr_eof:
+            try:
+                data = chan.recv_stderr(BUFFER_SIZE)
+            except socket.timeout:
+                break
+            stderr_eof = not data
+            span.add_bytes(len(data))
+            stderr.write(data)
+            stderr.flush()
+        while not stdout_eof:
+            try:
+                data = chan.recv(BUFFER_SIZE)
+            except socket.timeout:
+                break
+            stdout_eof = not data
+            span.add_bytes(len(data))
+            stdout.write(data)
+            stdout.flush()
+    chan.settimeout(None)
+    status = chan.recv_exit_status()
+    chan.close()
+    # like ssh, 255 when the connection did not report a status
+    return status if status >= 0 else 255
+
+
+def _tcp_connection(host: str, port, timeout: float) -> socket.socket:
+    """ without Nagle, every exec request and its reply would wait for a delayed ack """
+    sock = socket.create_connection((host, int(port)), timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _timed_kex(factory):
+    """ wrap a transport factory, so the key exchange of the new transport is a span of its own """
+
+    def timed_factory(sock, **kwargs):
+        transport = factory(sock, **kwargs)
+        start_client = transport.start_client
+
+        def timed_start_client(*args, **kw):
+            with spans.span("ssh.kex"):
+                return start_client(*args, **kw)
+
+        transport.start_client = timed_start_client
+        return transport
+
+    return timed_factory
+
+
 class SSH(paramiko.SSHClient):
 
-    def __init__(self):
+    def __init__(self, connect_timeout: float = 10.0, registry: DeviceRegistry = None, profile: str = AUTO):
         paramiko.SSHClient.__init__(self)
+        # name in profiles.PROFILES, or auto to pick by link type
+        self.profile = profile
+        self.link_profile = None
+        self._connect_args = None
+        # long running callers share one registry instead of listing devices on every connect
+        self.registry = registry
         self.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self._info = None
         self._relay = None
+        self.connect_timeout = connect_timeout
+        # seconds spent waiting for the usbmux tunnel, None for direct ip
+        self.proxy_elapsed = None
 
     def __del__(self):
         self.close()
@@ -47,18 +252,54 @@ class SSH(paramiko.SSHClient):
             username=None,
             password=None, *args
     ):
+        self._connect_args = dict(hostname=hostname, port=port, username=username, password=password)
+        with spans.span("ssh.connect"):
+            self._connect(hostname, port, username, password, *args)
+
+    def _connect(self, hostname, port, username, password, *args):
         ip_pattern = r'\b(?:\d{1,3}\.){3}\d{1,3}\b'
-        socket = None
         if not hostname or not re.match(ip_pattern, hostname):
-            socket = self._create_proxy(hostname, port)
+            sock = self._create_proxy(hostname, port)
+        else:
+            sock = _tcp_connection(hostname, port, self.connect_timeout)
+        if self.profile == AUTO:
+            self.link_profile = profile_for(self._info['ConnectionType'] if self._info else None)
+        else:
+            self.link_profile = PROFILES[self.profile]
+        factory = transport_factory(self.link_profile)
+        if spans.enabled():
+            factory = _timed_kex(factory)
         try:
-            super().connect(hostname=hostname, port=port, username=username, password=password, sock=socket, *args)
+            super().connect(hostname=hostname, port=port, username=username, password=password, sock=sock,
+                            compress=self.link_profile.compress, transport_factory=factory, *args)
         except paramiko.ssh_exception.AuthenticationException:
             raise AuthenticationException('SSH connection failed')
 
+    def _auth(self, *args, **kwargs):
+        with spans.span("ssh.auth"):
+            return super()._auth(*args, **kwargs)
+
+    def open_sftp(self) -> paramiko.SFTPClient:
+        with spans.span("sftp.open"):
+            return super().open_sftp()
+
+    def exec_command(self, command, *args, **kwargs):
+        with spans.span("ssh.exec_open"):
+            return super().exec_command(command, *args, **kwargs)
+
+    def reconnect(self):
+        """ connect again with the arguments of the last connect, after the connection dropped """
+        self.close()
+        self._info = None
+        self.connect(**self._connect_args)
+
     def _create_proxy(self, host, port):
-        _usbmux = Usbmux()
-        devices = _usbmux.device_list()
+        with Usbmux() as _usbmux:
+            return self._open_tunnel(_usbmux, host, port)
+
+    def _open_tunnel(self, _usbmux: Usbmux, host, port):
+        with spans.span("device.lookup"):
+            devices = self.registry.device_list() if self.registry else lookup_devices(_usbmux)
         if host is None:
             if len(devices) >= 2:
                 raise AuthenticationException("More than 2 usb devices detected")
@@ -71,40 +312,11 @@ class SSH(paramiko.SSHClient):
                     self._info = d
         if self._info is None:
             raise AuthenticationException('Device not found')
-        time.sleep(2)
-        conn = _usbmux.connect_device_port(self._info['DeviceID'], int(port))
+        start = time.monotonic()
+        conn = _usbmux.wait_device_port(self._info['DeviceID'], int(port), timeout=self.connect_timeout)
+        self.proxy_elapsed = time.monotonic() - start
         self._socket = conn
         return conn.get_socket()
 
     def __call__(self, *args, **kwargs):
-        oldtty_attrs = termios.tcgetattr(sys.stdin)
-        client = self.invoke_shell()
-        try:
-            stdin_fileno = sys.stdin.fileno()
-            # 将现在的操作终端属性设置为服务器上的原生终端属性,可以支持tab了
-            tty.setraw(stdin_fileno)
-            tty.setcbreak(stdin_fileno)
-            client.settimeout(0)
-            while True:
-                resize_pty(client)
-                read, wr, err = select.select([client, sys.stdin, ], [], [])
-                # 如果是用户输入命令了,sys.stdin发生变化
-                if sys.stdin in read:
-                    # 获取输入的内容，输入一个字符发送1个字符
-                    char = os.read(stdin_fileno, 1)
-                    # 将命令发送给服务器
-                    client.send(char)
-
-                # 服务器返回了结果,channel通道接受到结果,发生变化 select感知到
-                if client in read:
-                    # 获取结果
-                    result = client.recv(1024)
-                    # 断开连接后退出
-                    if len(result) == 0:
-                        break
-                    # 输出到屏幕
-                    sys.stdout.buffer.write(result)
-                    sys.stdout.buffer.flush()
-        finally:
-            # 执行完后将现在的终端属性恢复为原操作终端属性
-            termios.tcsetattr(sys.stdin, termios.TCSAFLUSH, oldtty_attrs)
+        interactive_shell(self.invoke_shell())
@@ -0,0 +1,587 @@
+import concurrent.futures
+import hashlib
+import os
+import posixpath
+import random
+import re
+import shlex
+import sys
+import tarfile
+import threading
+import time
+import typing
+from pathlib import Path
+
+import paramiko
+
+from . import spans, walk
+from .cache import cache_dir, read_json, write_json
+from .exceptions import BaseError
+
+# keep each remote command line well below ARG_MAX of the device
+_MAX_COMMAND = 64 * 1024
+
+
+class TransferError(BaseError):
+    pass
+
+
+class TransferStats:
+    """ Aggregate counters of a transfer, safe to update from worker threads """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, size: int, files: int = 1):
+        with self._lock:
+            self.files += files
+            self.bytes += size
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    def summary(self) -> str:
+        elapsed = max(self.elapsed, 1e-6)
+        mb = self.bytes / 1024 / 1024
+        return "{} files, {:.2f} MB in {:.2f}s ({:.1f} files/s, {:.2f} MB/s)".format(
+            self.files, mb, elapsed, self.files / elapsed, mb / elapsed)
+
+
+class SFTPPool:
+    """
+    Run tasks on several SFTP channels of one transport
+
+    Every worker thread opens its own channel with client.open_sftp()
+    """
+
+    def __init__(self, client, jobs: int = 1):
+        self._client = client
+        self._jobs = max(1, jobs)
+        self._local = threading.local()
+        self._sftps = []
+        self._lock = threading.Lock()
+
+    def sftp(self) -> paramiko.SFTPClient:
+        sftp = getattr(self._local, "sftp", None)
+        if sftp is None:
+            sftp = self._client.open_sftp()
+            self._local.sftp = sftp
+            with self._lock:
+                self._sftps.append(sftp)
+        return sftp
+
+    def map(self, func: typing.Callable[[paramiko.SFTPClient, typing.Any], typing.Any], items: typing.Iterable,
+            done: typing.Optional[typing.Callable[[], None]] = None):
+        """
+        call func(sftp, item) for every item, stop at the first error
+
+        done is called after each item from the calling thread, so what it
+        writes follows the stdout / stderr routing of fanout
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = [executor.submit(lambda item: func(self.sftp(), item), item) for item in items]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    if done is not None:
+                        done()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def close(self):
+        with self._lock:
+            for sftp in self._sftps:
+                sftp.close()
+            self._sftps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_command(client, cmd: str) -> bytes:
+    """ run cmd on device, return stdout
+
+    Raises:
+        TransferError when exit status is not zero
+    """
+    with spans.span("exec.run", command=cmd[:80]) as span:
+        _, stdout, stderr = client.exec_command(cmd)
+        output = stdout.read()
+        error = stderr.read()
+        status = stdout.channel.recv_exit_status()
+        span.add_bytes(len(output) + len(error))
+    if status != 0:
+        raise TransferError("{!r} exit {}: {}".format(cmd[:80], status, error.decode(errors="replace").strip()))
+    return output
+
+
+def _batched_commands(prefix: str, args: typing.List[str]) -> typing.Iterator[str]:
+    cmd = prefix
+    for arg in args:
+        quoted = " " + shlex.quote(arg)
+        if cmd != prefix and len(cmd) + len(quoted) > _MAX_COMMAND:
+            yield cmd
+            cmd = prefix
+        cmd += quoted
+    if cmd != prefix:
+        yield cmd
+
+
+def remote_makedirs(client, dirs: typing.Iterable[str]):
+    """ create remote directories with as few round trips as possible """
+    for cmd in _batched_commands("mkdir -p", sorted(set(dirs))):
+        run_command(client, cmd)
+    for path in set(dirs):
+        walk.forget(client, path)
+
+
+def remote_remove(client, root: str, paths: typing.List[str]):
+    """ rm -rf paths relative to root """
+    for cmd in _batched_commands("cd {} && rm -rf --".format(shlex.quote(root)), paths):
+        run_command(client, cmd)
+    walk.forget(client, root)
+
+
+def print_progress(stats: TransferStats, total_files: int, total_bytes: int):
+    """ one line progress on a terminal, nothing when redirected """
+    if not sys.stderr.isatty():
+        return
+    sys.stderr.write("\r{}/{} files, {:.1f}/{:.1f} MB".format(
+        stats.files, total_files, stats.bytes / 1024 / 1024, total_bytes / 1024 / 1024))
+    sys.stderr.flush()
+
+
+class Entry(typing.NamedTuple):
+    is_dir: bool
+    size: int
+    mtime: int
+
+
+def local_tree(root: str) -> typing.Dict[str, Entry]:
+    """ Return {relative posix path: Entry} of everything below root """
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        prefix = "" if rel == "." else "/".join(Path(rel).parts) + "/"
+        for name in dirnames:
+            st = os.stat(os.path.join(dirpath, name))
+            tree[prefix + name] = Entry(True, 0, int(st.st_mtime))
+        for name in filenames:
+            st = os.stat(os.path.join(dirpath, name))
+            tree[prefix + name] = Entry(False, st.st_size, int(st.st_mtime))
+    return tree
+
+
+def remote_tree(client, root: str) -> typing.Dict[str, Entry]:
+    """
+    Same as local_tree for a remote directory
+
+    Raises:
+        FileNotFoundError when root does not exist, NotADirectoryError when it is not a directory
+    """
+    tree = {}
+    for entry in walk.walk(client, root):
+        tree[entry.path] = Entry(entry.is_dir, 0 if entry.is_dir else entry.size, int(entry.mtime))
+    return tree
+
+
+def changed_files(source: typing.Dict[str, Entry], target: typing.Dict[str, Entry],
+                  compare_mtime: bool = True) -> typing.List[str]:
+    """ files of source which are missing or different in target """
+    result = []
+    for path, entry in source.items():
+        if entry.is_dir:
+            continue
+        other = target.get(path)
+        if other is None or other.is_dir or other.size != entry.size or \
+                (compare_mtime and other.mtime != entry.mtime):
+            result.append(path)
+    return result
+
+
+def extraneous(source: typing.Dict[str, Entry], target: typing.Dict[str, Entry]) -> typing.List[str]:
+    """ top most paths of target which do not exist in source """
+    result = []
+    for path in sorted(target):
+        if path in source and source[path].is_dir == target[path].is_dir:
+            continue
+        if result and path.startswith(result[-1] + "/"):
+            continue
+        result.append(path)
+    return result
+
+
+def local_digest(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def remote_digests(client, root: str, paths: typing.List[str]) -> typing.Dict[str, str]:
+    """ sha1 of remote files, relative to root, with batched sha1sum calls """
+    result = {}
+    prefix = "cd {} && sha1sum --".format(shlex.quote(root))
+    for cmd in _batched_commands(prefix, paths):
+        for line in run_command(client, cmd).decode(errors="replace").splitlines():
+            digest, _, name = line.partition("  ")
+            result[name] = digest
+    return result
+
+
+class Manifest:
+    """
+    Remote tree as left by the last sync, kept per device
+
+    Lets push compare against the local tree without listing the device
+    """
+
+    def __init__(self, device: str, local: str, remote: str):
+        key = hashlib.sha1("{}\0{}".format(os.path.abspath(local), remote).encode()).hexdigest()
+        device = re.sub(r"[^\w.-]", "_", device)
+        self._path = cache_dir().joinpath("manifests", device, key + ".json")
+
+    def load(self) -> typing.Optional[typing.Dict[str, Entry]]:
+        data = read_json(self._path)
+        if not isinstance(data, dict):
+            return None
+        return {path: Entry(*value) for path, value in data.items()}
+
+    def save(self, tree: typing.Dict[str, Entry]):
+        write_json(self._path, {path: list(entry) for path, entry in tree.items()})
+
+    def clear(self):
+        try:
+            os.unlink(str(self._path))
+        except OSError:
+            pass
+
+
+def remote_sample_matches(client, root: str, tree: typing.Dict[str, Entry], sample: int = 32) -> bool:
+    """ True when some files of tree, picked at random, still have their size and mtime below root, one exec """
+    files = [path for path, entry in tree.items() if not entry.is_dir]
+    if not files:
+        return False
+    picked = random.sample(files, min(sample, len(files)))
+    cmd = "cd {} && find -H {} -maxdepth 0 -printf {}".format(
+        shlex.quote(root), " ".join(shlex.quote("./" + p) for p in picked), shlex.quote(r"%s %T@ %p\0"))
+    with spans.span("exec.run", command="sync sample") as span:
+        _, stdout, _ = client.exec_command(cmd)
+        output = stdout.read()
+        # missing files only make find exit 1, they are absent from the output
+        stdout.channel.recv_exit_status()
+        span.add_bytes(len(output))
+    found = {}
+    for record in output.split(b"\0")[:-1]:
+        size, mtime, path = record.split(b" ", 2)
+        found[path.decode(errors="replace")[2:]] = (int(size), int(float(mtime)))
+    return all(found.get(p) == (tree[p].size, tree[p].mtime) for p in picked)
+
+
+class _ChannelWriter:
+    """ write-only file object for tarfile streams, sends straight to the channel """
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def write(self, data) -> int:
+        self._channel.sendall(data)
+        return len(data)
+
+
+def _tar_finish(stdout, stderr, cmd: str):
+    error = stderr.read()
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise TransferError("{!r} exit {}: {}".format(cmd, status, error.decode(errors="replace").strip()))
+
+
+def tar_push(client, local: str, remote: str, compress: bool = False) -> TransferStats:
+    """
+    Upload local file or directory to remote as one tar stream over a single exec channel
+
+    Nothing is staged on disk, tarfile only keeps one record buffer in memory
+    """
+    stats = TransferStats()
+    if os.path.isdir(local):
+        target, arcname = remote, "."
+    else:
+        target, arcname = posixpath.dirname(remote) or ".", posixpath.basename(remote)
+    cmd = "mkdir -p {0} && tar -x{1}f - -C {0}".format(shlex.quote(target), "z" if compress else "")
+    with spans.span("tar.push", compress=compress) as span:
+        stdin, stdout, stderr = client.exec_command(cmd)
+
+        def _count(tarinfo: tarfile.TarInfo):
+            if tarinfo.isfile():
+                stats.add(tarinfo.size)
+                span.add_bytes(tarinfo.size)
+            return tarinfo
+
+        try:
+            with tarfile.open(fileobj=_ChannelWriter(stdin.channel), mode="w|gz" if compress else "w|",
+                              format=tarfile.PAX_FORMAT) as tar:
+                tar.add(local, arcname=arcname, filter=_count)
+        finally:
+            stdin.channel.shutdown_write()
+        _tar_finish(stdout, stderr, cmd)
+    return stats
+
+
+def tar_pull(client, remote: str, local: str, compress: bool = False) -> TransferStats:
+    """ Download remote directory into local, extracting as the tar stream arrives """
+    stats = TransferStats()
+    cmd = "tar -c{}f - -C {} .".format("z" if compress else "", shlex.quote(remote))
+    with spans.span("tar.pull", compress=compress) as span:
+        _, stdout, stderr = client.exec_command(cmd)
+        try:
+            tar = tarfile.open(fileobj=stdout, mode="r|gz" if compress else "r|")
+        except tarfile.ReadError:
+            _tar_finish(stdout, stderr, cmd)
+            raise TransferError("{!r}: invalid tar stream".format(cmd))
+        os.makedirs(local, exist_ok=True)
+        kwargs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+        with tar:
+            for member in tar:
+                tar.extract(member, local, **kwargs)
+                if member.isfile():
+                    stats.add(member.size)
+                    span.add_bytes(member.size)
+        _tar_finish(stdout, stderr, cmd)
+    return stats
+
+
+# a stalled channel, e.g. an unplugged cable, fails after this many seconds instead of hanging
+STALL_TIMEOUT = 30.0
+_BACKOFF = 0.5
+_MAX_BACKOFF = 30.0
+# errors which a new connection does not fix
+_FATAL_ERRORS = (TransferError, FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)
+
+
+class ChunkMismatch(Exception):
+    """ a chunk arrived with a different sha1 than the source has """
+
+
+class Resume(typing.NamedTuple):
+    """ options of resumable transfers """
+    device: str
+    chunk_size: int = 8 * 1024 * 1024
+    verify: bool = False
+    retries: int = 5
+
+
+class Checkpoint:
+    """
+    Verified progress of one file transfer, kept until the file is complete
+
+    Only the contiguous prefix which is known to be on the target is recorded,
+    together with the sha1 of every chunk of it.
+    """
+
+    def __init__(self, device: str, direction: str, source: str, target: str):
+        key = hashlib.sha1("{}\0{}\0{}".format(direction, source, target).encode()).hexdigest()
+        device = re.sub(r"[^\w.-]", "_", device)
+        self._path = cache_dir().joinpath("transfers", device, key + ".json")
+        self.state = {}
+
+    @property
+    def offset(self) -> int:
+        return self.state.get("offset", 0)
+
+    def load(self, size: int, mtime: int, chunk_size: int) -> int:
+        """ offset to resume from, 0 unless the last attempt copied the same source file """
+        state = read_json(self._path, {})
+        if [state.get(k) for k in ("size", "mtime", "chunk_size")] == [size, mtime, chunk_size]:
+            self.state = state
+        else:
+            self.state = {"size": size, "mtime": mtime, "chunk_size": chunk_size, "offset": 0, "digests": []}
+        return self.offset
+
+    def reset(self, chunk: int = 0) -> int:
+        """ forget everything from chunk on """
+        self.state["digests"] = self.state["digests"][:chunk]
+        self.state["offset"] = chunk * self.state["chunk_size"]
+        write_json(self._path, self.state)
+        return self.offset
+
+    def advance(self, size: int, digest: str):
+        self.state["offset"] += size
+        self.state["digests"].append(digest)
+        write_json(self._path, self.state)
+
+    def clear(self):
+        try:
+            os.unlink(str(self._path))
+        except OSError:
+            pass
+
+
+def remote_chunk_digests(client, path: str, chunk_size: int, first: int, size: int) -> typing.Iterator[str]:
+    """ sha1 of every chunk of a remote file from chunk first on, streamed by one exec """
+    count = (size + chunk_size - 1) // chunk_size
+    cmd = ('f={}; i={}; while [ $i -lt {} ]; do dd if="$f" bs={} skip=$i count=1 2>/dev/null | sha1sum; '
+           'i=$((i+1)); done').format(shlex.quote(path), first, count, chunk_size)
+    _, stdout, _ = client.exec_command(cmd)
+    try:
+        for _ in range(first, count):
+            line = stdout.readline()
+            if not line:
+                raise EOFError("{!r}: digest stream ended early".format(cmd[:80]))
+            yield line.split()[0]
+    finally:
+        stdout.channel.close()
+
+
+def _with_retries(client, resume: Resume, checkpoint: Checkpoint, name: str, func: typing.Callable[[], None]):
+    """
+    call func until it completes, after a dropped connection reconnect with backoff and call it again
+
+    The failure count starts over whenever the checkpoint moved forward
+    """
+    failures = 0
+    delay = _BACKOFF
+    reached = checkpoint.offset
+    reconnect = False
+    while True:
+        try:
+            if reconnect:
+                client.reconnect()
+                reconnect = False
+            return func()
+        except _FATAL_ERRORS:
+            raise
+        except (OSError, EOFError, paramiko.SSHException, ChunkMismatch) as e:
+            if checkpoint.offset > reached:
+                failures, delay, reached = 0, _BACKOFF, checkpoint.offset
+            failures += 1
+            if failures > resume.retries:
+                raise TransferError("{}: giving up after {} retries: {}".format(name, resume.retries, e)) from e
+            sys.stderr.write("{}: {}, retry from {:.2f} MB in {:.1f}s\n".format(
+                name, str(e) or type(e).__name__, checkpoint.offset / 1024 / 1024, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, _MAX_BACKOFF)
+            reconnect = not isinstance(e, ChunkMismatch)
+
+
+def _open_sftp(client) -> paramiko.SFTPClient:
+    sftp = client.open_sftp()
+    sftp.get_channel().settimeout(STALL_TIMEOUT)
+    return sftp
+
+
+def resumable_get(client, remote: str, local: str, resume: Resume, stats: TransferStats,
+                  max_requests: typing.Optional[int] = None):
+    """
+    Download remote to local in chunks through local.part, resuming an earlier attempt
+
+    With resume.verify every chunk is compared with its sha1 computed on the device
+    """
+    checkpoint = Checkpoint(resume.device, "get", remote, os.path.abspath(local))
+    part = local + ".part"
+    chunk_size = resume.chunk_size
+
+    def attempt():
+        sftp = _open_sftp(client)
+        try:
+            attr = sftp.stat(remote)
+            size, mtime = attr.st_size, int(attr.st_mtime)
+            offset = checkpoint.load(size, mtime, chunk_size)
+            if offset and (not os.path.exists(part) or os.path.getsize(part) < offset):
+                offset = checkpoint.reset()
+            digests = remote_chunk_digests(client, remote, chunk_size, offset // chunk_size, size) \
+                if resume.verify and offset < size else None
+            with open(part, "r+b" if offset else "wb") as out, sftp.open(remote, "rb") as src:
+                out.truncate(offset)
+                out.seek(offset)
+                src.seek(offset)
+                src.prefetch(size, max_requests)
+                while offset < size:
+                    with spans.span("sftp.get_chunk") as span:
+                        data = src.read(min(chunk_size, size - offset))
+                        span.add_bytes(len(data))
+                    if not data:
+                        raise EOFError("{} shrank while reading".format(remote))
+                    digest = hashlib.sha1(data).hexdigest()
+                    if digests is not None and next(digests) != digest:
+                        raise ChunkMismatch("chunk {} of {} is corrupt".format(offset // chunk_size, remote))
+                    out.write(data)
+                    out.flush()
+                    os.fsync(out.fileno())
+                    offset += len(data)
+                    checkpoint.advance(len(data), digest)
+                    stats.add(len(data), files=0)
+            if digests is not None:
+                digests.close()
+        finally:
+            sftp.close()
+        os.replace(part, local)
+        os.utime(local, (mtime, mtime))
+
+    _with_retries(client, resume, checkpoint, remote, attempt)
+    checkpoint.clear()
+    stats.add(0)
+
+
+def resumable_put(client, local: str, remote: str, resume: Resume, stats: TransferStats):
+    """
+    Upload local to remote in chunks through remote.part, resuming an earlier attempt
+
+    With resume.verify the sha1 of every chunk is checked on the device once all
+    are written, the upload goes on from the first corrupt chunk
+    """
+    checkpoint = Checkpoint(resume.device, "put", os.path.abspath(local), remote)
+    part = remote + ".part"
+    chunk_size = resume.chunk_size
+    st = os.stat(local)
+    size = st.st_size
+
+    def attempt():
+        sftp = _open_sftp(client)
+        try:
+            offset = checkpoint.load(size, int(st.st_mtime), chunk_size)
+            if offset:
+                try:
+                    written = sftp.stat(part).st_size
+                except FileNotFoundError:
+                    written = -1
+                if written < offset:
+                    offset = checkpoint.reset()
+                else:
+                    sftp.truncate(part, offset)
+            if not offset:
+                sftp.open(part, "wb").close()
+            with open(local, "rb") as src:
+                src.seek(offset)
+                while offset < size:
+                    data = src.read(chunk_size)
+                    # closing waits for the pipelined writes, after that the chunk is on the device
+                    with spans.span("sftp.put_chunk", bytes=len(data)), sftp.open(part, "r+b") as out:
+                        out.seek(offset)
+                        out.set_pipelined(True)
+                        out.write(data)
+                    offset += len(data)
+                    checkpoint.advance(len(data), hashlib.sha1(data).hexdigest())
+                    stats.add(len(data), files=0)
+            if resume.verify and size:
+                expected = checkpoint.state["digests"]
+                for i, digest in enumerate(remote_chunk_digests(client, part, chunk_size, 0, size)):
+                    if digest != expected[i]:
+                        checkpoint.reset(i)
+                        raise ChunkMismatch("chunk {} of {} is corrupt".format(i, remote))
+            sftp.posix_rename(part, remote)
+        finally:
+            sftp.close()
+
+    _with_retries(client, resume, checkpoint, local, attempt)
+    checkpoint.clear()
+    stats.add(0)
@@ -0,0 +1,220 @@
+"""
+Listing of a remote tree with one streamed `find` instead of an sftp round trip per directory
+
+    for entry in walk(client, "/var/mobile/Media"):
+        print(entry.path, entry.size)
+
+Records are parsed as they arrive. A complete listing is kept per client,
+later walks of the same tree or of a subtree are answered from memory until
+forget() is called for a path below it, or the client goes away. Devices
+without GNU find (no -printf) are listed over sftp instead. A root which is
+not a directory raises NotADirectoryError, root_entry() describes it.
+"""
+import logging
+import posixpath
+import select
+import shlex
+import socket
+import stat
+import typing
+import weakref
+
+from .exceptions import BaseError
+
+logger = logging.getLogger(__name__)
+
+# type, size, permission bits (octal), mtime, path relative to the root, NUL terminated
+FIND_FORMAT = r"%y %s %m %T@ %P\0"
+_MISSING = 66  # exit status when the root does not exist
+_NOT_DIRECTORY = 67  # exit status when the root is something else
+_BUFFER_SIZE = 256 * 1024
+
+_TYPES = {"f": stat.S_IFREG, "d": stat.S_IFDIR, "l": stat.S_IFLNK, "b": stat.S_IFBLK, "c": stat.S_IFCHR,
+          "p": stat.S_IFIFO, "s": stat.S_IFSOCK}
+
+
+class WalkError(BaseError):
+    pass
+
+
+class RemoteEntry(typing.NamedTuple):
+    path: str  # relative to the walked root, posix separators
+    type: str  # as find %y: f d l b c p s
+    size: int
+    mode: int  # permission bits only
+    mtime: float
+
+    @property
+    def is_dir(self) -> bool:
+        return self.type == "d"
+
+    @property
+    def depth(self) -> int:
+        return self.path.count("/") + 1
+
+    def filemode(self) -> str:
+        """ like ls -l, drwxr-xr-x """
+        return stat.filemode(_TYPES.get(self.type, 0) | self.mode)
+
+
+class _TreeCache:
+    def __init__(self):
+        self._trees: typing.Dict[str, typing.List[RemoteEntry]] = {}
+
+    def get(self, root: str) -> typing.Optional[typing.List[RemoteEntry]]:
+        """ entries below root, from the cached tree of root or of one of its parents """
+        if root in self._trees:
+            return self._trees[root]
+        for cached, entries in self._trees.items():
+            rel = _relative(root, cached)
+            if rel is None:
+                continue
+            entry = next((e for e in entries if e.path == rel), None)
+            if entry is None:
+                raise FileNotFoundError("{}: no such file or directory".format(root))
+            if not entry.is_dir:
+                raise NotADirectoryError("{}: not a directory".format(root))
+            prefix = rel + "/"
+            return [e._replace(path=e.path[len(prefix):]) for e in entries if e.path.startswith(prefix)]
+        return None
+
+    def put(self, root: str, entries: typing.List[RemoteEntry]):
+        self._trees[root] = entries
+
+    def forget(self, path: str):
+        """ drop every cached tree which contains path or lies below it """
+        for root in list(self._trees):
+            if _relative(path, root) is not None or _relative(root, path) is not None or root == path:
+                del self._trees[root]
+
+
+_caches: "weakref.WeakKeyDictionary[typing.Any, _TreeCache]" = weakref.WeakKeyDictionary()
+
+
+def _normalize(root: str) -> str:
+    return posixpath.normpath(root) if root else "."
+
+
+def _relative(path: str, root: str) -> typing.Optional[str]:
+    """ path relative to root when path lies strictly below root, else None """
+    if root == "/":
+        return path[1:] if path.startswith("/") and path != "/" else None
+    if path.startswith(root + "/"):
+        return path[len(root) + 1:]
+    return None
+
+
+def forget(client, path: str):
+    """ the tree at path changed, e.g. after an upload """
+    cache = _caches.get(client)
+    if cache is not None:
+        cache.forget(_normalize(path))
+
+
+def walk(client, root: str, max_depth: typing.Optional[int] = None,
+         cache: bool = True) -> typing.Iterator[RemoteEntry]:
+    """
+    Every entry below root, parents before their children, root itself excluded
+
+    Raises:
+        FileNotFoundError when root does not exist
+        NotADirectoryError when root is a file or anything else but a directory
+        WalkError when part of the tree could not be read, after the readable entries
+    """
+    root = _normalize(root)
+    tree_cache = _caches.setdefault(client, _TreeCache()) if cache else None
+    cached = tree_cache.get(root) if tree_cache is not None else None
+    if cached is not None:
+        for entry in cached:
+            if max_depth is None or entry.depth <= max_depth:
+                yield entry
+        return
+    entries = [] if tree_cache is not None and max_depth is None else None
+    for entry in _find(client, root, max_depth):
+        if entries is not None:
+            entries.append(entry)
+        yield entry
+    if entries is not None:
+        tree_cache.put(root, entries)
+
+
+def _find(client, root: str, max_depth: typing.Optional[int]) -> typing.Iterator[RemoteEntry]:
+    depth = " -maxdepth {}".format(max_depth) if max_depth is not None else ""
+    cmd = "if [ -d {0} ]; then exec find -H {0} -mindepth 1{1} -printf {2}; elif [ -e {0} ]; then exit {3}; " \
+          "else exit {4}; fi".format(shlex.quote(root), depth, shlex.quote(FIND_FORMAT), _NOT_DIRECTORY, _MISSING)
+    stdin, stdout, stderr = client.exec_command(cmd)
+    stdin.close()
+    chan = stdout.channel
+    chan.settimeout(0)
+    errors = []
+    count = 0
+    partial = b""
+    eof = False
+    while not eof:
+        select.select([chan], [], [])
+        # drain stderr as well, the window is shared and permission errors can be many
+        while chan.recv_stderr_ready():
+            errors.append(chan.recv_stderr(_BUFFER_SIZE))
+        while True:
+            try:
+                data = chan.recv(_BUFFER_SIZE)
+            except socket.timeout:
+                break
+            if not data:
+                eof = True
+                break
+            *records, partial = (partial + data).split(b"\0")
+            for record in records:
+                count += 1
+                yield _parse(record)
+    chan.settimeout(None)
+    errors.append(stderr.read())
+    status = chan.recv_exit_status()
+    error = b"".join(errors).decode(errors="replace").strip()
+    if status == _MISSING:
+        raise FileNotFoundError("{}: no such file or directory".format(root))
+    if status == _NOT_DIRECTORY:
+        raise NotADirectoryError("{}: not a directory".format(root))
+    if status != 0 and not count and "printf" in error:
+        logger.debug("find without -printf, listing %s over sftp", root)
+        yield from _sftp_walk(client, root, max_depth)
+    elif status != 0:
+        raise WalkError("find {} exit {}: {}".format(root, status, error))
+
+
+def _parse(record: bytes) -> RemoteEntry:
+    kind, size, mode, mtime, path = record.split(b" ", 4)
+    return RemoteEntry(path.decode(errors="replace"), kind.decode(), int(size), int(mode, 8), float(mtime))
+
+
+def root_entry(client, path: str) -> RemoteEntry:
+    """ entry of path itself, named as given, like ls shows a file argument """
+    sftp = client.open_sftp()
+    try:
+        attr = sftp.stat(path)
+    except IOError as e:
+        raise FileNotFoundError("{}: no such file or directory".format(path)) from e
+    finally:
+        sftp.close()
+    return _entry(path, attr)
+
+
+def _entry(path: str, attr) -> RemoteEntry:
+    mode = attr.st_mode or 0
+    kind = next((k for k, v in _TYPES.items() if stat.S_IFMT(mode) == v), "f")
+    return RemoteEntry(path, kind, attr.st_size or 0, stat.S_IMODE(mode), float(attr.st_mtime or 0))
+
+
+def _sftp_walk(client, root: str, max_depth: typing.Optional[int]) -> typing.Iterator[RemoteEntry]:
+    sftp = client.open_sftp()
+    try:
+        pending = [""]
+        while pending:
+            rel = pending.pop(0)
+            for attr in sftp.listdir_attr(posixpath.join(root, rel) if rel else root):
+                entry = _entry(rel + "/" + attr.filename if rel else attr.filename, attr)
+                yield entry
+                if entry.is_dir and (max_depth is None or entry.depth < max_depth):
+                    pending.append(entry.path)
+    finally:
+        sftp.close()
@@ -5,4 +5,4 @@ __version__ = "0.0.1"
 
 setuptools.setup(
     version = __version__,
-    setup_requires=['pbr'], pbr=True, python_requires=">=3.6")
+    setup_requires=['pbr'], pbr=True, python_requires=">=3.7")
@@ -0,0 +1,60 @@
+"""
+push / pull --sync against a local paramiko server, see benchmarks/fakes.py
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fakes import FakeSSHServer  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = FakeSSHServer().start()
+    yield server
+    server.close()
+
+
+def ioscmd(server, tmp_path, *args) -> subprocess.CompletedProcess:
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path / "cache"))
+    return subprocess.run([sys.executable, "-m", "ioscmd", "-i", "127.0.0.1", "-p", str(server.port)] + list(args),
+                          cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def _tree(root) -> dict:
+    return {str(p.relative_to(root)): p.read_bytes() for p in root.rglob("*") if p.is_file()}
+
+
+@pytest.mark.parametrize("remote", ["missing", "file"])
+def test_pull_sync_delete_keeps_local_tree_without_remote_directory(server, tmp_path, remote):
+    local = tmp_path / "local"
+    (local / "sub").mkdir(parents=True)
+    (local / "sub" / "keep").write_bytes(b"keep")
+    (local / "top").write_bytes(b"top")
+    (tmp_path / "file").write_bytes(b"a file")
+    before = _tree(local)
+
+    result = ioscmd(server, tmp_path, "pull", "--sync", "--delete", str(tmp_path / remote), str(local))
+
+    assert result.returncode != 0
+    assert b"--sync expects a remote directory" in result.stderr
+    assert _tree(local) == before
+
+
+def test_push_sync_trust_manifest_sees_remote_change(server, tmp_path):
+    local = tmp_path / "local"
+    local.mkdir()
+    (local / "f").write_bytes(b"local")
+    remote = tmp_path / "remote"
+    assert ioscmd(server, tmp_path, "push", "--sync", str(local), str(remote)).returncode == 0
+
+    (remote / "f").write_bytes(b"changed on the device")
+    result = ioscmd(server, tmp_path, "push", "--sync", "--trust-manifest", str(local), str(remote))
+
+    assert result.returncode == 0
+    assert (remote / "f").read_bytes() == b"local"